@@ -12,11 +12,70 @@ __email__ = "valentin.lievin@gmail.com"
 __status__ = "Development"
 """
 
+import sys
+import time
+import numbers
+import threading
 import numpy as np
 from operator import itemgetter 
+from six import reraise
+from six.moves import queue
+
+def pad_batch(batch_xs, word_delimiter_ids):
+    """
+    pad a list of sequences and compute the word delimiters positions. We assume that the symbol representing padding is 0
+    Args:
+        batch_xs (list of lists of Natural Integers): sequences of ids
+        word_delimiter_ids (numpy array): ids of the symbols corresponding to spaces in the vocabulary
+    Returns:
+        a tuple padded_batch_xs, batch_lengths, batch_weights, end_of_words, batch_word_lengths, max_length (see Generator.next_batch)
+    """
+    batch_lengths = np.array([len(x) for x in batch_xs], dtype=np.int32)
+    max_length = int(batch_lengths.max())
+    # padding
+    mask = np.arange(max_length) < batch_lengths[:, None]
+    padded_batch_xs = np.zeros((len(batch_xs), max_length), dtype=np.int32)
+    padded_batch_xs[mask] = np.concatenate(batch_xs)
+    batch_weights = (padded_batch_xs > 0).astype(np.int32)
+    # end of words
+    is_delimiter = np.isin(padded_batch_xs, word_delimiter_ids) & mask
+    batch_word_lengths = is_delimiter.sum(axis=1).astype(np.int32)
+    max_words = int(batch_word_lengths.max())
+    word_mask = np.arange(max_words) < batch_word_lengths[:, None]
+    padded_end_of_words = np.zeros((len(batch_xs), max_words, 2), dtype=np.int32)
+    padded_end_of_words[:, :, 0] = np.arange(len(batch_xs))[:, None]
+    padded_end_of_words[:, :, 1][word_mask] = np.nonzero(is_delimiter)[1]
+    return padded_batch_xs, batch_lengths, batch_weights, padded_end_of_words, batch_word_lengths, max_length
+
+def split_padded_batch(padded_batch_xs, batch_lengths, batch_weights, end_of_words, batch_word_lengths, n):
+    """
+    split a padded batch (see pad_batch) into n micro-batches, each one is trimmed to its own maximum length
+    Args:
+        padded_batch_xs, batch_lengths, batch_weights, end_of_words, batch_word_lengths: padded batch
+        n (Natural Integer): number of micro-batches
+    Returns:
+        a list of n tuples (padded_batch_xs, batch_lengths, batch_weights, end_of_words, batch_word_lengths, start, stop)
+        where start and stop are the indexes of the micro-batch in the batch
+    """
+    bounds = np.linspace(0, len(batch_lengths), n + 1).astype(int)
+    micro_batches = []
+    for start, stop in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        max_length = int(batch_lengths[start:stop].max())
+        max_words = int(batch_word_lengths[start:stop].max())
+        micro_end_of_words = np.array(end_of_words[start:stop, :max_words], dtype=np.int32)
+        micro_end_of_words[:, :, 0] -= start
+        micro_batches.append((padded_batch_xs[start:stop, :max_length], batch_lengths[start:stop], batch_weights[start:stop, :max_length],
+                              micro_end_of_words, batch_word_lengths[start:stop], start, stop))
+    return micro_batches
+
+def delimiter_ids(word_delimiters):
+    """
+    keep the integer symbols of a list of word delimiters (only integer symbols can match an id)
+    """
+    return np.array([d for d in word_delimiters if isinstance(d, numbers.Integral)], dtype=np.int32)
 
 class Generator:
-    def __init__(self, x, y, batch_size, word_delimiters):
+    def __init__(self, x, y, batch_size, word_delimiters, sort_chunk=0, seed=None, sentiments=None, num_shards=1, shard_index=0):
         """
         initialize the class with inputs 'x' and labels 'y'
         Args:
@@ -24,29 +83,69 @@ class Generator:
             y (list of Objects): list of labels
             batch_size (Natural Interger): number of elements to be produced at each iteration
             word_delimiters (list of Natural Integer): list of the symbols corresponding to spaces in the vocabulary
+            sort_chunk (Natural Integer): number of batches sorted by length together after shuffling
+                (length bucketing). 0 or 1 to disable
+            seed (Integer): seed used to shuffle the data (use the global numpy random state if None)
+            sentiments (numpy array): optional precomputed sentiment features aligned with x (len(x) x 3)
+            num_shards (Natural Integer): number of workers sharing the data (data-parallel training)
+            shard_index (Natural Integer): index of this worker. The batches of the shuffled index are dealt to the workers,
+                thus all the workers must use the same seed
         """
         self.x = x
         self.y = y
         self.batch_size = batch_size
         self.index = list(xrange(len(x)))
-        self.n_steps = len(x) // batch_size
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.n_steps = len(x) // (batch_size * num_shards)
         self.step = 0
         self.word_delimiters = word_delimiters
+        self.word_delimiter_ids = delimiter_ids(word_delimiters)
+        self.sort_chunk = sort_chunk
+        self.random_state = np.random if seed is None else np.random.RandomState(seed)
+        if hasattr(x, 'lengths'):
+            self.lengths = np.asarray(x.lengths)
+        else:
+            self.lengths = np.array([len(s) for s in x])
+        self.sentiments = sentiments
         assert len(self.x) == len(self.y)
+        assert sentiments is None or len(sentiments) == len(self.x)
         assert self.n_steps > 0
+        assert 0 <= shard_index < num_shards
+        assert num_shards == 1 or seed is not None, "sharded generators must share the same seed"
         
     def iterations_per_epoch(self):
         """
         Return the number of iteration per epoch
         """
-        return len(self.x) // self.batch_size
+        return len(self.x) // (self.batch_size * self.num_shards)
         
     def shuffle(self):
         """
         shuffle index and re-initialize step
         """
-        np.random.shuffle(self.index)
+        self.random_state.shuffle(self.index)
+        if self.sort_chunk > 1:
+            self.index = self.bucketed_index()
         self.step = 0
+        
+    def bucketed_index(self):
+        """
+        group sentences of similar lengths: the shuffled index is split into chunks of sort_chunk batches,
+        each chunk is sorted by length and cut into batches, then the order of the batches is shuffled
+        Returns:
+            the new index
+        """
+        index = np.array(self.index)
+        n = len(index) // self.batch_size * self.batch_size
+        chunk_size = self.sort_chunk * self.batch_size
+        batches = []
+        for start in xrange(0, n, chunk_size):
+            chunk = index[start : min(start + chunk_size, n)]
+            chunk = chunk[np.argsort(self.lengths[chunk], kind='mergesort')]
+            batches += [chunk[k : k + self.batch_size] for k in xrange(0, len(chunk), self.batch_size)]
+        batches = [batches[k] for k in self.random_state.permutation(len(batches))]
+        return np.concatenate(batches + [index[n:]]).tolist()
     
     def epochCompleted(self):
         """
@@ -54,7 +153,14 @@ class Generator:
         Returns:
             True if completed else False
         """
-        return (self.step+1) * self.batch_size > len(self.x)
+        return (self.step+1) * self.batch_size * self.num_shards > len(self.x)
+    
+    def batch_indexes(self):
+        """
+        return the indexes of the elements of the next batch (batches are dealt to the shards in turn)
+        """
+        k = self.step * self.num_shards + self.shard_index
+        return self.index[k * self.batch_size : (k+1) * self.batch_size]
     
     def raw_batch(self):
         """
@@ -65,45 +171,266 @@ class Generator:
             batch_ys: the list of corresponding labels
         """
         assert (not self.epochCompleted())
-        indexes = self.index[self.step * self.batch_size : (self.step+1) * self.batch_size]
+        indexes = self.batch_indexes()
         self.step += 1
         return itemgetter(*indexes)(self.x), itemgetter(*indexes)(self.y)
     
-    def pad(self, l, n):
-        """
-        padd a sequence l to a sequence of length n. We assume that the symbol representing padding is 0.
-        Args:
-            l: sequence to be padded
-            n : target number of elmements
-        Returns:
-            the input sequence padded with 0s
-        """
-        return l[:n] + [0]*(n-len(l))
-
     def next_batch(self):
         """
-        return a padded batch. We assume that the symbol representing padding is 0
+        return a padded batch as numpy int32 arrays. We assume that the symbol representing padding is 0
         Returns:
             a tuple batch_xs, batch_ys; batch_weights, max_length
-                batch_xs: a padded list of batch_len objects
+                batch_xs: a padded array of batch_len objects (batch_len x max_length)
                 batch_ys: the list of corresponding labels
-                batch_lengths: the list of sequence lengths
-                batch_weights: a list of weights corresponding to 0 if it's a padded element, 0 otherwise
-                end_of_words: a list of indexes corresponding to the end of the words
+                batch_lengths: the array of sequence lengths
+                batch_weights: an array of weights corresponding to 0 if it's a padded element, 1 otherwise
+                end_of_words: an array of indexes [k,x] corresponding to the end of the words (batch_len x max_words x 2)
+                batch_word_lengths: the array of the number of words in each sequence
                 max_length: the maximum length in the current batch
+                batch_sentiments: the array of sentiment features (None if the generator has no sentiments)
         """
+        return self.timed_batch()[0]
+    
+    def timed_batch(self):
+        """
+        return the next padded batch (see next_batch) and the time spent building it and gathering the sentiment features
+        Returns:
+            a tuple batch, timings (dictionary phase -> seconds)
+        """
+        start = time.time()
+        indexes = self.batch_indexes()
         batch_xs, batch_ys = self.raw_batch()
-        batch_lengths = [len(x) for x in batch_xs]
-        max_length = max(batch_lengths)
-        padded_batch_xs = [ self.pad(d, max_length) for d in batch_xs ]
-        batch_weights = [ [ 1 if dd>0 else 0 for dd in d] for d in padded_batch_xs]
-        end_of_words = [ [i for i, j in enumerate(sentence) if j in self.word_delimiters] for sentence in batch_xs]
-        batch_word_lengths = [len(x) for x in end_of_words]
-        max_words = max(batch_word_lengths)
-        padded_end_of_words = [ [ [k,x] for x in self.pad(d, max_words) ] for k,d in enumerate(end_of_words) ]
-        return padded_batch_xs, batch_ys, batch_lengths, batch_weights, padded_end_of_words, batch_word_lengths, max_length
+        padded_batch_xs, batch_lengths, batch_weights, padded_end_of_words, batch_word_lengths, max_length = pad_batch(batch_xs, self.word_delimiter_ids)
+        timings = {'batch_build': time.time() - start, 'sentiment_feature': 0.}
+        batch_sentiments = None
+        if self.sentiments is not None:
+            start = time.time()
+            batch_sentiments = np.asarray(self.sentiments[indexes])
+            timings['sentiment_feature'] = time.time() - start
+        return (padded_batch_xs, batch_ys, batch_lengths, batch_weights, padded_end_of_words, batch_word_lengths, max_length, batch_sentiments), timings
+        
         
+class StreamGenerator:
+    """
+    Produce padded batches from a stream of sequences (e.g. data_utils_WMT.stream_data), without loading the whole
+    dataset into memory. Sequences are shuffled using a buffer of fixed size.
+    The class has the interface of Generator (shuffle, epochCompleted, next_batch), thus it can be used with Prefetcher.
+    """
+    def __init__(self, stream_fn, batch_size, word_delimiters, shuffle_buffer=0, seed=None):
+        """
+        Args:
+            stream_fn (function): function returning a new iterator over the sequences (called at each epoch)
+            batch_size (Natural Interger): number of elements to be produced at each iteration
+            word_delimiters (list of Natural Integer): list of the symbols corresponding to spaces in the vocabulary
+            shuffle_buffer (Natural Integer): number of sequences in the shuffling buffer (0: no shuffling)
+            seed (Integer): seed used to shuffle the data (use the global numpy random state if None)
+        """
+        self.stream_fn = stream_fn
+        self.batch_size = batch_size
+        self.word_delimiters = word_delimiters
+        self.word_delimiter_ids = delimiter_ids(word_delimiters)
+        self.shuffle_buffer = shuffle_buffer
+        self.random_state = np.random if seed is None else np.random.RandomState(seed)
+        self.n_steps = None
+        self.batches = None
+        self.next = None
+        
+    def iterations_per_epoch(self):
+        """
+        Return the number of iteration per epoch (the stream is read once to count the sequences)
+        """
+        if self.n_steps is None:
+            self.n_steps = sum(1 for _ in self.stream_fn()) // self.batch_size
+            assert self.n_steps > 0
+        return self.n_steps
         
+    def shuffled(self, stream):
+        """
+        shuffle a stream using a buffer of shuffle_buffer elements
+        """
+        buffer = []
+        for x in stream:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(x)
+                continue
+            k = self.random_state.randint(len(buffer))
+            yield buffer[k]
+            buffer[k] = x
+        self.random_state.shuffle(buffer)
+        for x in buffer:
+            yield x
     
+    def __iter__(self):
+        """
+        iterate over the batches of one epoch. The last incomplete batch is dropped. Labels are not available (None)
+        Returns:
+            tuples padded_batch_xs, None, batch_lengths, batch_weights, end_of_words, batch_word_lengths, max_length, None
+            (see Generator.next_batch)
+        """
+        stream = self.stream_fn()
+        if self.shuffle_buffer > 0:
+            stream = self.shuffled(stream)
+        batch_xs = []
+        for x in stream:
+            batch_xs.append(x)
+            if len(batch_xs) == self.batch_size:
+                padded_batch_xs, batch_lengths, batch_weights, end_of_words, batch_word_lengths, max_length = pad_batch(batch_xs, self.word_delimiter_ids)
+                yield padded_batch_xs, None, batch_lengths, batch_weights, end_of_words, batch_word_lengths, max_length, None
+                batch_xs = []
+                
+    def shuffle(self):
+        """
+        start a new epoch: the stream is opened again and shuffled through the buffer
+        """
+        self.batches = iter(self)
+        self.next = next(self.batches, None)
+        
+    def epochCompleted(self):
+        """
+        Says if a whole epoch has been processed
+        Returns:
+            True if completed else False
+        """
+        return self.next is None
+    
+    def next_batch(self):
+        """
+        return the next padded batch (see Generator.next_batch). Labels and sentiment features are not available (None)
+        """
+        return self.timed_batch()[0]
     
-    
\ No newline at end of file
+    def timed_batch(self):
+        """
+        return the next padded batch (see next_batch) and the time spent reading the stream and building it
+        Returns:
+            a tuple batch, timings (dictionary phase -> seconds)
+        """
+        assert (not self.epochCompleted())
+        batch = self.next
+        # the batches are built lazily, the following one is read from the stream now
+        start = time.time()
+        self.next = next(self.batches, None)
+        return batch, {'batch_build': time.time() - start}
+        
+        
+_END_OF_EPOCH = object()
+
+class _WorkerException:
+    """
+    exception raised in the worker thread, forwarded to the main thread
+    """
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class Prefetcher:
+    """
+    Iterate over the batches of a Generator while the next batches are prepared in a background thread.
+    The batches are produced by a single worker, in the same order as Generator.next_batch. The padding and timing
+    statistics are only updated by the consumer, for the batches it has received
+    """
+    def __init__(self, generator, queue_size=4, preprocess=None):
+        """
+        Args:
+            generator (Generator): batch generator
+            queue_size (Natural Integer): maximum number of batches prepared in advance
+            preprocess (function): optional function applied to each batch in the worker thread,
+                its output is appended to the batch tuple
+        """
+        assert queue_size > 0
+        self.generator = generator
+        self.queue_size = queue_size
+        self.preprocess = preprocess
+        self.queue = None
+        self.thread = None
+        self.stop_event = None
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.timings = {}
+        
+    def start(self):
+        """
+        shuffle the generator and start preparing the batches of a new epoch
+        """
+        self.close()
+        self.generator.shuffle()
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.queue = queue.Queue(maxsize=self.queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, args=(self.queue, self.stop_event))
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def _put(self, q, stop_event, item):
+        """
+        put an item in the queue unless the prefetcher is stopped
+        """
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+            
+    def _worker(self, q, stop_event):
+        """
+        produce the batches of the current epoch
+        """
+        try:
+            while not self.generator.epochCompleted() and not stop_event.is_set():
+                batch, timings = self.generator.timed_batch()
+                if self.preprocess is not None:
+                    batch = batch + (self.preprocess(batch),)
+                self._put(q, stop_event, (batch, timings))
+        except Exception:
+            self._put(q, stop_event, _WorkerException(sys.exc_info()))
+        self._put(q, stop_event, _END_OF_EPOCH)
+        
+    def __iter__(self):
+        """
+        iterate over the batches of one epoch. Exceptions raised in the worker are raised here.
+        """
+        self.start()
+        try:
+            while True:
+                try:
+                    # use a timeout so that KeyboardInterrupt can be received
+                    item = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _END_OF_EPOCH:
+                    break
+                if isinstance(item, _WorkerException):
+                    reraise(*item.exc_info)
+                batch, timings = item
+                self.real_tokens += int(batch[2].sum())
+                self.padded_tokens += batch[0].size
+                for name, seconds in timings.items():
+                    self.timings[name] = self.timings.get(name, 0.) + seconds
+                yield batch
+        finally:
+            self.close()
+            
+    def padding_efficiency(self):
+        """
+        Return the ratio of real elements over padded elements for the batches received since the start of the epoch
+        """
+        if self.padded_tokens == 0:
+            return 1.0
+        return float(self.real_tokens) / self.padded_tokens
+    
+    def pop_timings(self):
+        """
+        Return the time spent building the received batches and gathering their sentiment features since the last call (in seconds)
+        """
+        timings, self.timings = self.timings, {}
+        return timings
+            
+    def close(self):
+        """
+        stop the worker thread
+        """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
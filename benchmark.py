@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Micro and macro benchmarks of the hot paths of the VRAE model, on CPU with synthetic corpora:
+    micro: batch.Generator.next_batch, character_tokenizer, sentence_to_token_ids, read_data
+    macro: Vrae.step for each cell type, batch size and sequence length, XToz and zToX latency
+Results are written to a json file and compared against a stored baseline (a benchmark slower than
+baseline * (1 + tolerance) is reported as a regression and the script exits with an error).
+
+Usage:  python benchmark.py --output results.json --baseline benchmarks_baseline.json
+        python benchmark.py --output results.json --baseline benchmarks_baseline.json --update_baseline
+        python benchmark.py --suite micro
+
+__author__ = "Valentin Lievin, DTU, Denmark"
+__copyright__ = "Copyright 2017, Valentin Lievin"
+__credits__ = ["Valentin Lievin"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Valentin Lievin"
+__email__ = "valentin.lievin@gmail.com"
+__status__ = "Development"
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import multiprocessing
+from timeit import default_timer
+import numpy as np
+import tensorflow as tf
+import data_utils_LMR
+from data_utils_LMR import character_tokenizer, sentence_to_token_ids, read_data
+from batch import Generator, pad_batch, delimiter_ids
+
+tf.app.flags.DEFINE_string("output", "benchmark_results.json", "file where the results are written")
+tf.app.flags.DEFINE_string("baseline", "", "baseline results to compare with")
+tf.app.flags.DEFINE_boolean("update_baseline", False, "write the results to the baseline file")
+tf.app.flags.DEFINE_float("tolerance", 0.2, "relative slowdown reported as a regression")
+tf.app.flags.DEFINE_string("suite", "all", "micro, macro or all")
+tf.app.flags.DEFINE_integer("repeat", 5, "number of measures of each benchmark (the median is reported)")
+tf.app.flags.DEFINE_integer("seed", 1234, "seed of the synthetic data")
+tf.app.flags.DEFINE_integer("num_sentences", 20000, "number of sentences of the synthetic corpus (micro benchmarks)")
+tf.app.flags.DEFINE_string("cells", "GRU,LSTM,LNLSTM,UGRNN", "cell types of the Vrae.step benchmarks")
+tf.app.flags.DEFINE_string("batch_sizes", "32,128", "batch sizes of the Vrae.step benchmarks")
+tf.app.flags.DEFINE_string("sequence_lengths", "20,60", "sequence lengths of the Vrae.step benchmarks")
+tf.app.flags.DEFINE_integer("state_size", 128, "state size of the RNN cells in the macro benchmarks")
+FLAGS = tf.app.flags.FLAGS
+
+NUM_SYMBOLS = 60
+SPACE_ID = 4
+_CHARACTERS_ = list("abcdefghijklmnopqrstuvwxyz0123456789.,!?'")
+
+
+def measure(fn, repeat, number=1, warmup=1):
+    """
+    time a function
+    Args:
+        fn (function): function to benchmark
+        repeat (Natural Integer): number of measures
+        number (Natural Integer): number of calls per measure
+        warmup (Natural Integer): number of calls before measuring
+    Returns:
+        dictionary of statistics, in seconds per call
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(number):
+            fn()
+        times.append((default_timer() - start) / number)
+    return {'median': float(np.median(times)), 'min': float(np.min(times)), 'max': float(np.max(times)),
+            'repeat': repeat, 'number': number}
+
+def synthetic_ids(n, min_length, max_length, random_state):
+    """
+    random sequences of ids with spaces (words of 1 to 8 symbols), starting with GO and ending with EOS
+    """
+    sequences = []
+    for length in random_state.randint(min_length, max_length + 1, size=n):
+        ids = random_state.randint(SPACE_ID + 1, NUM_SYMBOLS, size=length)
+        ids[random_state.rand(length) < 0.2] = SPACE_ID
+        sequences.append([data_utils_LMR.GO_ID] + ids.tolist() + [data_utils_LMR.EOS_ID])
+    return sequences
+
+def synthetic_text(n, random_state):
+    """
+    random sentences of 5 to 20 words
+    """
+    sentences = []
+    for n_words in random_state.randint(5, 21, size=n):
+        words = [ "".join(random_state.choice(_CHARACTERS_, size=random_state.randint(1, 9))) for _ in range(n_words) ]
+        sentences.append(" ".join(words).capitalize() + ".")
+    return sentences
+
+def micro_benchmarks(random_state):
+    """
+    benchmarks of the data pipeline
+    Returns:
+        dictionary name -> statistics
+    """
+    results = {}
+    # batch generator
+    sequences = synthetic_ids(FLAGS.num_sentences, 10, 60, random_state)
+    for batch_size in [32, 800]:
+        generator = Generator(sequences, [0] * len(sequences), batch_size, [SPACE_ID], seed=FLAGS.seed)
+        def next_batch():
+            if generator.epochCompleted():
+                generator.shuffle()
+            generator.next_batch()
+        generator.shuffle()
+        results["generator.next_batch/batch%d" % batch_size] = measure(next_batch, FLAGS.repeat, number=20)
+    # tokenization
+    sentences = synthetic_text(1000, random_state)
+    vocabulary = dict( (c, k + SPACE_ID + 1) for k, c in enumerate(sorted(set("".join(sentences).lower()) | set("_"))) )
+    results["character_tokenizer/1000_sentences"] = measure(lambda: [character_tokenizer(s) for s in sentences], FLAGS.repeat)
+    results["sentence_to_token_ids/1000_sentences"] = measure(lambda: [sentence_to_token_ids(s, vocabulary) for s in sentences], FLAGS.repeat)
+    # read_data on a synthetic corpus
+    directory = tempfile.mkdtemp()
+    sentences_dir = data_utils_LMR._SENTENCES_DIR
+    try:
+        with open(os.path.join(directory, 'sentences.txt'), 'w') as fp:
+            for ids in sequences:
+                fp.write("%d|%s\n" % (random_state.randint(1, 11), " ".join(str(i) for i in ids)))
+        data_utils_LMR._SENTENCES_DIR = directory + '/'
+        def create_binary_corpus():
+            data_utils_LMR.create_binary_corpus(data_utils_LMR._SENTENCES_DIR, force=True)
+        results["create_binary_corpus/%d_sentences" % len(sequences)] = measure(create_binary_corpus, FLAGS.repeat, warmup=0)
+        results["read_data/%d_sentences" % len(sequences)] = measure(lambda: read_data(max_sentence_size=50, min_sentence_size=15), FLAGS.repeat)
+    finally:
+        data_utils_LMR._SENTENCES_DIR = sentences_dir
+        shutil.rmtree(directory)
+    return results
+
+def build_model(cell_type, batch_size):
+    """
+    build a small Vrae model and initialize it in a new session
+    """
+    from model import Vrae
+    vrae_model = Vrae(char2word_state_size=FLAGS.state_size, char2word_num_layers=1,
+                      encoder_state_size=FLAGS.state_size, encoder_num_layers=1,
+                      decoder_state_size=FLAGS.state_size, decoder_num_layers=1,
+                      latent_dim=16, batch_size=batch_size, num_symbols=NUM_SYMBOLS,
+                      input_keep_prob=0.9, output_keep_prob=0.5, latent_loss_weight=0.1,
+                      dtype_precision=32, cell_type=cell_type, peephole=False, sentiment_feature=True)
+    sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+    sess.run(tf.global_variables_initializer())
+    return vrae_model, sess
+
+def macro_benchmarks(random_state):
+    """
+    benchmarks of the model: training step and inference latency
+    Returns:
+        dictionary name -> statistics (or error message if the model can not be built)
+    """
+    results = {}
+    for cell_type in FLAGS.cells.split(","):
+        for batch_size in [ int(b) for b in FLAGS.batch_sizes.split(",") ]:
+            try:
+                vrae_model, sess = build_model(cell_type, batch_size)
+            except Exception as e:
+                results["vrae.step/%s" % cell_type] = {'error': repr(e)}
+                break
+            with sess:
+                for length in [ int(l) for l in FLAGS.sequence_lengths.split(",") ]:
+                    sequences = synthetic_ids(batch_size, length - 2, length - 2, random_state)
+                    padded_batch_xs, batch_lengths, batch_weights, end_of_words, batch_word_lengths, _ = pad_batch(sequences, delimiter_ids([SPACE_ID]))
+                    sentiments = np.zeros((batch_size, 3))
+                    def step():
+                        vrae_model.step(sess, padded_batch_xs, 0.5, 1e-4, batch_lengths, batch_weights, end_of_words,
+                                        batch_word_lengths, 0, sentiments, summarize=False)
+                    results["vrae.step/%s/batch%d/length%d" % (cell_type, batch_size, length)] = measure(step, FLAGS.repeat, number=3)
+                if batch_size == min( int(b) for b in FLAGS.batch_sizes.split(",") ):
+                    # latency of a single sentence
+                    length = max( int(l) for l in FLAGS.sequence_lengths.split(",") )
+                    sequence = synthetic_ids(1, length - 2, length - 2, random_state)
+                    padded_batch_xs, batch_lengths, _, end_of_words, batch_word_lengths, _ = pad_batch(sequence, delimiter_ids([SPACE_ID]))
+                    z = random_state.randn(16)
+                    results["vrae.XToz/%s/length%d" % (cell_type, length)] = measure(
+                        lambda: vrae_model.XToz(sess, padded_batch_xs[0], batch_lengths[0], end_of_words[0], batch_word_lengths[0], [0., 0., 0.]),
+                        FLAGS.repeat, number=10)
+                    results["vrae.zToX/%s/length%d" % (cell_type, length)] = measure(lambda: vrae_model.zToX(sess, z, length), FLAGS.repeat, number=10)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    compare results with a baseline
+    Returns:
+        list of (name, baseline median, current median, ratio) for the regressions
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline or 'median' not in results[name] or 'median' not in baseline[name]:
+            continue
+        ratio = results[name]['median'] / max(baseline[name]['median'], 1e-12)
+        status = "REGRESSION" if ratio > 1 + tolerance else ""
+        print("%-50s %10.5fs %10.5fs %6.2fx %s" % (name, baseline[name]['median'], results[name]['median'], ratio, status))
+        if status:
+            regressions.append((name, baseline[name]['median'], results[name]['median'], ratio))
+    return regressions
+
+def main(_):
+    random_state = np.random.RandomState(FLAGS.seed)
+    results = {}
+    if FLAGS.suite in ("micro", "all"):
+        results.update(micro_benchmarks(random_state))
+    if FLAGS.suite in ("macro", "all"):
+        results.update(macro_benchmarks(random_state))
+    report = {'metadata': {'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+                           'python': platform.python_version(),
+                           'tensorflow': tf.__version__,
+                           'numpy': np.__version__,
+                           'platform': platform.platform(),
+                           'cpu_count': multiprocessing.cpu_count(),
+                           'flags': dict( (k, str(v)) for k, v in FLAGS.__flags.items() )},
+              'results': results}
+    with open(FLAGS.output, 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    print("results written to %s" % FLAGS.output)
+    if FLAGS.baseline and FLAGS.update_baseline:
+        shutil.copyfile(FLAGS.output, FLAGS.baseline)
+        print("baseline updated: %s" % FLAGS.baseline)
+    elif FLAGS.baseline:
+        with open(FLAGS.baseline, 'r') as fp:
+            baseline = json.load(fp)['results']
+        regressions = compare(results, baseline, FLAGS.tolerance)
+        if regressions:
+            print("%d regression(s)" % len(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    tf.app.run()
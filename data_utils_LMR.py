@@ -20,15 +20,23 @@ from __future__ import print_function
 
 import gzip
 import os
+import json
+import hashlib
 import re
 import tarfile
 import sys
+import multiprocessing
+from array import array
+from collections import Counter
+import numpy as np
 from tqdm import tqdm
 import spacy
 from bs4 import BeautifulSoup
 from nltk.tokenize import sent_tokenize
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
 
 from six.moves import urllib
+from six import int2byte
 
 from tensorflow.python.platform import gfile
 import tensorflow as tf
@@ -59,10 +67,30 @@ _TEST_SENTENCES_DIR = _DATA_DIR_+'test_sentences/'
 _TRAIN_DIRS_ = [_DATA_DIR_+ 'aclImdb/train/neg/', _DATA_DIR_ + 'aclImdb/train/pos/']
 _TEST_DIRS_ = [_DATA_DIR_+ 'aclImdb/test/neg/', _DATA_DIR_ + 'aclImdb/test/pos/']
 _VOCAB_DIR_ = _DATA_DIR_+'vocab.dat'
+# binary corpus files (memory-mapped numpy arrays)
+_TOKENS_FILE_ = 'tokens.npy'
+_OFFSETS_FILE_ = 'offsets.npy'
+_LENGTHS_FILE_ = 'lengths.npy'
+_RATINGS_FILE_ = 'ratings.npy'
+_BINARY_CORPUS_FILES_ = [_TOKENS_FILE_, _OFFSETS_FILE_, _LENGTHS_FILE_, _RATINGS_FILE_]
+_SENTIMENTS_FILE_ = 'sentiments.npy'
+# incremental preprocessing: a single corpus of all the reviews, the split is stored as an index
+_CORPUS_DIR_ = _DATA_DIR_+'corpus/'
+_MANIFEST_FILE_ = 'manifest.json'
+_SPLIT_FILE_ = 'split.npy'
+TRAIN_SPLIT = 0
+TEST_SPLIT = 1
+REMOVED_SPLIT = -1
+SENTIMENT_CHUNK_SIZE = 10000
 
 nlp = spacy.load('en')
 character_pattern = re.compile('([^\s\w\'\.\!\,\?]|_)+')
-special_character_pattern = re.compile(r"([\'\.\!\,\?])")
+# special characters are surrounded by spaces (str.replace is much faster than a regex substitution with a group)
+special_characters = [ (c, " " + c + " ") for c in ["'", ".", "!", ",", "?"] ]
+spaces_pattern = re.compile(' +')
+# prettyDecode: spaces before punctuation and end of the sentence
+pretty_punctuation_pattern = re.compile(r" ([,.!?'])")
+pretty_end_pattern = re.compile(r"[.?!]")
 
 def to_unicode(text, encoding='utf8', errors='strict'):
     """Convert a string (bytestring in `encoding` or unicode), to unicode."""
@@ -97,17 +125,51 @@ def character_tokenizer(sentence):
     Return:
         a list of characters
     """
+    return list(character_string(sentence))
+
+def character_string(sentence):
+    """
+    the characters of character_tokenizer, as a single string
+    """
     # remove non alphanumeric characters
     sentence = character_pattern.sub('', sentence)
     # add spaces before and after special characters
-    sentence  = special_character_pattern.sub(" \\1 ", sentence)
+    for c, spaced in special_characters:
+        sentence = sentence.replace(c, spaced)
     #remove redondant spaces
-    sentence = re.sub(' +',' ',sentence)
+    sentence = spaces_pattern.sub(' ',sentence)
     # replace spaces with "_"
     sentence = sentence.replace(' ', '_')
     sentence= sentence[:len(sentence)-1]
     # remove last space
-    return list(sentence.lower())
+    return sentence.lower()
+
+sentimentAnalyzer = None
+def getSentimentScore(sentence):
+    """
+    VADER sentiment scores of a sentence
+    Args:
+        sentence: input text
+    Return:
+        a tuple (negative, neutral, positive)
+    """
+    global sentimentAnalyzer
+    if sentimentAnalyzer is None:
+        sentimentAnalyzer = SentimentIntensityAnalyzer()
+    scores = sentimentAnalyzer.polarity_scores(sentence)
+    return (scores['neg'], scores['neu'] ,scores['pos'])
+
+def sentiment_features(encoder_decoder, seqs):
+    """
+    VADER sentiment features of sequences of ids, computed on the text decoded with EncoderDecoder.prettyDecode
+    as for the corpus (see create_sentiment_features)
+    Args:
+        encoder_decoder (EncoderDecoder): vocabulary
+        seqs (list of lists of ids): sequences
+    Return:
+        numpy array (len(seqs) x 3)
+    """
+    return np.array([ getSentimentScore(encoder_decoder.prettyDecode(seq)) for seq in seqs ], dtype=np.float32).reshape(-1, 3)
 
 def maybe_download(directory, filename, url):
     """Download filename from url unless it's already in directory."""
@@ -143,37 +205,62 @@ def getData(directory):
     else:
         print("Data already downloaded.")
 
+def list_files(data_paths):
+    """
+    list the files contained in a list of directories, in a deterministic order
+    Args:
+        data_paths: list of directories
+    Returns:
+        list of file paths
+    """
+    files = []
+    for d in data_paths:
+        files += [d+f for f in sorted(os.listdir(d)) ]
+    return files
+
+def count_tokens(args):
+    """
+    count the tokens of one file (used by create_vocabulary in worker processes)
+    Args:
+        args: a tuple (file path, tokenizer, normalize_digits)
+    Returns:
+        a Counter token -> number of occurences
+    """
+    one_file, tokenizer, normalize_digits = args
+    with gfile.GFile(one_file, mode="rb") as f:
+        review = f.read()
+    tokens = tokenizer(review) if tokenizer else character_tokenizer(review)
+    return Counter( _DIGIT_RE.sub(b"0", w) if normalize_digits else w for w in tokens )
+
 def create_vocabulary(vocabulary_path, data_paths, max_vocabulary_size,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True, processes=None):
     """Create vocabulary file (if it does not exist yet) from data file.
       Data files are supposed to be a list of files with the list of directories. Each sentence is
       tokenized and digits are normalized (if normalize_digits is set).
       Vocabulary contains the most-frequent tokens up to max_vocabulary_size.
       We write it to vocabulary_path in a one-token-per-line format, so that later
       token in the first line gets id=0, second line gets id=1, and so on.
+      Files are processed in parallel and the counts are merged in the order of the files.
       Args:
         vocabulary_path: path where the vocabulary will be created.
         data_path: data file that will be used to create vocabulary.
         max_vocabulary_size: limit on the size of the created vocabulary.
         tokenizer: a function to use to tokenize each data sentence;
-          if None, basic_tokenizer will be used.
+          if None, basic_tokenizer will be used. It must be a module level function (sent to worker processes)
         normalize_digits: Boolean; if true, all digits are replaced by 0s.
+        processes: number of worker processes (number of cpus if None)
      """
     if not gfile.Exists(vocabulary_path):
-        vocab = {}
-        files = []
-        for d in data_paths:
-            files += [d+f for f in os.listdir(d) ]
-        for one_file in tqdm(files):
-            with gfile.GFile(one_file, mode="rb") as f:
-                review = f.read()
-                tokens = tokenizer(review) if tokenizer else character_tokenizer(review)
-                for w in tokens:
-                    word = _DIGIT_RE.sub(b"0", w) if normalize_digits else w
-                    if word in vocab:
-                        vocab[word] += 1
-                    else:
-                        vocab[word] = 1
+        vocab = Counter()
+        files = list_files(data_paths)
+        jobs = [ (one_file, tokenizer, normalize_digits) for one_file in files ]
+        pool = multiprocessing.Pool(processes)
+        try:
+            for counts in tqdm(pool.imap(count_tokens, jobs, chunksize=16), total=len(jobs)):
+                vocab.update(counts)
+        finally:
+            pool.close()
+            pool.join()
         vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
         if len(vocab_list) > max_vocabulary_size:
             vocab_list = vocab_list[:max_vocabulary_size]
@@ -237,44 +324,69 @@ def sentence_to_token_ids(sentence, vocabulary,
     output += [EOS_ID]
     return output
 
+tokenizerVocabulary = None
+def _tokenizer_worker_init(vocabulary_path):
+    """
+    load the vocabulary in a worker process
+    """
+    global tokenizerVocabulary
+    tokenizerVocabulary, _ = initialize_vocabulary(vocabulary_path)
+
+def file_to_token_lines(args):
+    """
+    convert the sentences of one review file into lines "rating|ids" (used by data_to_token_ids in worker processes)
+    Args:
+        args: a tuple (file path, tokenizer, normalize_digits)
+    Returns:
+        the list of lines to be written in sentences.txt
+    """
+    one_file, tokenizer, normalize_digits = args
+    lines = []
+    with gfile.GFile(one_file, mode="rb") as f:
+        rating = one_file.split('/')[-1].split('.')[0].split('_')[-1]
+        review = cleanHTML( f.read() )
+        for sentence in sentence_tokenizer(review):
+            if len(sentence) > 3: 
+                while sentence[0] == " ":
+                    if len(sentence) > 2:
+                        sentence = sentence[1:]
+                token_ids = sentence_to_token_ids(tf.compat.as_bytes(sentence), tokenizerVocabulary,
+                                            tokenizer, normalize_digits)
+                lines.append(str(rating) + '|' + " ".join([str(tok) for tok in token_ids]) + "\n")
+    return lines
+
 def data_to_token_ids(data_paths, target_path, vocabulary_path,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True, processes=None):
     """Tokenize data file and turn into token-ids using given vocabulary file.
       This function loads data line-by-line from data_path, calls the above
       sentence_to_token_ids, and saves the result to target_path. 
       Sentiment scores are added using the file names ([[id]_[rating].txt])
       See comment for sentence_to_token_ids on the details of token-ids format.
+      Files are tokenized in parallel and written in the order of the files, thus the output
+      does not depend on the number of processes.
       Args:
         data_path: path to the data file in one-sentence-per-line format.
         target_path: path where the file with token-ids will be created.
         vocabulary_path: path to the vocabulary file.
         tokenizer: a function to use to tokenize each sentence;
-          if None, basic_tokenizer will be used.
+          if None, basic_tokenizer will be used. It must be a module level function (sent to worker processes)
         normalize_digits: Boolean; if true, all digits are replaced by 0s.
+        processes: number of worker processes (number of cpus if None)
     """
     if not os.path.exists(target_path):
         os.makedirs(target_path)
     if not gfile.Exists(target_path+"sentences.txt"):
         print("Tokenizing data in %s" % data_paths)
-        vocab, _ = initialize_vocabulary(vocabulary_path)
-        files = []
-        for d in data_paths:
-            files += [d+f for f in os.listdir(d) ]
-        with gfile.GFile(target_path+"sentences.txt" , mode="w") as tokens_file:
-            with gfile.GFile(target_path+"sentiments.txt" , mode="w") as sentiments_files:
-                for one_file in tqdm(files):
-                    with gfile.GFile(one_file, mode="rb") as f:
-                        rating = one_file.split('/')[-1].split('.')[0].split('_')[-1]
-                        review = cleanHTML( f.read() )
-                        for sentence in sentence_tokenizer(review):
-                            if len(sentence) > 3: 
-                                while sentence[0] == " ":
-                                    if len(sentence) > 2:
-                                        sentence = sentence[1:]
-                                token_ids = sentence_to_token_ids(tf.compat.as_bytes(sentence), vocab,
-                                                            tokenizer, normalize_digits)
-                                tokens_file.write(str(rating) + '|' + " ".join([str(tok) for tok in token_ids]) + "\n")
-                                #sentiments_files.write( str(rating) + "\n")
+        files = list_files(data_paths)
+        jobs = [ (one_file, tokenizer, normalize_digits) for one_file in files ]
+        pool = multiprocessing.Pool(processes, initializer=_tokenizer_worker_init, initargs=(vocabulary_path,))
+        try:
+            with gfile.GFile(target_path+"sentences.txt" , mode="w") as tokens_file:
+                for lines in tqdm(pool.imap(file_to_token_lines, jobs, chunksize=16), total=len(jobs)):
+                    tokens_file.write("".join(lines))
+        finally:
+            pool.close()
+            pool.join()
 
                                 
 def moveLinesFromFileToFile(source_file_path, target_file_path, lines_to_keep):
@@ -308,72 +420,462 @@ def moveLinesFromFileToFile(source_file_path, target_file_path, lines_to_keep):
             source_file.write(row)
     
 
-def prepare_data(vocabulary_size):
+def prepare_data(vocabulary_size, processes=None, incremental=False):
     """
     Download the Large Movie Review Dataset, create the vocabulary 
     and convert every sentence in the dataset into list of ids
     
     Args:
         vocabulary_size: maximum number words in the vocabulary
+        processes: number of worker processes used for preprocessing (number of cpus if None)
+        incremental: only tokenize the new or modified reviews and append them to a single corpus
+            (see update_corpus, the data is then read with read_data(incremental=True))
     """
     print("Downloading data from " + _DATA_DIR_ +"..")
     getData(_DATA_DIR_)
     print("Creating Vocabulary..")
-    create_vocabulary( _VOCAB_DIR_, _TRAIN_DIRS_, vocabulary_size )
+    create_vocabulary( _VOCAB_DIR_, _TRAIN_DIRS_, vocabulary_size, processes=processes )
+    if incremental:
+        print("Updating the corpus..")
+        update_corpus( _TRAIN_DIRS_, _TEST_DIRS_, _CORPUS_DIR_, _VOCAB_DIR_, processes=processes )
+        print("Computing sentiment features..")
+        create_sentiment_features(_CORPUS_DIR_, processes=processes, append=True)
+        return
     print("Converting sentences to sequences of ids..")
-    data_to_token_ids( _TRAIN_DIRS_ , _SENTENCES_DIR, _VOCAB_DIR_ )
-    data_to_token_ids( _TEST_DIRS_ , _TEST_SENTENCES_DIR, _VOCAB_DIR_ )
+    data_to_token_ids( _TRAIN_DIRS_ , _SENTENCES_DIR, _VOCAB_DIR_, processes=processes )
+    data_to_token_ids( _TEST_DIRS_ , _TEST_SENTENCES_DIR, _VOCAB_DIR_, processes=processes )
     print("Moving some line from test set to train set..")
     moveLinesFromFileToFile(_TEST_SENTENCES_DIR+"sentences.txt", _SENTENCES_DIR+"sentences.txt", TEST_SET_LENGTH)
+    print("Writing binary corpus..")
+    create_binary_corpus(_SENTENCES_DIR)
+    create_binary_corpus(_TEST_SENTENCES_DIR)
+    print("Computing sentiment features..")
+    create_sentiment_features(_SENTENCES_DIR, processes=processes)
+    create_sentiment_features(_TEST_SENTENCES_DIR, processes=processes)
     
 
-def read_data(max_size=None, max_sentence_size=None, min_sentence_size=10, test=False):
-    """Read data from source.
+def token_dtype(max_id):
+    """
+    smallest numpy dtype able to store the token ids
+    Args:
+        max_id: largest token id in the corpus
+    Returns:
+        numpy dtype (uint8, int16 or int32)
+    """
+    if max_id < 2**8:
+        return np.uint8
+    elif max_id < 2**15:
+        return np.int16
+    return np.int32
+
+def binary_corpus_is_valid(path):
+    """
+    check if the binary corpus in path exists and is up to date with sentences.txt
+    Args:
+        path: directory containing sentences.txt
+    Returns:
+        True if the binary corpus can be used else False
+    """
+    for f in _BINARY_CORPUS_FILES_:
+        if not os.path.exists(path + f):
+            return False
+    if os.path.exists(path + "sentences.txt"):
+        source_time = os.path.getmtime(path + "sentences.txt")
+        return all( os.path.getmtime(path + f) >= source_time for f in _BINARY_CORPUS_FILES_ )
+    return True
+
+def create_binary_corpus(path, force=False):
+    """
+    Convert sentences.txt into a compact binary corpus, unless an up to date one already exists:
+        tokens.npy: flat array of all token ids
+        offsets.npy: index of the first token of each sentence in tokens.npy
+        lengths.npy: length of each sentence
+        ratings.npy: rating of each sentence
+    The arrays are stored with np.save so that read_data can memory-map them.
+    Args:
+        path: directory containing sentences.txt, the binary corpus is written in the same directory
+        force: rebuild the binary corpus even if it is up to date
+    """
+    if binary_corpus_is_valid(path) and not force:
+        print("Binary corpus already created in %s" % path)
+        return
+    tokens = array('i')
+    lengths = array('i')
+    ratings = array('b')
+    with tf.gfile.GFile(path + 'sentences.txt', mode="r") as source_file:
+        for source in source_file:
+            rating, ids = source.split('|')
+            source_ids = [int(x) for x in ids.split()]
+            tokens.extend(source_ids)
+            lengths.append(len(source_ids))
+            ratings.append(int(rating))
+    tokens = np.frombuffer(tokens, dtype=np.int32) if len(tokens) else np.zeros(0, dtype=np.int32)
+    lengths = np.array(lengths, dtype=np.int32)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    if len(lengths):
+        offsets[1:] = np.cumsum(lengths[:-1], dtype=np.int64)
+    max_id = int(tokens.max()) if len(tokens) else 0
+    np.save(path + _TOKENS_FILE_, tokens.astype(token_dtype(max_id)))
+    np.save(path + _OFFSETS_FILE_, offsets)
+    np.save(path + _LENGTHS_FILE_, lengths)
+    np.save(path + _RATINGS_FILE_, np.array(ratings, dtype=np.int8))
+    
+
+encoderDecoder = None
+def _sentiment_worker_init():
+    """
+    load the vocabulary in a worker process
+    """
+    global encoderDecoder
+    encoderDecoder = EncoderDecoder()
+
+def _sentiment_chunk(args):
+    """
+    compute the sentiment features of the sentences [start, end) of the binary corpus in path
+    """
+    path, start, end = args
+    tokens = np.load(path + _TOKENS_FILE_, mmap_mode='r')
+    offsets = np.load(path + _OFFSETS_FILE_, mmap_mode='r')
+    lengths = np.load(path + _LENGTHS_FILE_, mmap_mode='r')
+    return sentiment_features(encoderDecoder, [ tokens[offsets[i] : offsets[i] + lengths[i]] for i in range(start, end) ])
+
+def sentiment_features_are_valid(path, append=False):
+    """
+    check if sentiments.npy exists in path and is up to date with the binary corpus
+    Args:
+        path: directory containing the binary corpus
+        append: the corpus is append-only (see update_corpus), the features are valid if there is one row per sentence
+    Returns:
+        True if the sentiment features can be used else False
+    """
+    target = path + _SENTIMENTS_FILE_
+    if not os.path.exists(target) or not os.path.exists(path + _LENGTHS_FILE_):
+        return False
+    if len(np.load(target, mmap_mode='r')) != len(np.load(path + _LENGTHS_FILE_, mmap_mode='r')):
+        return False
+    return append or os.path.getmtime(target) >= os.path.getmtime(path + _LENGTHS_FILE_)
+
+def create_sentiment_features(path, processes=None, force=False, append=False):
+    """
+    Compute the VADER sentiment features (negative, neutral, positive) of every sentence in the binary corpus
+    and save them in sentiments.npy (float32, n_sentences x 3), unless an up to date file already exists.
+    Sentences are decoded with EncoderDecoder.prettyDecode as during training. The work is split in chunks
+    processed in parallel.
+    Args:
+        path: directory containing the binary corpus
+        processes: number of worker processes (number of cpus if None)
+        force: recompute the features even if they are up to date
+        append: the corpus is append-only (see update_corpus), only compute the features of the new sentences
+    """
+    target = path + _SENTIMENTS_FILE_
+    n = len(np.load(path + _LENGTHS_FILE_, mmap_mode='r'))
+    previous = np.zeros((0, 3), dtype=np.float32)
+    if not force and sentiment_features_are_valid(path, append):
+        print("Sentiment features already computed in %s" % path)
+        return
+    if not force and append and os.path.exists(target):
+        previous = np.load(target)
+        if len(previous) > n:
+            previous = np.zeros((0, 3), dtype=np.float32)
+    chunks = [ (path, start, min(start + SENTIMENT_CHUNK_SIZE, n)) for start in range(len(previous), n, SENTIMENT_CHUNK_SIZE) ]
+    pool = multiprocessing.Pool(processes, initializer=_sentiment_worker_init)
+    try:
+        sentiments = list(tqdm(pool.imap(_sentiment_chunk, chunks), total=len(chunks)))
+    finally:
+        pool.close()
+        pool.join()
+    # replaced atomically: the file may be read by other processes (see read_data)
+    save_arrays(path, {_SENTIMENTS_FILE_: np.concatenate([previous] + sentiments)})
+
+def file_hash(path):
+    """
+    md5 of the content of a file
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+def load_manifest(path):
+    """
+    load the manifest of an incremental corpus (an empty manifest if it does not exist)
+    """
+    if not os.path.exists(path + _MANIFEST_FILE_):
+        return {'vocabulary': None, 'files': {}}
+    with open(path + _MANIFEST_FILE_, 'r') as fp:
+        return json.load(fp)
+
+def save_manifest(path, manifest):
+    """
+    write the manifest of an incremental corpus atomically
+    """
+    with open(path + _MANIFEST_FILE_ + '.tmp', 'w') as fp:
+        json.dump(manifest, fp)
+    os.rename(path + _MANIFEST_FILE_ + '.tmp', path + _MANIFEST_FILE_)
+
+def save_arrays(path, arrays):
+    """
+    save numpy arrays (file name -> array) in path, each file is replaced atomically. All the arrays are written
+    to temporary files before the first one is renamed
+    """
+    # np.save adds the extension .npy to names which do not end with it
+    tmp_files = dict( (name, path + name[:-len('.npy')] + '.tmp.npy') for name in arrays )
+    for name, a in arrays.items():
+        np.save(tmp_files[name], a)
+    for name in arrays:
+        os.rename(tmp_files[name], path + name)
+
+def repair_corpus(path, manifest):
+    """
+    truncate the arrays of an incremental corpus to the sentences recorded in the manifest: the arrays of an interrupted
+    update (written before the manifest) may contain sentences of files which are not in the manifest
+    """
+    if 'n_sentences' not in manifest:
+        return
+    sizes = dict( (name, manifest['n_sentences']) for name in [_OFFSETS_FILE_, _LENGTHS_FILE_, _RATINGS_FILE_, _SPLIT_FILE_, _SENTIMENTS_FILE_] )
+    sizes[_TOKENS_FILE_] = manifest['n_tokens']
+    arrays = {}
+    for name, size in sizes.items():
+        if os.path.exists(path + name):
+            a = np.load(path + name, mmap_mode='r')
+            if len(a) > size:
+                arrays[name] = np.array(a[:size])
+    if arrays:
+        print("Interrupted update, truncating %s in %s" % (", ".join(sorted(arrays)), path))
+        save_arrays(path, arrays)
+
+def update_corpus(train_dirs, test_dirs, path, vocabulary_path, test_set_length=TEST_SET_LENGTH,
+                  tokenizer=None, normalize_digits=True, processes=None):
+    """
+    Incremental version of data_to_token_ids + moveLinesFromFileToFile + create_binary_corpus.
+    A manifest records the hash of each review file and the sentences it produced in a single binary corpus
+    (same files as create_binary_corpus). Only new or modified files are tokenized: their sentences are appended
+    to the corpus, the sentences of modified or deleted files are marked as removed. The split is stored in
+    split.npy (TRAIN_SPLIT, TEST_SPLIT or REMOVED_SPLIT for each sentence): the first test_set_length sentences
+    of the test files are the test set, the other sentences are the training set, as with prepare_data.
+    The vocabulary is not updated since the ids of the corpus (and the models) depend on it: if vocabulary_path
+    changes, the corpus is rebuilt.
+    Args:
+        train_dirs: directories of the training reviews
+        test_dirs: directories of the test reviews
+        path: directory of the corpus
+        vocabulary_path: path to the vocabulary file
+        test_set_length: number of sentences of the test set
+        tokenizer, normalize_digits, processes: see data_to_token_ids
+    Returns:
+        the number of sentences added to the corpus
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    manifest = load_manifest(path)
+    vocabulary_hash = file_hash(vocabulary_path)
+    if manifest['vocabulary'] != vocabulary_hash or not os.path.exists(path + _SPLIT_FILE_):
+        if manifest['files']:
+            print("Vocabulary changed, rebuilding the corpus in %s" % path)
+        # the empty manifest is written first, so that an interrupted rebuild is redone from an empty corpus
+        manifest = {'vocabulary': vocabulary_hash, 'files': {}, 'n_sentences': 0, 'n_tokens': 0}
+        save_manifest(path, manifest)
+        if os.path.exists(path + _SENTIMENTS_FILE_):
+            os.remove(path + _SENTIMENTS_FILE_)
+        save_arrays(path, {_TOKENS_FILE_: np.zeros(0, dtype=np.uint8), _OFFSETS_FILE_: np.zeros(0, dtype=np.int64),
+                           _LENGTHS_FILE_: np.zeros(0, dtype=np.int32), _RATINGS_FILE_: np.zeros(0, dtype=np.int8),
+                           _SPLIT_FILE_: np.zeros(0, dtype=np.int8)})
+    repair_corpus(path, manifest)
+    files = manifest['files']
+    split = np.load(path + _SPLIT_FILE_)
+    # find the new and modified files
+    current = [ (f, False) for f in list_files(train_dirs) ] + [ (f, True) for f in list_files(test_dirs) ]
+    updated = []
+    for f, test in current:
+        stat = os.stat(f)
+        entry = files.get(f)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            continue
+        md5 = file_hash(f)
+        if entry is not None and entry['md5'] == md5:
+            entry['mtime'] = stat.st_mtime
+            continue
+        updated.append((f, test, {'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': md5}))
+    # sentences of modified and deleted files are removed
+    current_files = set( f for f, _ in current )
+    removed = [ f for f in files if f not in current_files ] + [ f for f, _, _ in updated if f in files ]
+    for f in removed:
+        split[files[f]['start'] : files[f]['start'] + files[f]['count']] = REMOVED_SPLIT
+        del files[f]
+    print("%d new or modified files, %d files in the corpus" % (len(updated), len(files)))
+    if not updated and not removed:
+        # the corpus is up to date: the arrays are not rewritten (their modification time stays the same)
+        manifest.setdefault('n_sentences', len(split))
+        manifest.setdefault('n_tokens', len(np.load(path + _TOKENS_FILE_, mmap_mode='r')))
+        save_manifest(path, manifest)
+        return 0
+    # tokenize the new files
+    jobs = [ (f, tokenizer, normalize_digits) for f, _, _ in updated ]
+    tokens, lengths, ratings, new_split = array('i'), array('i'), array('b'), array('b')
+    n_sentences = len(split)
+    n_test = int((split == TEST_SPLIT).sum())
+    pool = multiprocessing.Pool(processes, initializer=_tokenizer_worker_init, initargs=(vocabulary_path,))
+    try:
+        for k, lines in enumerate(tqdm(pool.imap(file_to_token_lines, jobs, chunksize=16), total=len(jobs))):
+            f, test, entry = updated[k]
+            entry['start'] = n_sentences + len(lengths)
+            entry['count'] = len(lines)
+            for line in lines:
+                rating, ids = line.split('|')
+                source_ids = [int(x) for x in ids.split()]
+                tokens.extend(source_ids)
+                lengths.append(len(source_ids))
+                ratings.append(int(rating))
+                if test and n_test < test_set_length:
+                    new_split.append(TEST_SPLIT)
+                    n_test += 1
+                else:
+                    new_split.append(TRAIN_SPLIT)
+            files[f] = entry
+    finally:
+        pool.close()
+        pool.join()
+    # append to the binary corpus
+    old_tokens = np.load(path + _TOKENS_FILE_, mmap_mode='r')
+    old_lengths = np.load(path + _LENGTHS_FILE_, mmap_mode='r')
+    tokens = np.frombuffer(tokens, dtype=np.int32) if len(tokens) else np.zeros(0, dtype=np.int32)
+    lengths = np.array(lengths, dtype=np.int32)
+    offsets = np.zeros(len(lengths), dtype=np.int64)
+    if len(lengths):
+        offsets[1:] = np.cumsum(lengths[:-1], dtype=np.int64)
+    offsets += len(old_tokens)
+    max_id = max(int(tokens.max()) if len(tokens) else 0, int(old_tokens.max()) if len(old_tokens) else 0)
+    save_arrays(path, {_TOKENS_FILE_: np.concatenate([old_tokens, tokens]).astype(token_dtype(max_id)),
+                       _OFFSETS_FILE_: np.concatenate([np.load(path + _OFFSETS_FILE_, mmap_mode='r'), offsets]),
+                       _LENGTHS_FILE_: np.concatenate([old_lengths, lengths]),
+                       _RATINGS_FILE_: np.concatenate([np.load(path + _RATINGS_FILE_, mmap_mode='r'), np.array(ratings, dtype=np.int8)]),
+                       _SPLIT_FILE_: np.concatenate([split, np.array(new_split, dtype=np.int8)])})
+    # the manifest is written last with the size of the corpus: an interrupted update is redone
+    # after truncating the arrays (see repair_corpus)
+    manifest['n_sentences'] = len(old_lengths) + len(lengths)
+    manifest['n_tokens'] = len(old_tokens) + len(tokens)
+    save_manifest(path, manifest)
+    print("%d sentences added to the corpus" % len(lengths))
+    return len(lengths)
+
+class Corpus:
+    """
+    A read-only view over a memory-mapped binary corpus. Sentences are stored in a flat token array and
+    located using offsets and lengths. Only the selected sentences are exposed.
+    """
+    def __init__(self, tokens, offsets, lengths, index=None):
+        """
+        Args:
+            tokens (numpy array): flat array of token ids
+            offsets (numpy array): index of the first token of each sentence
+            lengths (numpy array): length of each sentence
+            index (numpy array): indexes of the selected sentences (all sentences if None)
+        """
+        if index is None:
+            index = np.arange(len(lengths))
+        self.tokens = tokens
+        self.offsets = offsets[index]
+        self.lengths = lengths[index]
+        self.index = index
+        
+    def __len__(self):
+        return len(self.index)
+    
+    def __getitem__(self, i):
+        """
+        return sentence i as a list of ids
+        """
+        start = self.offsets[i]
+        return self.tokens[start : start + self.lengths[i]].tolist()
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+def read_data(max_size=None, max_sentence_size=None, min_sentence_size=10, test=False, sentiments=False, incremental=False):
+    """Read data from the binary corpus (created from sentences.txt if needed).
     Args:
         max_size: maximum number of lines to read, all other will be ignored;
       if 0 or None, data files will be read completely (no limit).
         max_sentence_size: maximum size of sentences
         min_sentence_size: minimum sentence length
         test_set (boolean): use test dataset of note
+        sentiments (boolean): also return the sentiment features precomputed by prepare_data (ValueError if they are missing or out of date)
+        incremental (boolean): read the corpus created by update_corpus (prepare_data(incremental=True))
     Returns:
-        data_set: training data
+        a tuple sentences, ratings (, sentiments)
+            sentences: a Corpus object (sequence of lists of ids)
+            ratings: numpy array of the corresponding ratings
+            sentiments: numpy array of the corresponding sentiment features (n_sentences x 3)
     """
-    sentences = []
-    ratings = []
     PATH = _SENTENCES_DIR
-    if test:
+    if incremental:
+        PATH = _CORPUS_DIR_
+        repair_corpus(PATH, load_manifest(PATH))
+    elif test:
         PATH = _TEST_SENTENCES_DIR
-    with tf.gfile.GFile(PATH +'sentences.txt', mode="r") as source_file:
-        source = source_file.readline()
-        counter = 0
-        while source and (not max_size or counter < max_size):
-            rating = int(source.split('|')[0])
-            source_ids = [int(x) for x in source.split('|')[1].split()]
-            if len(source_ids) < max_sentence_size and len(source_ids) > min_sentence_size:
-                sentences.append(source_ids)
-                ratings.append(rating)
-                counter += 1
-                if counter % 10000 == 0 and counter != 0:
-                    print("  reading data line %d" % counter)
-                    sys.stdout.flush()
-            source = source_file.readline()
-        return sentences,ratings
+    create_binary_corpus(PATH)
+    tokens = np.load(PATH + _TOKENS_FILE_, mmap_mode='r')
+    offsets = np.load(PATH + _OFFSETS_FILE_, mmap_mode='r')
+    lengths = np.load(PATH + _LENGTHS_FILE_, mmap_mode='r')
+    ratings = np.load(PATH + _RATINGS_FILE_, mmap_mode='r')
+    mask = lengths > min_sentence_size
+    if incremental:
+        mask &= np.load(PATH + _SPLIT_FILE_, mmap_mode='r') == (TEST_SPLIT if test else TRAIN_SPLIT)
+    if max_sentence_size:
+        mask &= lengths < max_sentence_size
+    index = np.flatnonzero(mask)
+    if max_size:
+        index = index[:max_size]
+    if sentiments:
+        # computed once by prepare_data, the features are only loaded here
+        if not sentiment_features_are_valid(PATH, append=incremental):
+            raise ValueError("Sentiment features missing or out of date in %s, run prepare_data first" % PATH)
+        sentiment_features = np.load(PATH + _SENTIMENTS_FILE_, mmap_mode='r')
+        return Corpus(tokens, offsets, lengths, index), np.asarray(ratings[index], dtype=np.int32), np.asarray(sentiment_features[index])
+    return Corpus(tokens, offsets, lengths, index), np.asarray(ratings[index], dtype=np.int32)
     
 class EncoderDecoder:
     """
-    A class to encode text to a sequence of ids or to decode a sequence of ids to text
+    A class to encode text to a sequence of ids or to decode a sequence of ids to text.
+    Characters are encoded with a lookup table over the 256 byte values, and ids are decoded with
+    arrays of symbols indexed by id.
     """
     def __init__(self):
         """
         Load vocabulary
         """
         self.vocab,self.rev_vocab = initialize_vocabulary(_VOCAB_DIR_)
+        # id of each byte, digits are normalized as in sentence_to_token_ids
+        self.byte_ids = np.array([ self.vocab.get(_DIGIT_RE.sub(b"0", int2byte(b)), UNK_ID) for b in range(256) ], dtype=np.int32)
+        self.symbols = np.array(self.rev_vocab, dtype=object)
+        # symbols of prettyDecode: special symbols are removed and "_" is a space (the vocabulary is lowercase
+        # so the special symbols can not be formed by several characters)
+        pretty = dict( (symbol, b"") for symbol in [_GO, _EOS, _PAD] )
+        self.pretty_symbols = np.array([ pretty.get(symbol, symbol.replace(b"_", b" ")) for symbol in self.rev_vocab ], dtype=object)
+        self.space_symbol = self.encode("I am")[1]
         
     def encode(self, sentence):
         """
         Encode a sentence to a sequence of ids
         """
-        return sentence_to_token_ids(sentence, self.vocab)
+        return self.encodeBatch([sentence])[0]
+    
+    def encodeBatch(self, sentences):
+        """
+        Encode a list of sentences to sequences of ids (same output as sentence_to_token_ids), with a single lookup
+        """
+        strings = [ character_string(sentence) for sentence in sentences ]
+        if not all( isinstance(s, bytes) for s in strings ):
+            return [ sentence_to_token_ids(sentence, self.vocab) for sentence in sentences ]
+        ids = self.byte_ids.take(np.frombuffer(b"".join(strings), dtype=np.uint8)).tolist()
+        seqs = []
+        start = 0
+        for s in strings:
+            seqs.append([GO_ID] + ids[start : start + len(s)] + [EOS_ID])
+            start += len(s)
+        return seqs
     
     def encodeForTraining(self,sentence):
         """
@@ -388,8 +890,7 @@ class EncoderDecoder:
         """
         seq_ids = self.encode(sentence)
         seq_len = len(seq_ids)
-        space_symbol = self.encode("I am")[1]
-        word_delimiters = [ EOS_ID, GO_ID, space_symbol ]
+        word_delimiters = [ EOS_ID, GO_ID, self.space_symbol ]
         words_endings = [i for i, j in enumerate(seq_ids) if j in word_delimiters]
         words_endings = [ [0,x] for x in words_endings ]
         seq_words_len = len(words_endings)
@@ -399,25 +900,30 @@ class EncoderDecoder:
         """
         Decode a sequence of ids to a sentence
         """
-        return [ self.rev_vocab[int(el)] for el in seq ]
+        return self.symbols.take(np.asarray(seq, dtype=np.int64)).tolist()
     
     def prettyDecode(self,seq):
         """
         decode and return a nicely formatted string
         """
-        s = "".join(self.decode(seq))
-        s = s.replace("_GO", "" )
-        s = s.replace("_EOS", "" )
-        s = s.replace("_PAD", "" )
-        s = s.replace("_", " " )
-        s = s.replace(" ,", "," )
-        s = s.replace(" .", "." )
-        s = s.replace(" !", "!" )
-        s = s.replace(" ?", "?" )
-        s = s.replace(" '", "'" )
-        for u in ['.','?','!']:
-            if u in s:
-                s = s.split(u)[0]+u
+        return self._prettify("".join(self.pretty_symbols.take(np.asarray(seq, dtype=np.int64))))
+    
+    def prettyDecodeBatch(self, seqs):
+        """
+        prettyDecode a batch of sequences (2D array or list of sequences of different lengths)
+        """
+        if isinstance(seqs, np.ndarray) and seqs.ndim == 2:
+            return [ self._prettify("".join(row)) for row in self.pretty_symbols.take(seqs.astype(np.int64)) ]
+        return [ self.prettyDecode(seq) for seq in seqs ]
+    
+    def _prettify(self, s):
+        """
+        remove the spaces before punctuation and cut after the end of the first sentence
+        """
+        s = pretty_punctuation_pattern.sub(r"\1", s)
+        end = pretty_end_pattern.search(s)
+        if end is not None:
+            s = s[:end.end()]
         return s
     
     def vocabularySize(self):
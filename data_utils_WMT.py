@@ -23,6 +23,9 @@ import os
 import re
 import tarfile
 import sys
+import multiprocessing
+from itertools import islice
+from collections import Counter, deque
 from tqdm import tqdm
 import spacy
 from bs4 import BeautifulSoup
@@ -55,6 +58,8 @@ _DATA_DIR_ = 'data_WMT/'
 _RAW_SENTENCES_DIR_ = _DATA_DIR_ + 'raw_sentences/'
 _SENTENCES_DIR = _DATA_DIR_ + 'sentences/'
 _VOCAB_DIR_ = _DATA_DIR_+'vocab.dat'
+# number of lines processed by a worker process at once
+CHUNK_LINES = 10000
 
 nlp = spacy.load('en')
 character_pattern = re.compile('([^\s\w\'\.\!\,\?]|_)+')
@@ -132,36 +137,86 @@ def getData(directory):
     else:
         print("Data already downloaded.")
 
+def read_chunks(file_path, chunk_lines=CHUNK_LINES):
+    """
+    read a file by chunks of lines
+    Args:
+        file_path: path of the file
+        chunk_lines: number of lines per chunk
+    Returns:
+        a generator of lists of lines
+    """
+    with gfile.GFile(file_path, mode="rb") as f:
+        while True:
+            chunk = list(islice(f, chunk_lines))
+            if not chunk:
+                return
+            yield chunk
+
+def bounded_imap(pool, func, iterable, max_pending):
+    """
+    ordered equivalent of pool.imap which consumes the input iterable lazily:
+    at most max_pending tasks are submitted to the pool at the same time
+    Args:
+        pool: multiprocessing pool
+        func: function applied to each element
+        iterable: input elements
+        max_pending: maximum number of tasks in progress
+    Returns:
+        a generator of results, in the order of the inputs
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def count_tokens(args):
+    """
+    count the tokens of a chunk of lines (used by create_vocabulary in worker processes)
+    Args:
+        args: a tuple (list of lines, tokenizer, normalize_digits)
+    Returns:
+        a Counter token -> number of occurences
+    """
+    lines, tokenizer, normalize_digits = args
+    text = b"".join(lines)
+    tokens = tokenizer(text) if tokenizer else character_tokenizer(text)
+    return Counter( _DIGIT_RE.sub(b"0", w) if normalize_digits else w for w in tokens )
+
 def create_vocabulary(vocabulary_path, data_paths, max_vocabulary_size,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True, processes=None):
     """Create vocabulary file (if it does not exist yet) from data file.
       Data files are supposed to be a list of files with the list of directories. Each sentence is
       tokenized and digits are normalized (if normalize_digits is set).
       Vocabulary contains the most-frequent tokens up to max_vocabulary_size.
       We write it to vocabulary_path in a one-token-per-line format, so that later
       token in the first line gets id=0, second line gets id=1, and so on.
+      Chunks of lines are processed in parallel and the counts are merged in order.
       Args:
         vocabulary_path: path where the vocabulary will be created.
         data_path: data file that will be used to create vocabulary.
         max_vocabulary_size: limit on the size of the created vocabulary.
         tokenizer: a function to use to tokenize each data sentence;
-          if None, basic_tokenizer will be used.
+          if None, basic_tokenizer will be used. It must be a module level function (sent to worker processes)
         normalize_digits: Boolean; if true, all digits are replaced by 0s.
+        processes: number of worker processes (number of cpus if None)
      """
     if not gfile.Exists(vocabulary_path):
-        vocab = {}
-        files = []
-        files += [data_paths+f for f in os.listdir(data_paths) ]
-        for one_file in files:
-            with gfile.GFile(one_file, mode="rb") as f:
-                review = f.read()
-                tokens = tokenizer(review) if tokenizer else character_tokenizer(review)
-                for w in tqdm(tokens):
-                    word = _DIGIT_RE.sub(b"0", w) if normalize_digits else w
-                    if word in vocab:
-                        vocab[word] += 1
-                    else:
-                        vocab[word] = 1
+        vocab = Counter()
+        files = [data_paths+f for f in sorted(os.listdir(data_paths)) ]
+        pool = multiprocessing.Pool(processes)
+        max_pending = 2 * (processes or multiprocessing.cpu_count())
+        try:
+            for one_file in files:
+                jobs = ( (lines, tokenizer, normalize_digits) for lines in read_chunks(one_file) )
+                for counts in tqdm(bounded_imap(pool, count_tokens, jobs, max_pending)):
+                    vocab.update(counts)
+        finally:
+            pool.close()
+            pool.join()
         vocab_list = _START_VOCAB + sorted(vocab, key=vocab.get, reverse=True)
         if len(vocab_list) > max_vocabulary_size:
             vocab_list = vocab_list[:max_vocabulary_size]
@@ -224,58 +279,106 @@ def sentence_to_token_ids(sentence, vocabulary,
     output += [EOS_ID]
     return output
 
+tokenizerVocabulary = None
+def _tokenizer_worker_init(vocabulary_path):
+    """
+    load the vocabulary in a worker process
+    """
+    global tokenizerVocabulary
+    tokenizerVocabulary, _ = initialize_vocabulary(vocabulary_path)
+
+def lines_to_token_lines(args):
+    """
+    convert a chunk of raw lines into lines of ids (used by data_to_token_ids in worker processes)
+    Args:
+        args: a tuple (list of lines, tokenizer, normalize_digits)
+    Returns:
+        the list of lines to be written in sentences.txt
+    """
+    lines, tokenizer, normalize_digits = args
+    token_lines = []
+    for line in lines:
+        sentence = cleanHTML( line )
+        if len(sentence) > 10: # don't save short sentences
+            while sentence[0] == " ":
+                sentence = sentence[1:]
+            token_ids = sentence_to_token_ids(tf.compat.as_bytes(sentence), tokenizerVocabulary,
+                                        tokenizer, normalize_digits)
+            token_lines.append(" ".join([str(tok) for tok in token_ids]) + "\n")
+    return token_lines
+
 def data_to_token_ids(data_path, target_path, vocabulary_path,
-                      tokenizer=None, normalize_digits=True):
+                      tokenizer=None, normalize_digits=True, processes=None):
     """Tokenize data file and turn into token-ids using given vocabulary file.
       This function loads data line-by-line from data_path, calls the above
       sentence_to_token_ids, and saves the result to target_path. 
       Sentiment scores are added using the file names ([[id]_[rating].txt])
       See comment for sentence_to_token_ids on the details of token-ids format.
+      The file is streamed: chunks of lines are tokenized in parallel and written in order, thus the output
+      does not depend on the number of processes and the memory usage does not depend on the size of the corpus.
       Args:
         data_path: path to the data file in one-sentence-per-line format.
         target_path: path where the file with token-ids will be created.
         vocabulary_path: path to the vocabulary file.
         tokenizer: a function to use to tokenize each sentence;
-          if None, basic_tokenizer will be used.
+          if None, basic_tokenizer will be used. It must be a module level function (sent to worker processes)
         normalize_digits: Boolean; if true, all digits are replaced by 0s.
+        processes: number of worker processes (number of cpus if None)
     """
     if not os.path.exists(target_path):
         os.makedirs(target_path)
     if not gfile.Exists(target_path+"sentences.txt"):
         print("Tokenizing data in %s" % data_path)
-        vocab, _ = initialize_vocabulary(vocabulary_path)
-        files = []
-        #for d in data_path:
-        files += [data_path+f for f in os.listdir(data_path) ]
-        with gfile.GFile(target_path+"sentences.txt" , mode="w") as tokens_file:
-            for one_file in files:
-                with gfile.GFile(one_file, mode="rb") as f:
-                    for line in tqdm(f.readlines()):
-                        sentence = cleanHTML( line )
-                        if len(sentence) > 10: # don't save short sentences
-                            while sentence[0] == " ":
-                                sentence = sentence[1:]
-                            token_ids = sentence_to_token_ids(tf.compat.as_bytes(sentence), vocab,
-                                                        tokenizer, normalize_digits)
-                            tokens_file.write(" ".join([str(tok) for tok in token_ids]) + "\n")
-                            #sentiments_files.write( str(rating) + "\n")
+        files = [data_path+f for f in sorted(os.listdir(data_path)) ]
+        pool = multiprocessing.Pool(processes, initializer=_tokenizer_worker_init, initargs=(vocabulary_path,))
+        max_pending = 2 * (processes or multiprocessing.cpu_count())
+        try:
+            with gfile.GFile(target_path+"sentences.txt" , mode="w") as tokens_file:
+                for one_file in files:
+                    jobs = ( (lines, tokenizer, normalize_digits) for lines in read_chunks(one_file) )
+                    for token_lines in tqdm(bounded_imap(pool, lines_to_token_lines, jobs, max_pending)):
+                        tokens_file.write("".join(token_lines))
+        finally:
+            pool.close()
+            pool.join()
                             
-def prepare_data(vocabulary_size):
+def prepare_data(vocabulary_size, processes=None):
     """
     Download the Large Movie Review Dataset, create the vocabulary 
     and convert every sentence in the dataset into list of ids
     
     Args:
         vocabulary_size: maximum number words in the vocabulary
+        processes: number of worker processes used for preprocessing (number of cpus if None)
     """
     print("Downloading data from " + _DATA_DIR_ +"..")
     getData(_DATA_DIR_)
     print("Creating Vocabulary..")
-    create_vocabulary( _VOCAB_DIR_, _RAW_SENTENCES_DIR_, vocabulary_size )
+    create_vocabulary( _VOCAB_DIR_, _RAW_SENTENCES_DIR_, vocabulary_size, processes=processes )
     print("Converting sentences to sequences of ids..")
-    data_to_token_ids( _RAW_SENTENCES_DIR_ , _SENTENCES_DIR, _VOCAB_DIR_ )
+    data_to_token_ids( _RAW_SENTENCES_DIR_ , _SENTENCES_DIR, _VOCAB_DIR_, processes=processes )
     
 
+def stream_data(max_size=None, max_sentence_size=None, min_sentence_size=10):
+    """Iterate over the tokenized sentences without loading the corpus into memory.
+    Args:
+    max_size: maximum number of sentences to yield, all other will be ignored;
+      if 0 or None, data files will be read completely (no limit).
+    max_sentence_size: maximum size of sentences (no limit if None)
+    min_sentence_size: minimum size of sentences
+    Returns:
+    a generator of lists of ids
+    """
+    counter = 0
+    with tf.gfile.GFile(_SENTENCES_DIR + 'sentences.txt', mode="r") as source_file:
+        for source in source_file:
+            if max_size and counter >= max_size:
+                return
+            source_ids = [int(x) for x in source.split()]
+            if (not max_sentence_size or len(source_ids) < max_sentence_size) and len(source_ids) > min_sentence_size:
+                counter += 1
+                yield source_ids
+
 def read_data(max_size=None, max_sentence_size=None, min_sentence_size=10):
     """Read data from source.
     Args:
@@ -286,21 +389,12 @@ def read_data(max_size=None, max_sentence_size=None, min_sentence_size=10):
     data_set: training data
     """
     sentences = []
-    with tf.gfile.GFile('data_WMT/sentences/sentences.txt', mode="r") as source_file:
-        source = source_file.readline()
-        print (source)
-        counter = 0
-        while source and (not max_size or counter < max_size):
-            source_ids = [int(x) for x in source]
-            if len(source_ids) < max_sentence_size and len(source_ids) > min_sentence_size:
-                sentences.append(source_ids)
-                ratings.append(rating)
-                counter += 1
-                if counter % 10000 == 0 and counter != 0:
-                    print("  reading data line %d" % counter)
-                    sys.stdout.flush()
-            source = source_file.readline()
-        return sentences
+    for source_ids in stream_data(max_size, max_sentence_size, min_sentence_size):
+        sentences.append(source_ids)
+        if len(sentences) % 10000 == 0:
+            print("  reading data line %d" % len(sentences))
+            sys.stdout.flush()
+    return sentences
     
 class EncoderDecoder:
     """
@@ -311,6 +405,7 @@ class EncoderDecoder:
         Load vocabulary
         """
         self.vocab,self.rev_vocab = initialize_vocabulary(_VOCAB_DIR_)
+        self.space_symbol = self.encode("I am")[1]
         
     def encode(self, sentence):
         """
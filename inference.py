@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Export a trained VRAE model as a frozen inference graph and serve encode/decode requests from it
+without rebuilding the training graph (optimizer, summaries).
+
+Usage: python inference.py --training_dir no_char2word --export_dir export/no_char2word
+
+__author__ = "Valentin Lievin, DTU, Denmark"
+__copyright__ = "Copyright 2017, Valentin Lievin"
+__credits__ = ["Valentin Lievin"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Valentin Lievin"
+__email__ = "valentin.lievin@gmail.com"
+__status__ = "Development"
+"""
+
+import os
+import json
+import tensorflow as tf
+from model import encode_batch, decode_batch
+
+_GRAPH_FILE_ = 'frozen_graph.pb'
+_TENSORS_FILE_ = 'tensors.json'
+# inputs and outputs of the inference graph
+INPUT_TENSORS = ['x_input', 'x_input_lenghts', 'end_of_words', 'batch_word_lengths', 'input_keep_prob',
+                 'output_keep_prob', 'batch_size', 'sentiment_feature', 'training', 'z']
+OUTPUT_TENSORS = ['z_mu', 'decoder_output']
+
+
+def export_inference_graph(sess, vrae_model, export_dir, fold_constants=True):
+    """
+    Write a frozen inference graph: variables are converted to constants and only the operations needed to
+    compute z_mu (encoder) and the decoder logits are kept. The names of the input and output tensors are saved
+    in tensors.json.
+    Args:
+        sess: Tensorflow session with the trained variables
+        vrae_model (Vrae): model
+        export_dir (string): output directory
+        fold_constants (boolean): fold constant operations (requires tensorflow.tools.graph_transforms)
+    """
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    tensors = dict( (name, getattr(vrae_model, name).name) for name in INPUT_TENSORS + OUTPUT_TENSORS )
+    output_nodes = [ getattr(vrae_model, name).op.name for name in OUTPUT_TENSORS ]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_nodes)
+    if fold_constants:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        input_nodes = [ getattr(vrae_model, name).op.name for name in INPUT_TENSORS ]
+        graph_def = TransformGraph(graph_def, input_nodes, output_nodes, ['fold_constants(ignore_errors=true)'])
+    with tf.gfile.GFile(os.path.join(export_dir, _GRAPH_FILE_), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(os.path.join(export_dir, _TENSORS_FILE_), 'w') as fp:
+        json.dump(tensors, fp)
+    print("exported %d nodes to %s" % (len(graph_def.node), export_dir))
+
+
+class InferenceModel:
+    """
+    Load a frozen inference graph written by export_inference_graph and encode/decode batches of data.
+    The object exposes the same tensors as Vrae (x_input, z_mu, decoder_output, ...)
+    """
+    def __init__(self, export_dir, config=None):
+        """
+        Args:
+            export_dir (string): directory containing the exported graph
+            config (tf.ConfigProto): session configuration
+        """
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(os.path.join(export_dir, _GRAPH_FILE_), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        with open(os.path.join(export_dir, _TENSORS_FILE_), 'r') as fp:
+            tensors = json.load(fp)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        for name, tensor_name in tensors.items():
+            setattr(self, name, self.graph.get_tensor_by_name(tensor_name))
+        self.sess = tf.Session(graph=self.graph, config=config)
+
+    def encode(self, seqs, sentiments=None, word_delimiters=(), max_batch_size=1000):
+        """
+        Project sequences of ids to the latent space (see Vrae.XTozBatch)
+        Returns:
+            numpy array of z_mu (len(seqs) x latent_dim)
+        """
+        return encode_batch(self.sess, self, seqs, sentiments, word_delimiters, max_batch_size)
+
+    def decode(self, z_samples, s_length, max_batch_size=1000):
+        """
+        Reconstruct sequences from latent variables (see Vrae.zToXBatch)
+        Returns:
+            numpy array of logits (n_samples x s_length x num_symbols)
+        """
+        return decode_batch(self.sess, self, z_samples, s_length, max_batch_size)
+
+    def close(self):
+        """
+        close the session
+        """
+        self.sess.close()
+
+
+if __name__ == "__main__":
+    from data_utils_LMR import EncoderDecoder
+    from model import Vrae as Vrae_model
+
+    tf.app.flags.DEFINE_string("training_dir", "sentiment_input", "repertory where checkpoints are logs are saved")
+    tf.app.flags.DEFINE_string("export_dir", "export", "repertory where the inference graph is written")
+    FLAGS = tf.app.flags.FLAGS
+    training_dir = "logs/" + FLAGS.training_dir
+
+    def string2bool(st):
+        return st.lower() == "true"
+
+    with open(training_dir +'/flags.json', 'r') as fp:
+        training_flags = json.loads( fp.read() )
+    num_symbols = EncoderDecoder().vocabularySize()
+    vrae_model = Vrae_model(char2word_state_size = int(training_flags['char2word_state_size']),
+                            char2word_num_layers = int(training_flags['char2word_num_layers']),
+                            encoder_state_size = int(training_flags['encoder_state_size']),
+                            encoder_num_layers = int(training_flags['encoder_num_layers']),
+                            decoder_state_size = int(training_flags['decoder_state_size']),
+                            decoder_num_layers = int(training_flags['decoder_num_layers']),
+                            latent_dim = int(training_flags['latent_dim']),
+                            batch_size = int(training_flags['batch_size']),
+                            num_symbols = num_symbols,
+                            input_keep_prob = float(training_flags['input_keep_prob']),
+                            output_keep_prob = float(training_flags['output_keep_prob']),
+                            latent_loss_weight = float(training_flags['latent_loss_weight']),
+                            dtype_precision = int(training_flags['dtype_precision']),
+                            cell_type = training_flags['cell'],
+                            peephole = False,
+                            sentiment_feature = string2bool(training_flags['use_sentiment_feature']),
+                            use_char2word = string2bool(training_flags['use_char2word']),
+                            embedding_dim = int(training_flags.get('embedding_dim', 0)))
+    saver = tf.train.Saver()
+    with tf.Session() as sess:
+        saver.restore(sess, tf.train.latest_checkpoint(training_dir))
+        export_inference_graph(sess, vrae_model, FLAGS.export_dir)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+tf.data input pipeline for the VRAE model: batches are padded, bucketed, shuffled and prefetched by the
+Tensorflow runtime and read by the model through a feedable iterator (see Vrae dataset_input) instead of feed_dict.
+
+__author__ = "Valentin Lievin, DTU, Denmark"
+__copyright__ = "Copyright 2017, Valentin Lievin"
+__credits__ = ["Valentin Lievin"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Valentin Lievin"
+__email__ = "valentin.lievin@gmail.com"
+__status__ = "Development"
+"""
+
+import numpy as np
+import tensorflow as tf
+from batch import delimiter_ids
+
+# structure of a batch: x_input, x_input_lenghts, weights_input, end_of_words, batch_word_lengths, sentiment_feature
+BATCH_TYPES = (tf.int32, tf.int32, tf.int32, tf.int32, tf.int32, tf.float32)
+BATCH_SHAPES = (tf.TensorShape([None, None]), tf.TensorShape([None]), tf.TensorShape([None, None]),
+                tf.TensorShape([None, None, 2]), tf.TensorShape([None]), tf.TensorShape([None, 3]))
+
+
+def feedable_iterator(handle):
+    """
+    Create an iterator over batches from a string handle (see DatasetInput.initialize)
+    Args:
+        handle (Tensor): string placeholder
+    Returns:
+        tf.data.Iterator
+    """
+    return tf.data.Iterator.from_string_handle(handle, BATCH_TYPES, BATCH_SHAPES)
+
+
+class DatasetInput:
+    """
+    A tf.data pipeline over a Corpus (see data_utils_LMR.read_data). The corpus is copied once into local variables
+    (see load), then each epoch only feeds the shuffling seed and sentences are sliced, padded and batched in the graph.
+    """
+    def __init__(self, batch_size, word_delimiters, shuffle_buffer=None, bucket_width=0, prefetch=4, num_parallel_calls=None, num_shards=1, shard_index=0):
+        """
+        Build the pipeline in the current graph (after the model since Vrae resets the default graph)
+        Args:
+            batch_size (Natural Integer): number of sentences per batch
+            word_delimiters (list of Natural Integer): list of the symbols corresponding to spaces in the vocabulary
+            shuffle_buffer (Natural Integer): size of the shuffle buffer (None: the whole corpus, 0: no shuffling)
+            bucket_width (Natural Integer): batch together sentences which lengths are in the same bucket of this width (0: no bucketing)
+            prefetch (Natural Integer): number of batches prepared in advance
+            num_parallel_calls (Natural Integer): number of sentences processed in parallel
+            num_shards (Natural Integer): number of workers sharing the data (data-parallel training)
+            shard_index (Natural Integer): index of this worker, all the workers must use the same shuffling seed
+        """
+        self.tokens = tf.placeholder(tf.int32, [None], name="dataset_tokens")
+        self.offsets = tf.placeholder(tf.int64, [None], name="dataset_offsets")
+        self.lengths = tf.placeholder(tf.int32, [None], name="dataset_lengths")
+        self.sentiments = tf.placeholder(tf.float32, [None, 3], name="dataset_sentiments")
+        self.seed = tf.placeholder(tf.int64, [], name="dataset_seed")
+        # the corpus is stored in variables which are neither initialized with the model nor saved in the checkpoints,
+        # their size changes when a new corpus is loaded
+        corpus_variables = [tf.Variable(placeholder, trainable=False, collections=[], validate_shape=False, name=name)
+                            for placeholder, name in [(self.tokens, "dataset_tokens_variable"), (self.offsets, "dataset_offsets_variable"),
+                                                      (self.lengths, "dataset_lengths_variable"), (self.sentiments, "dataset_sentiments_variable")]]
+        self.load_op = tf.group(*[variable.initializer for variable in corpus_variables])
+        tokens, offsets, lengths = [tf.reshape(variable.value(), [-1]) for variable in corpus_variables[:3]]
+        sentiments = tf.reshape(corpus_variables[3].value(), [-1, 3])
+        delimiters = tf.constant(delimiter_ids(word_delimiters), dtype=tf.int32)
+
+        def sentence(offset, length, sentiment):
+            ids = tokens[offset : offset + tf.cast(length, tf.int64)]
+            weights = tf.cast(ids > 0, tf.int32)
+            is_delimiter = tf.reduce_any(tf.equal(tf.expand_dims(ids, 1), tf.expand_dims(delimiters, 0)), 1)
+            word_ends = tf.cast(tf.where(is_delimiter)[:, 0], tf.int32)
+            return ids, length, weights, word_ends, tf.size(word_ends), sentiment
+
+        padded_shapes = ([None], [], [None], [None], [], [3])
+        def batch(dataset):
+            return dataset.padded_batch(batch_size, padded_shapes)
+
+        def add_batch_index(ids, lengths, weights, word_ends, word_lengths, sentiments):
+            # end_of_words are indexes (batch_index, position) as in batch.pad_batch
+            batch_index = tf.tile(tf.expand_dims(tf.range(tf.shape(word_ends)[0]), 1), [1, tf.shape(word_ends)[1]])
+            end_of_words = tf.stack([batch_index, word_ends], 2)
+            return ids, lengths, weights, end_of_words, word_lengths, sentiments
+
+        dataset = tf.data.Dataset.from_tensor_slices((offsets, lengths, sentiments))
+        if shuffle_buffer is None:
+            dataset = dataset.shuffle(tf.cast(tf.size(lengths), tf.int64), seed=self.seed)
+        elif shuffle_buffer > 0:
+            dataset = dataset.shuffle(shuffle_buffer, seed=self.seed)
+        if num_shards > 1:
+            dataset = dataset.shard(num_shards, shard_index)
+        dataset = dataset.map(sentence, num_parallel_calls=num_parallel_calls)
+        if bucket_width > 0:
+            dataset = dataset.apply(tf.contrib.data.group_by_window(
+                key_func=lambda ids, length, weights, word_ends, word_length, sentiment: tf.cast(length // bucket_width, tf.int64),
+                reduce_func=lambda key, bucket: batch(bucket),
+                window_size=batch_size))
+        else:
+            dataset = batch(dataset)
+        dataset = dataset.map(add_batch_index).prefetch(prefetch)
+        self.iterator = dataset.make_initializable_iterator()
+        self.handle = self.iterator.string_handle()
+
+    def load(self, sess, corpus, sentiments=None):
+        """
+        Copy the corpus into the graph. Called once, and again when the corpus changes (the next epoch uses the new corpus)
+        Args:
+            sess: current Tensorflow session
+            corpus (data_utils_LMR.Corpus): sentences
+            sentiments (numpy array): sentiment features aligned with the corpus (zeros if None)
+        """
+        if sentiments is None:
+            sentiments = np.zeros((len(corpus), 3), dtype=np.float32)
+        sess.run(self.load_op, feed_dict={self.tokens: np.asarray(corpus.tokens, dtype=np.int32),
+                                          self.offsets: np.asarray(corpus.offsets, dtype=np.int64),
+                                          self.lengths: np.asarray(corpus.lengths, dtype=np.int32),
+                                          self.sentiments: np.asarray(sentiments, dtype=np.float32)})
+
+    def initialize(self, sess, seed=0):
+        """
+        Start a new epoch over the loaded corpus (see load). The model raises tf.errors.OutOfRangeError when the epoch is completed.
+        Args:
+            sess: current Tensorflow session
+            seed (Integer): shuffling seed for this epoch
+        Returns:
+            the iterator handle to feed to the model (see Vrae.dataset_step)
+        """
+        sess.run(self.iterator.initializer, feed_dict={self.seed: seed})
+        return sess.run(self.handle)
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Latent space exploration: interpolations between pairs of sentences (linear or spherical) and shifts along
+attribute directions (e.g. a single latent dimension, or the difference between two sentences). All the points
+are generated as one latent matrix and decoded with a few batched session runs, identical points and
+identical outputs are decoded only once.
+
+Usage:
+    engine = InterpolationEngine(sess, vrae_model, EncoderDecoder(), use_sentiment_feature=vrae_model.use_sentiment_feature)
+    engine.interpolate([("I loved it.", "I hated this film.")], steps=50, length=45, method='spherical')
+    engine.shift(["I like this movie."], dimension_directions([3], latent_dim), np.linspace(-2, 2, 30), length=45)
+
+__author__ = "Valentin Lievin, DTU, Denmark"
+__copyright__ = "Copyright 2017, Valentin Lievin"
+__credits__ = ["Valentin Lievin"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Valentin Lievin"
+__email__ = "valentin.lievin@gmail.com"
+__status__ = "Development"
+"""
+
+import numpy as np
+from model import encode_batch, decode_batch
+from data_utils_LMR import sentiment_features
+
+METHODS = ('linear', 'spherical')
+
+
+def interpolation_paths(z_starts, z_ends, steps, method='linear'):
+    """
+    Points of the paths between pairs of latent vectors
+    Args:
+        z_starts (numpy array): starting points (n_paths x latent_dim)
+        z_ends (numpy array): end points (n_paths x latent_dim)
+        steps (Natural Integer): number of points per path, including both ends
+        method (string): 'linear' or 'spherical' (great circle between the directions, the norm is interpolated linearly)
+    Returns:
+        numpy array of points (n_paths x steps x latent_dim)
+    """
+    assert method in METHODS
+    z_starts = np.atleast_2d(np.asarray(z_starts, dtype=np.float64))
+    z_ends = np.atleast_2d(np.asarray(z_ends, dtype=np.float64))
+    t = np.linspace(0., 1., steps)[None, :, None]
+    linear = (1 - t) * z_starts[:, None, :] + t * z_ends[:, None, :]
+    if method == 'linear':
+        return linear
+    start_norms = np.linalg.norm(z_starts, axis=1)[:, None, None]
+    end_norms = np.linalg.norm(z_ends, axis=1)[:, None, None]
+    cos_omega = (z_starts * z_ends).sum(1)[:, None, None] / np.maximum(start_norms * end_norms, 1e-12)
+    omega = np.arccos(np.clip(cos_omega, -1., 1.))
+    sin_omega = np.sin(omega)
+    # (nearly) colinear vectors: fall back to the linear interpolation
+    colinear = sin_omega < 1e-6
+    sin_omega = np.where(colinear, 1., sin_omega)
+    slerp = (np.sin((1 - t) * omega) * z_starts[:, None, :] / np.maximum(start_norms, 1e-12) +
+             np.sin(t * omega) * z_ends[:, None, :] / np.maximum(end_norms, 1e-12)) / sin_omega
+    slerp *= (1 - t) * start_norms + t * end_norms
+    return np.where(colinear, linear, slerp)
+
+def attribute_paths(z, directions, amplitudes):
+    """
+    Points obtained by moving latent vectors along attribute directions: z + amplitude * direction
+    Args:
+        z (numpy array): latent vectors (n x latent_dim)
+        directions (numpy array): directions (n_directions x latent_dim)
+        amplitudes (list of floats): displacements along each direction
+    Returns:
+        numpy array of points (n x n_directions x len(amplitudes) x latent_dim)
+    """
+    z = np.atleast_2d(z)
+    directions = np.atleast_2d(directions)
+    amplitudes = np.asarray(amplitudes, dtype=np.float64)
+    return z[:, None, None, :] + amplitudes[None, None, :, None] * directions[None, :, None, :]
+
+def dimension_directions(dimensions, latent_dim):
+    """
+    Unit directions along single latent dimensions (dz[k] = 1)
+    Returns:
+        numpy array (len(dimensions) x latent_dim)
+    """
+    return np.eye(latent_dim)[list(dimensions)]
+
+def attribute_direction(z_with, z_without):
+    """
+    Direction of an attribute: difference between the mean latent vectors of sentences with and without it
+    (with a single pair, z_b - z_a is the translation of the analogy a:b :: c:c + z_b - z_a)
+    """
+    return np.mean(np.atleast_2d(z_with), 0) - np.mean(np.atleast_2d(z_without), 0)
+
+def unique_rows(a):
+    """
+    Return the unique rows of a 2D array and the index of the unique row of each row
+    """
+    a = np.ascontiguousarray(a)
+    rows = a.view(np.dtype((np.void, a.dtype.itemsize * a.shape[1]))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return a[first], inverse
+
+def unique_sequence(sentences):
+    """
+    Remove the repeated sentences, keeping the order of the first occurrences
+    """
+    seen = set()
+    return [ s for s in sentences if not (s in seen or seen.add(s)) ]
+
+
+class InterpolationEngine:
+    """
+    Encode sentences and decode batches of latent points with a trained model
+    """
+    def __init__(self, sess, model, encoder_decoder, word_delimiters=(), max_batch_size=1000, use_sentiment_feature=True):
+        """
+        Args:
+            sess: Tensorflow session with the trained variables
+            model: Vrae or inference.InferenceModel
+            encoder_decoder (data_utils_LMR.EncoderDecoder): vocabulary
+            word_delimiters (list of Natural Integers): symbols corresponding to spaces (char2word encoder)
+            max_batch_size (Natural Integer): maximum number of points per session run
+            use_sentiment_feature (boolean): the model uses the sentiment feature (Vrae.use_sentiment_feature), the VADER
+                features of the sentences are computed when they are not given
+        """
+        self.sess = sess
+        self.model = model
+        self.encoder_decoder = encoder_decoder
+        self.word_delimiters = word_delimiters
+        self.max_batch_size = max_batch_size
+        self.use_sentiment_feature = use_sentiment_feature
+
+    def encode(self, sentences, sentiments=None):
+        """
+        Returns:
+            numpy array of z_mu (len(sentences) x latent_dim)
+        """
+        seqs = self.encoder_decoder.encodeBatch(sentences)
+        if sentiments is None and self.use_sentiment_feature:
+            # as for the training corpus
+            sentiments = sentiment_features(self.encoder_decoder, seqs)
+        return encode_batch(self.sess, self.model, seqs, sentiments, self.word_delimiters, self.max_batch_size)
+
+    def decode(self, z_samples, length):
+        """
+        Decode latent points of any shape (... x latent_dim), identical points and identical outputs are decoded once
+        Returns:
+            numpy array of sentences with the shape of z_samples without the last dimension
+        """
+        z_samples = np.asarray(z_samples, dtype=np.float32)
+        shape = z_samples.shape[:-1]
+        unique_z, z_inverse = unique_rows(z_samples.reshape((-1, z_samples.shape[-1])))
+        ids = decode_batch(self.sess, self.model, unique_z, length, self.max_batch_size, ids=True)
+        unique_ids, ids_inverse = unique_rows(ids)
+        sentences = np.array(self.encoder_decoder.prettyDecodeBatch(unique_ids), dtype=object)
+        return sentences[ids_inverse][z_inverse].reshape(shape)
+
+    def interpolate(self, pairs, steps, length, method='linear', sentiments=None, unique=True):
+        """
+        Decode the interpolations between pairs of sentences
+        Args:
+            pairs (list of (string, string)): start and end sentences of each path
+            steps (Natural Integer): number of points per path
+            length (Natural Integer): length of the decoded sequences
+            method (string): 'linear' or 'spherical'
+            sentiments (numpy array): sentiment features of the start and end sentences (n_pairs x 2 x 3)
+            unique (boolean): remove the repeated sentences of each path
+        Returns:
+            list of n_pairs lists of sentences
+        """
+        starts, ends = zip(*pairs)
+        z = self.encode(list(starts) + list(ends), None if sentiments is None else
+                        np.concatenate([ np.asarray(sentiments)[:, 0], np.asarray(sentiments)[:, 1] ]))
+        sentences = self.decode(interpolation_paths(z[:len(pairs)], z[len(pairs):], steps, method), length)
+        return [ unique_sequence(path) if unique else list(path) for path in sentences ]
+
+    def shift(self, sentences, directions, amplitudes, length, sentiments=None, unique=True):
+        """
+        Decode the sentences moved along attribute directions (see dimension_directions and attribute_direction)
+        Args:
+            sentences (list of strings): input sentences
+            directions (numpy array): directions (n_directions x latent_dim)
+            amplitudes (list of floats): displacements along each direction
+            length (Natural Integer): length of the decoded sequences
+            sentiments (numpy array): sentiment features of the sentences
+            unique (boolean): remove the repeated sentences of each path
+        Returns:
+            list (one item per sentence) of lists (one item per direction) of decoded sentences
+        """
+        z = self.encode(sentences, sentiments)
+        decoded = self.decode(attribute_paths(z, directions, amplitudes), length)
+        return [ [ unique_sequence(path) if unique else list(path) for path in paths ] for paths in decoded ]
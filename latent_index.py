@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+Nearest neighbours search in the latent space: the corpus is encoded once (z_mu) into a memory-mapped matrix,
+an inverted file index (IVF: k-means coarse quantizer + exact re-ranking) is built over it in NumPy and
+queried to find the corpus sentences closest to any input text. ExactIndex is the brute-force reference.
+
+Usage:
+    encode = lambda seqs, sentiments: vrae_model.XTozBatch(sess, seqs, sentiments, word_delimiters)
+    vectors = build_latent_store(encode, sentences, "logs/model/z_mu.npy", sentiments=sentiments)
+    index = IVFIndex(vectors, "logs/model/ivf_vectors.npy")
+    search = SimilarSentences(index, sentences, EncoderDecoder(), encode, vrae_model.use_sentiment_feature)
+    search.query("This movie was great.", k=10)
+
+__author__ = "Valentin Lievin, DTU, Denmark"
+__copyright__ = "Copyright 2017, Valentin Lievin"
+__credits__ = ["Valentin Lievin"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Valentin Lievin"
+__email__ = "valentin.lievin@gmail.com"
+__status__ = "Development"
+"""
+
+import numpy as np
+from data_utils_LMR import GO_ID, EOS_ID, sentiment_features
+
+METRICS = ('l2', 'cosine')
+
+
+def build_latent_store(encode, corpus, path, sentiments=None, chunk_size=10000):
+    """
+    Encode a corpus and write the z_mu vectors to a .npy file, chunk by chunk
+    Args:
+        encode (function): seqs, sentiments -> z_mu (e.g. Vrae.XTozBatch or inference.InferenceModel.encode)
+        corpus (sequence of lists of ids): sentences (e.g. data_utils_LMR.Corpus)
+        path (string): output .npy file
+        sentiments (numpy array): sentiment features aligned with the corpus (None if not used by the model)
+        chunk_size (Natural Integer): number of sentences encoded per call
+    Returns:
+        the read-only memory-mapped matrix of z_mu (len(corpus) x latent_dim)
+    """
+    store = None
+    for start in xrange(0, len(corpus), chunk_size):
+        stop = min(start + chunk_size, len(corpus))
+        seqs = [ corpus[i] for i in xrange(start, stop) ]
+        z_mu = encode(seqs, None if sentiments is None else np.asarray(sentiments[start:stop]))
+        if store is None:
+            store = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(len(corpus), z_mu.shape[1]))
+        store[start:stop] = z_mu
+    if store is None:
+        raise ValueError("empty corpus")
+    store.flush()
+    del store
+    return load_latent_store(path)
+
+def load_latent_store(path):
+    """
+    Memory-map a matrix of z_mu written by build_latent_store
+    """
+    return np.load(path, mmap_mode='r')
+
+def prepare_vectors(vectors, metric):
+    """
+    Convert vectors to float32 and normalize them for the cosine metric
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if metric == 'cosine':
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+    return vectors
+
+def pairwise_distances(queries, vectors, vectors_sq_norms, metric):
+    """
+    Distances between queries (n x d) and vectors (m x d): squared euclidean distance or cosine distance
+    (the vectors are normalized by prepare_vectors for the cosine metric)
+    """
+    products = np.dot(queries, vectors.T)
+    if metric == 'cosine':
+        return 1. - products
+    return np.maximum((queries ** 2).sum(1)[:, None] - 2 * products + vectors_sq_norms[None, :], 0.)
+
+def top_k(distances, k):
+    """
+    Return the indexes and values of the k smallest distances of each row, sorted
+    """
+    k = min(k, distances.shape[1])
+    if k < distances.shape[1]:
+        candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(distances.shape[1]), (distances.shape[0], 1))
+    rows = np.arange(len(distances))[:, None]
+    candidate_distances = distances[rows, candidates]
+    order = np.argsort(candidate_distances, axis=1)
+    return candidates[rows, order], candidate_distances[rows, order]
+
+def merge_results(indexes_a, distances_a, indexes_b, distances_b, k):
+    """
+    Merge two sets of sorted nearest neighbours and keep the k nearest
+    """
+    indexes = np.concatenate([indexes_a, indexes_b], 1)
+    distances = np.concatenate([distances_a, distances_b], 1)
+    order, distances = top_k(distances, k)
+    return indexes[np.arange(len(indexes))[:, None], order], distances
+
+def assign(vectors, centroids, chunk_size=10000):
+    """
+    Return the index of the closest centroid (euclidean distance) of each vector, computed by chunks
+    """
+    # the norm of the vector does not change the closest centroid
+    centroids_sq_norms = (centroids ** 2).sum(1)
+    return np.concatenate([ np.argmin(centroids_sq_norms - 2 * np.dot(vectors[start : start + chunk_size], centroids.T), 1)
+                            for start in xrange(0, len(vectors), chunk_size) ]).astype(np.int32)
+
+def kmeans(vectors, n_clusters, n_iterations=10, random_state=np.random):
+    """
+    Lloyd's k-means, empty clusters are re-seeded with random vectors
+    Returns:
+        centroids (n_clusters x d)
+    """
+    centroids = vectors[random_state.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in xrange(n_iterations):
+        assignments = assign(vectors, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.stack([ np.bincount(assignments, weights=vectors[:, d], minlength=n_clusters) for d in xrange(vectors.shape[1]) ], 1)
+        empty = counts == 0
+        centroids[~empty] = (sums[~empty] / counts[~empty, None]).astype(centroids.dtype)
+        centroids[empty] = vectors[random_state.choice(len(vectors), int(empty.sum()), replace=False)]
+    return centroids
+
+def word_delimiters(encoder_decoder):
+    """
+    symbols delimiting the words for the char2word encoder (as in EncoderDecoder.encodeForTraining)
+    """
+    return [ EOS_ID, GO_ID, encoder_decoder.space_symbol ]
+
+def recall_at_k(approximate_indexes, exact_indexes):
+    """
+    Fraction of the exact k nearest neighbours found by an approximate search (both arrays are n_queries x k)
+    """
+    found = [ len(np.intersect1d(a, e)) for a, e in zip(approximate_indexes, exact_indexes) ]
+    return float(np.sum(found)) / np.size(exact_indexes)
+
+
+class ExactIndex(object):
+    """
+    Brute-force nearest neighbours search, the vectors are scanned by chunks so that a memory-mapped matrix
+    is never loaded entirely in memory. Used as the reference for the approximate index.
+    """
+    def __init__(self, vectors, metric='cosine', chunk_size=100000):
+        """
+        Args:
+            vectors (numpy array): z_mu of the corpus (n x latent_dim), may be memory-mapped
+            metric (string): 'l2' or 'cosine'
+            chunk_size (Natural Integer): number of vectors compared to the queries at once
+        """
+        assert metric in METRICS
+        self.vectors = vectors
+        self.metric = metric
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k=10):
+        """
+        Find the k nearest neighbours of each query
+        Args:
+            queries (numpy array): n_queries x latent_dim
+            k (Natural Integer): number of neighbours
+        Returns:
+            a tuple indexes, distances (n_queries x k), sorted by increasing distance
+        """
+        queries = prepare_vectors(np.atleast_2d(queries), self.metric)
+        best_indexes = np.zeros((len(queries), 0), dtype=np.int64)
+        best_distances = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in xrange(0, len(self.vectors), self.chunk_size):
+            chunk = prepare_vectors(self.vectors[start : start + self.chunk_size], self.metric)
+            distances = pairwise_distances(queries, chunk, (chunk ** 2).sum(1), self.metric)
+            indexes, distances = top_k(distances, k)
+            best_indexes, best_distances = merge_results(best_indexes, best_distances, indexes + start, distances, k)
+        return best_indexes, best_distances
+
+
+class IVFIndex(object):
+    """
+    Approximate nearest neighbours search with an inverted file: the vectors are clustered by k-means and
+    stored contiguously by cluster (as the sentences in data_utils_LMR.Corpus: offsets and lengths of each list)
+    in a memory-mapped .npy file. A query only scans the n_probe lists which centroids are the closest,
+    candidates are then ranked exactly.
+    """
+    def __init__(self, vectors, path, n_lists=None, n_probe=8, metric='cosine', train_size=100000, n_iterations=10, seed=0, chunk_size=100000):
+        """
+        Args:
+            vectors (numpy array): z_mu of the corpus (n x latent_dim), may be memory-mapped
+            path (string): .npy file where the vectors ordered by cluster are written
+            n_lists (Natural Integer): number of clusters (default: 4 * sqrt(n))
+            n_probe (Natural Integer): number of clusters scanned per query (recall / latency trade-off)
+            metric (string): 'l2' or 'cosine'
+            train_size (Natural Integer): number of vectors sampled to train the k-means
+            n_iterations (Natural Integer): number of k-means iterations
+            seed (Integer): seed of the k-means initialization and sampling
+            chunk_size (Natural Integer): number of vectors assigned to the clusters and written at once
+        """
+        assert metric in METRICS
+        self.metric = metric
+        self.n_probe = n_probe
+        random_state = np.random.RandomState(seed)
+        n = len(vectors)
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(n))
+        n_lists = max(1, min(n_lists, n))
+        sample = np.sort(random_state.choice(n, min(train_size, n), replace=False))
+        self.centroids = kmeans(prepare_vectors(vectors[sample], metric), n_lists, n_iterations, random_state)
+        assignments = np.concatenate([ assign(prepare_vectors(vectors[start : start + chunk_size], metric), self.centroids)
+                                       for start in xrange(0, n, chunk_size) ])
+        # inverted lists: ids sorted by cluster, with the offset and length of each list
+        self.ids = np.argsort(assignments, kind='mergesort')
+        self.lengths = np.bincount(assignments, minlength=n_lists)
+        self.offsets = np.zeros(n_lists, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(self.lengths[:-1])
+        # the vectors are written by cluster, chunk by chunk, as in build_latent_store
+        store = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, self.centroids.shape[1]))
+        self.sq_norms = np.zeros(n, dtype=np.float32)
+        for start in xrange(0, n, chunk_size):
+            chunk = prepare_vectors(vectors[self.ids[start : start + chunk_size]], metric)
+            store[start : start + len(chunk)] = chunk
+            self.sq_norms[start : start + len(chunk)] = (chunk ** 2).sum(1)
+        store.flush()
+        del store
+        self.vectors_path = path
+        self.vectors = load_latent_store(path)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k=10, n_probe=None):
+        """
+        Find the approximate k nearest neighbours of each query
+        Args:
+            queries (numpy array): n_queries x latent_dim
+            k (Natural Integer): number of neighbours
+            n_probe (Natural Integer): number of clusters scanned (default: the value given to the constructor)
+        Returns:
+            a tuple indexes, distances (n_queries x k), sorted by increasing distance. Missing neighbours
+            (less than k candidates) have index -1 and infinite distance
+        """
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        queries = prepare_vectors(np.atleast_2d(queries), self.metric)
+        probes, _ = top_k(pairwise_distances(queries, self.centroids, (self.centroids ** 2).sum(1), 'l2'), n_probe)
+        indexes = np.full((len(queries), k), -1, dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        for q in xrange(len(queries)):
+            positions = np.concatenate([ np.arange(self.offsets[l], self.offsets[l] + self.lengths[l]) for l in probes[q] ])
+            if len(positions) == 0:
+                continue
+            candidate_distances = pairwise_distances(queries[q:q+1], self.vectors[positions], self.sq_norms[positions], self.metric)
+            best, best_distances = top_k(candidate_distances, k)
+            indexes[q, :best.shape[1]] = self.ids[positions[best[0]]]
+            distances[q, :best.shape[1]] = best_distances[0]
+        return indexes, distances
+
+    def save(self, path):
+        """
+        Save the index to a .npz file, the vectors stay in the .npy file given to the constructor
+        """
+        np.savez(path, centroids=self.centroids, ids=self.ids, lengths=self.lengths, offsets=self.offsets,
+                 sq_norms=self.sq_norms, vectors_path=self.vectors_path, metric=self.metric, n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index written by save
+        """
+        data = np.load(path)
+        index = cls.__new__(cls)
+        for name in ['centroids', 'ids', 'lengths', 'offsets', 'sq_norms']:
+            setattr(index, name, data[name])
+        index.metric = str(data['metric'])
+        index.n_probe = int(data['n_probe'])
+        index.vectors_path = str(data['vectors_path'])
+        index.vectors = load_latent_store(index.vectors_path)
+        return index
+
+
+class SimilarSentences(object):
+    """
+    Find the corpus sentences which latent representations are the closest to the one of an input text
+    """
+    def __init__(self, index, corpus, encoder_decoder, encode, use_sentiment_feature=True):
+        """
+        Args:
+            index (IVFIndex or ExactIndex): index over the z_mu of the corpus
+            corpus (sequence of lists of ids): indexed sentences, aligned with the index
+            encoder_decoder (data_utils_LMR.EncoderDecoder): vocabulary
+            encode (function): seqs, sentiments -> z_mu, the function used to build the index
+            use_sentiment_feature (boolean): the model uses the sentiment feature (Vrae.use_sentiment_feature)
+        """
+        self.index = index
+        self.corpus = corpus
+        self.encoder_decoder = encoder_decoder
+        self.encode = encode
+        self.use_sentiment_feature = use_sentiment_feature
+
+    def query(self, text, k=10, sentiment=None):
+        """
+        Return the k most similar sentences of the corpus
+        Args:
+            text (string or list of strings): input sentence(s)
+            k (Natural Integer): number of sentences
+            sentiment (list): sentiment features of the input(s) (VADER features of the inputs as for the corpus if None)
+        Returns:
+            list of (corpus index, distance, sentence) sorted by distance, or a list of such lists for a list of texts
+        """
+        texts = [text] if isinstance(text, basestring) else text
+        seqs = self.encoder_decoder.encodeBatch(texts)
+        if sentiment is not None:
+            sentiments = np.reshape(sentiment, (len(texts), -1))
+        elif self.use_sentiment_feature:
+            sentiments = sentiment_features(self.encoder_decoder, seqs)
+        else:
+            sentiments = None
+        z_mu = self.encode(seqs, sentiments)
+        indexes, distances = self.index.search(z_mu, k)
+        results = [ [ (int(i), float(d), self.encoder_decoder.prettyDecode(self.corpus[i])) for i, d in zip(row, row_distances) if i >= 0 ]
+                    for row, row_distances in zip(indexes, distances) ]
+        return results[0] if isinstance(text, basestring) else results
@@ -12,6 +12,8 @@ __maintainer__ = "Valentin Lievin"
 __email__ = "valentin.lievin@gmail.com"
 __status__ = "Development"
 """    
+import functools
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.util import nest
 from tensorflow.python.framework import constant_op
@@ -20,6 +22,8 @@ from tensorflow.python.framework import ops
 from tensorflow.python.framework import tensor_shape
 from tensorflow.python.ops import array_ops
 from tensorflow.python.ops import tensor_array_ops
+from batch import pad_batch, delimiter_ids, split_padded_batch
+from input_pipeline import feedable_iterator
 
 
 class Vrae:
@@ -40,7 +44,14 @@ class Vrae:
                  peephole, 
                  sentiment_feature = False,
                  teacher_forcing=True,
-                 use_char2word =False):
+                 use_char2word =False,
+                 embedding_dim=0,
+                 sampled_softmax=0,
+                 dataset_input=False,
+                 device_setter=None,
+                 num_replicas=1,
+                 worker_device=None,
+                 accumulation_steps=1):
         """
         Initi Variational Recurrent Autoencoder (VRAE) for sequences. The model clears the current tf graph and implements this model as the new graph. 
         Args:
@@ -56,101 +67,176 @@ class Vrae:
             input_keep_prob (float): dropout keep probability for the inputs
             output_keep_prob (float): dropout keep probability for the outputs
             latent_loss_weight (float): weight used to weaken the regularization/latent loss
-            dtype_precision (Integer): dtype precision
+            dtype_precision (Integer): dtype precision. 16: mixed precision training, float32 variables and loss with float16 activations and dynamic loss scaling
             cell_type (string): type of cell: LSTM,GRU,LNLSTM
             peephole (boolean): use peepholes or not for LSTM
             sentiment_feature (boolean): input sentiment_feature
-            teacher_forcing (bool): use teacher forcing during training
+            teacher_forcing (bool): use teacher forcing during training. The training loss is then computed by a dynamic_rnn fed with the shifted inputs (see teacher_forced_rnn)
             use_char2word (book): use the char2word layer
+            embedding_dim (Natural Integer): dimension of the symbol embeddings used as inputs of the encoder and the decoder (0: one-hot inputs, compatible with older checkpoints)
+            sampled_softmax (Natural Integer): number of classes sampled by the sampled softmax training loss (0: full softmax). The exact loss is still used for evaluation (reconstruct)
+            dataset_input (bool): read the batches from a feedable tf.data iterator when the inputs are not fed (see input_pipeline and dataset_step)
+            device_setter (function): device function used to place the operations (e.g. tf.train.replica_device_setter for data-parallel training)
+            num_replicas (Natural Integer): number of workers training the model. If larger than 1, the gradients of all the workers
+                are averaged before each update (tf.train.SyncReplicasOptimizer, see sync_optimizer)
+            worker_device (string): device of this worker in data-parallel training (e.g. "/job:worker/task:0"), where the local
+                variables (gradient accumulators) are placed
+            accumulation_steps (Natural Integer): number of micro-batches used for each update. step splits the batch and accumulates the
+                gradients of the micro-batches before one update, the memory used by the activations is the one of a micro-batch
         Returns 
         """
         if dtype_precision==16:
+            # mixed precision (see float32_variable_storage_getter and optimizationOperation)
             dtype = tf.float16
         else:
             dtype = tf.float32
         # clear the default graph
         tf.reset_default_graph()
-        self.batch_size_value = batch_size
-        # placeholders
-        self.use_sentiment_feature = sentiment_feature
-        self.sentiment_feature = tf.placeholder( dtype , [None,3] , name="sentiment_feature")
-        self.batch_size = tf.placeholder( tf.int32 , name='batch_size')
-        self.input_keep_prob_value = input_keep_prob
-        self.output_keep_prob_value = output_keep_prob
-        self.x_input = tf.placeholder( tf.int32, [None, None], name='input_placeholder')
-        self.x_input_lenghts = tf.placeholder(shape=(None,), dtype=tf.int32, name='encoder_inputs_length')
-        self.weights_input = tf.placeholder( tf.int32, [None, None], name='weights_placeholder')
-        self.end_of_words = tf.placeholder( tf.int32, [None, None, 2], name='end_of_words_placeholder')
-        self.batch_word_lengths = tf.placeholder(shape=(None,), dtype=tf.int32, name='encoder_inputs_word_length')
-        self.input_keep_prob = tf.placeholder(dtype,name="input_keep_prob")
-        self.output_keep_prob = tf.placeholder(dtype,name="output_keep_prob")
-        self.max_sentence_size = tf.reduce_max(self.x_input_lenghts )
-        self.training = tf.placeholder( tf.bool, name="training_state")
-        self.teacher_forcing = teacher_forcing
-        with tf.name_scope("training_parameters"):
-            self.B = tf.placeholder(dtype, name='Beta_deterministic_warmup')
-            self.learning_rate = tf.placeholder(dtype, shape=[], name='learning_rate')
-            self.epoch = tf.placeholder(dtype, shape=[], name='epoch')
-        # summaries
-        tf.summary.scalar("Beta", self.B)
-        tf.summary.scalar("learning_rate", self.learning_rate)
-        tf.summary.scalar("epoch", self.epoch)
-        tf.summary.scalar("sentences_max_length", self.max_sentence_size)
-        # prepare the input
-        with tf.name_scope("input_transformations"):
-            inputs_onehot = tf.one_hot(self.x_input, num_symbols, axis= -1, dtype=dtype)   # one hot encoding
-            data_dim = int(inputs_onehot.shape[2])
-            #rnn_inputs = tf.reverse(inputs_onehot, [1])   # reverse input
-            rnn_inputs = inputs_onehot
+        with tf.device(device_setter):
+            self.batch_size_value = batch_size
+            # placeholders
+            if dataset_input:
+                # the inputs default to the next batch of the iterator
+                self.iterator_handle = tf.placeholder(tf.string, shape=[], name="iterator_handle")
+                next_batch = feedable_iterator(self.iterator_handle).get_next()
+                defaults = list(next_batch[:5]) + [tf.cast(next_batch[5], dtype), tf.shape(next_batch[0])[0]]
+            else:
+                self.iterator_handle = None
+                defaults = [None] * 7
+            self.use_sentiment_feature = sentiment_feature
+            self.sentiment_feature = input_placeholder( dtype , [None,3] , name="sentiment_feature", default=defaults[5])
+            self.batch_size = input_placeholder( tf.int32 , None, name='batch_size', default=defaults[6])
+            self.input_keep_prob_value = input_keep_prob
+            self.output_keep_prob_value = output_keep_prob
+            self.x_input = input_placeholder( tf.int32, [None, None], name='input_placeholder', default=defaults[0])
+            self.x_input_lenghts = input_placeholder(tf.int32, (None,), name='encoder_inputs_length', default=defaults[1])
+            self.weights_input = input_placeholder( tf.int32, [None, None], name='weights_placeholder', default=defaults[2])
+            self.end_of_words = input_placeholder( tf.int32, [None, None, 2], name='end_of_words_placeholder', default=defaults[3])
+            self.batch_word_lengths = input_placeholder(tf.int32, (None,), name='encoder_inputs_word_length', default=defaults[4])
+            self.input_keep_prob = tf.placeholder(dtype,name="input_keep_prob")
+            self.output_keep_prob = tf.placeholder(dtype,name="output_keep_prob")
+            self.max_sentence_size = tf.reduce_max(self.x_input_lenghts )
+            # number of sentences, real tokens and padded tokens of the batch (throughput of the tf.data pipeline, see dataset_step)
+            self.batch_statistics = tf.stack([tf.shape(self.x_input)[0], tf.reduce_sum(self.x_input_lenghts), tf.size(self.x_input)])
+            self.training = tf.placeholder( tf.bool, name="training_state")
+            self.teacher_forcing = teacher_forcing
+            with tf.name_scope("training_parameters"):
+                self.B = tf.placeholder(tf.float32, name='Beta_deterministic_warmup')
+                self.learning_rate = tf.placeholder(tf.float32, shape=[], name='learning_rate')
+                self.epoch = tf.placeholder(tf.float32, shape=[], name='epoch')
+            # summaries
+            tf.summary.scalar("Beta", self.B)
+            tf.summary.scalar("learning_rate", self.learning_rate)
+            tf.summary.scalar("epoch", self.epoch)
+            tf.summary.scalar("sentences_max_length", self.max_sentence_size)
+            # mixed precision: float32 master weights, float16 computations
+            custom_getter = float32_variable_storage_getter if dtype == tf.float16 else None
+            with tf.variable_scope(tf.get_variable_scope(), custom_getter=custom_getter):
+                # prepare the input
+                with tf.name_scope("input_transformations"):
+                    data_dim = num_symbols
+                    if embedding_dim > 0:
+                        self.embeddings = tf.get_variable("symbol_embeddings", [num_symbols, embedding_dim], dtype=dtype)
+                        inputs_onehot = tf.nn.embedding_lookup(self.embeddings, self.x_input)   # embedded inputs
+                    else:
+                        self.embeddings = None
+                        inputs_onehot = tf.one_hot(self.x_input, num_symbols, axis= -1, dtype=dtype)   # one hot encoding
+                    #rnn_inputs = tf.reverse(inputs_onehot, [1])   # reverse input
+                    rnn_inputs = inputs_onehot
         
-        # encoder
-        if use_char2word:
-            encoder_output = char2word_encoder(char2word_state_size,
-                                               char2word_num_layers, 
-                                               encoder_state_size, 
-                                               encoder_num_layers,
-                                               rnn_inputs, 
-                                               self.x_input_lenghts, 
-                                               self.end_of_words, 
-                                               self.batch_word_lengths, 
-                                               dtype,
-                                               cell_type, 
-                                               peephole, 
-                                               self.input_keep_prob, 
-                                               self.output_keep_prob) 
-        else:
-            encoder_output = encoder(encoder_state_size, 
-                                               encoder_num_layers,
-                                               rnn_inputs, 
-                                               self.x_input_lenghts, 
-                                               dtype,
-                                               cell_type, 
-                                               peephole, 
-                                               self.input_keep_prob, 
-                                               self.output_keep_prob) 
+                # encoder
+                if use_char2word:
+                    encoder_output = char2word_encoder(char2word_state_size,
+                                                       char2word_num_layers, 
+                                                       encoder_state_size, 
+                                                       encoder_num_layers,
+                                                       rnn_inputs, 
+                                                       self.x_input_lenghts, 
+                                                       self.end_of_words, 
+                                                       self.batch_word_lengths, 
+                                                       dtype,
+                                                       cell_type, 
+                                                       peephole, 
+                                                       self.input_keep_prob, 
+                                                       self.output_keep_prob) 
+                else:
+                    encoder_output = encoder(encoder_state_size, 
+                                                       encoder_num_layers,
+                                                       rnn_inputs, 
+                                                       self.x_input_lenghts, 
+                                                       dtype,
+                                                       cell_type, 
+                                                       peephole, 
+                                                       self.input_keep_prob, 
+                                                       self.output_keep_prob) 
             
-        # sentiment feature
-        if self.use_sentiment_feature:
-            stochastic_layer_input = tf.concat( [self.sentiment_feature , encoder_output] , 1)
-        else:
-            stochastic_layer_input = encoder_output
-        # stochastic layer
-        self.z, self.z_mu, self.z_ls2 = stochasticLayer(stochastic_layer_input, latent_dim, self.batch_size,
-                                                        dtype, scope="stochastic_layer")
-        # decoder
-        self.decoder_output = decoder(self.z, self.batch_size, decoder_state_size, decoder_num_layers, 
-                                      data_dim, self.x_input_lenghts, cell_type, peephole,
-                                      self.input_keep_prob, self.output_keep_prob, inputs_onehot, self.training,dtype, scope="decoder") 
-        # loss
-        self.loss, self.reconstruction_loss, self.latent_loss = loss_function(self.decoder_output, self.x_input, 
-                                  self.weights_input,self.z_ls2, self.z_mu, 
-                                  self.B, latent_loss_weight, dtype, scope="loss") 
-        # optimizer
-        self.optimizer = optimizationOperation(self.loss, self.learning_rate, scope="optimizer")   # optimizer
-        # merge summaries: summarize variables
-        self.merged_summary = tf.summary.merge_all()
+                # sentiment feature
+                if self.use_sentiment_feature:
+                    stochastic_layer_input = tf.concat( [self.sentiment_feature , encoder_output] , 1)
+                else:
+                    stochastic_layer_input = encoder_output
+                # stochastic layer
+                self.z, self.z_mu, self.z_ls2 = stochasticLayer(stochastic_layer_input, latent_dim, self.batch_size,
+                                                                dtype, scope="stochastic_layer")
+                # decoder
+                self.decoder_output, training_output, self.build_generator, build_sampled_loss = decoder(self.z, self.batch_size, decoder_state_size, decoder_num_layers, 
+                                              data_dim, self.x_input_lenghts, cell_type, peephole,
+                                              self.input_keep_prob, self.output_keep_prob, inputs_onehot, self.training,dtype, embeddings=self.embeddings, 
+                                              teacher_forcing=teacher_forcing, scope="decoder") 
+            # generation (built on demand, see generate)
+            self.generation_max_length = tf.placeholder(tf.int32, shape=[], name='generation_max_length')
+            self.generation_temperature = tf.placeholder_with_default(tf.constant(1.0, dtype=dtype), shape=[], name='generation_temperature')
+            self.generators = {}
+            # loss
+            separate_training_loss = teacher_forcing or sampled_softmax > 0
+            self.loss, self.reconstruction_loss, self.latent_loss = loss_function(self.decoder_output, self.x_input, 
+                                      self.weights_input,self.z_ls2, self.z_mu, 
+                                      self.B, latent_loss_weight, dtype, summaries= not separate_training_loss, scope="loss") 
+            if separate_training_loss:
+                # training loss (the exact loss above is only computed for evaluation)
+                if sampled_softmax > 0:
+                    training_reconstruction_loss = build_sampled_loss(self.x_input, self.weights_input, sampled_softmax)
+                else:
+                    training_reconstruction_loss = None
+                self.train_loss, self.train_reconstruction_loss, _ = loss_function(training_output, self.x_input, 
+                                      self.weights_input,self.z_ls2, self.z_mu, 
+                                      self.B, latent_loss_weight, dtype, reconstruction_loss=training_reconstruction_loss, scope="training_loss") 
+            else:
+                self.train_loss, self.train_reconstruction_loss = self.loss, self.reconstruction_loss
+            # optimizer
+            if num_replicas > 1:
+                if dtype == tf.float16:
+                    raise ValueError("mixed precision is not supported with synchronous replicas")
+                self.global_step = tf.train.get_or_create_global_step()
+                # the aggregated update is applied by the chief queue runner, which can not feed placeholders:
+                # the learning rate is read from a shared variable assigned by the chief (see assign_learning_rate)
+                with tf.name_scope("training_parameters"):
+                    self.learning_rate_variable = tf.Variable(0., trainable=False, name='learning_rate_value')
+                    self.assign_learning_rate_op = self.learning_rate_variable.assign(self.learning_rate)
+                self.sync_optimizer = tf.train.SyncReplicasOptimizer(tf.train.AdamOptimizer(self.learning_rate_variable), 
+                                                                     replicas_to_aggregate=num_replicas, 
+                                                                     total_num_replicas=num_replicas)
+            else:
+                self.global_step = None
+                self.learning_rate_variable = None
+                self.assign_learning_rate_op = None
+                self.sync_optimizer = None
+            self.accumulation_steps = accumulation_steps
+            if accumulation_steps > 1:
+                if dtype == tf.float16:
+                    raise ValueError("mixed precision is not supported with gradient accumulation")
+                self.accumulate, self.optimizer, self.reset_accumulation = accumulationOperations(self.train_loss, self.learning_rate, accumulation_steps,
+                                                                                                  optimizer=self.sync_optimizer, global_step=self.global_step, 
+                                                                                                  device=worker_device, scope="optimizer")
+            else:
+                self.accumulate = None
+                self.reset_accumulation = None
+                self.optimizer = optimizationOperation(self.train_loss, self.learning_rate, loss_scaling= dtype == tf.float16, 
+                                                       optimizer=self.sync_optimizer, global_step=self.global_step, scope="optimizer")   # optimizer
+            # merge summaries: summarize variables
+            self.merged_summary = tf.summary.merge_all()
     
-    def step(self, sess, padded_batch_xs, beta, learning_rate, batch_lengths, batch_weights, end_of_words_value, batch_word_lengths_value, epoch,sentiment_feature) :
+    def step(self, sess, padded_batch_xs, beta, learning_rate, batch_lengths, batch_weights, end_of_words_value, batch_word_lengths_value, epoch,sentiment_feature, summarize=True, options=None, run_metadata=None) :
         """ 
         train the model for one step
         Args:
@@ -164,26 +250,116 @@ class Vrae:
             batch_word_lengths_value: number of words
             epoch: current epoch
             sentiment_feature: sentiment feature
+            summarize (bool): evaluate the summaries (None is returned otherwise, the summary operations are not run)
+            options (tf.RunOptions): run options, e.g. to trace the step (the last micro-batch with gradient accumulation)
+            run_metadata (tf.RunMetadata): collects the trace
         Returns:
             a tuple of values:
                 optimizer op
                 current loss
                 summary op
+            with gradient accumulation, the losses are averaged over the micro-batches and the summary is the one of the last micro-batch
+        """
+        if self.accumulation_steps == 1:
+            return self.run_training_step(sess, self.optimizer, 
+                                          self.train_feed_dict(padded_batch_xs, beta, learning_rate, batch_lengths, batch_weights, end_of_words_value, 
+                                                               batch_word_lengths_value, epoch, sentiment_feature, self.batch_size_value), 
+                                          summarize, options, run_metadata)
+        sentiment_feature = np.asarray(sentiment_feature)
+        micro_batches = split_padded_batch(padded_batch_xs, batch_lengths, batch_weights, end_of_words_value, batch_word_lengths_value, self.accumulation_steps)
+        results = []
+        for k, micro_batch in enumerate(micro_batches):
+            micro_xs, micro_lengths, micro_weights, micro_end_of_words, micro_word_lengths, start, stop = micro_batch
+            last = k == len(micro_batches) - 1
+            results.append( self.run_training_step(sess, self.accumulate, 
+                                                   self.train_feed_dict(micro_xs, beta, learning_rate, micro_lengths, micro_weights, micro_end_of_words, 
+                                                                        micro_word_lengths, epoch, sentiment_feature[start:stop], stop - start),
+                                                   summarize and last, options if last else None, run_metadata if last else None) )
+        return [sess.run(self.optimizer, feed_dict={self.learning_rate: learning_rate})] + accumulated_results(results)
+    
+    def assign_learning_rate(self, sess, learning_rate):
+        """
+        set the learning rate used by the synchronous replicas (the chief calls it before initializing the tokens
+        and each time the learning rate changes). The learning rate fed to step is used otherwise.
+        Args:
+            sess: current Tensorflow session
+            learning_rate (float): learning rate
         """
-        return sess.run([self.optimizer, self.loss, self.reconstruction_loss, self.latent_loss, self.merged_summary, self.max_sentence_size ], feed_dict={self.x_input: padded_batch_xs, 
-                                                           self.B:beta, 
-                                                           self.learning_rate: learning_rate,
-                                                           self.x_input_lenghts:batch_lengths,
-                                                           self.weights_input: batch_weights,
-                                                           self.input_keep_prob:self.input_keep_prob_value, 
-                                                           self.output_keep_prob:self.output_keep_prob_value,
-                                                           self.epoch: epoch,
-                                                           self.batch_size:self.batch_size_value,
-                                                           self.end_of_words: end_of_words_value,
-                                                           self.batch_word_lengths:batch_word_lengths_value,
-                                                           self.training: self.teacher_forcing,
-                                                           self.sentiment_feature:sentiment_feature
-                                                            })
+        sess.run(self.assign_learning_rate_op, feed_dict={self.learning_rate: learning_rate})
+    
+    def run_training_step(self, sess, train_op, feed_dict, summarize, options=None, run_metadata=None, extra_fetches=()):
+        """
+        run a training operation and return [train_op output, loss, reconstruction_loss, latent_loss, summary, max_sentence_size]
+        followed by the values of extra_fetches. The summary is None and the summary operations are not evaluated if summarize is False
+        """
+        fetches = [train_op, self.train_loss, self.train_reconstruction_loss, self.latent_loss, self.max_sentence_size] + list(extra_fetches)
+        if summarize:
+            fetches.append(self.merged_summary)
+        results = sess.run(fetches, feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        summary = results.pop() if summarize else None
+        return results[:4] + [summary] + results[4:]
+    
+    def train_feed_dict(self, padded_batch_xs, beta, learning_rate, batch_lengths, batch_weights, end_of_words_value, batch_word_lengths_value, epoch, sentiment_feature, batch_size):
+        """
+        feed_dict of a training step (see step)
+        """
+        return {self.x_input: padded_batch_xs, 
+                self.B:beta, 
+                self.learning_rate: learning_rate,
+                self.x_input_lenghts:batch_lengths,
+                self.weights_input: batch_weights,
+                self.input_keep_prob:self.input_keep_prob_value, 
+                self.output_keep_prob:self.output_keep_prob_value,
+                self.epoch: epoch,
+                self.batch_size:batch_size,
+                self.end_of_words: end_of_words_value,
+                self.batch_word_lengths:batch_word_lengths_value,
+                self.training: self.teacher_forcing,
+                self.sentiment_feature:sentiment_feature
+                }
+    
+    def dataset_step(self, sess, iterator_handle, beta, learning_rate, epoch, summarize=True, options=None, run_metadata=None, statistics=False):
+        """ 
+        train the model for one step on the next batch of a tf.data iterator (the model must be built with dataset_input=True)
+        Args:
+            sess: current Tensorflow session
+            iterator_handle: handle of the iterator (see input_pipeline.DatasetInput.initialize)
+            beta: beta parameter for deterministic warmup
+            learning_rate: learning rate (potentially controled during training)
+            epoch: current epoch
+            summarize (bool): evaluate the summaries
+            options (tf.RunOptions): run options (see step)
+            run_metadata (tf.RunMetadata): collects the trace
+            statistics (bool): also return the numbers of sentences, real tokens and padded tokens read from the iterator
+                (numpy array of 3 integers appended to the results, summed over the micro-batches)
+        Returns:
+            see step. Raises tf.errors.OutOfRangeError at the end of the epoch. With gradient accumulation, 
+            each micro-batch is read from the iterator and an incomplete accumulation is discarded at the end of the epoch
+        """
+        feed_dict = {self.iterator_handle: iterator_handle,
+                     self.B:beta, 
+                     self.learning_rate: learning_rate,
+                     self.input_keep_prob:self.input_keep_prob_value, 
+                     self.output_keep_prob:self.output_keep_prob_value,
+                     self.epoch: epoch,
+                     self.training: self.teacher_forcing
+                     }
+        extra_fetches = [self.batch_statistics] if statistics else []
+        if self.accumulation_steps == 1:
+            return self.run_training_step(sess, self.optimizer, feed_dict, summarize, options, run_metadata, extra_fetches)
+        results = []
+        try:
+            for k in xrange(self.accumulation_steps):
+                last = k == self.accumulation_steps - 1
+                results.append( self.run_training_step(sess, self.accumulate, feed_dict, summarize and last, 
+                                                       options if last else None, run_metadata if last else None, extra_fetches) )
+        except tf.errors.OutOfRangeError:
+            sess.run(self.reset_accumulation)
+            raise
+        outputs = [sess.run(self.optimizer, feed_dict={self.learning_rate: learning_rate})] + accumulated_results([ r[:6] for r in results ])
+        if statistics:
+            outputs.append(np.sum([ r[6] for r in results ], axis=0))
+        return outputs
     
     def reconstruct(self, sess, padded_batch_xs, batch_lengths, batch_weights,end_of_words_value,batch_word_lengths_value,sentiment_feature):
         """
@@ -261,6 +437,156 @@ class Vrae:
                                                 self.sentiment_feature:[sentiment],
                                                 self.training: False})
     
+    def generate(self, sess, z_samples, max_length, beam_width=1, temperature=0.):
+        """
+        Generate sentences from latent variables. Each sequence stops when the end of sentence symbol is
+        emitted and the decoding stops when all sequences are finished, or after max_length steps.
+        Args:
+            sess: current Tensorflow session
+            z_samples (numpy array): z samples (n_samples x latent_dim)
+            max_length (Natural Integer): maximum number of generated symbols
+            beam_width (Natural Integer): beam search width (1: greedy or sampling)
+            temperature (float): softmax temperature used for sampling (0: greedy decoding, ignored with beam search)
+        Returns:
+            a tuple ids, lengths
+                ids: numpy array of generated ids (n_samples x generated length), the best beam for beam search
+                lengths: numpy array of sequence lengths (including the end of sentence symbol)
+        """
+        sampling = beam_width == 1 and temperature > 0
+        key = (beam_width, sampling)
+        if key not in self.generators:
+            self.generators[key] = self.build_generator(self.generation_max_length, beam_width=beam_width,
+                                                        temperature=self.generation_temperature if sampling else None)
+        feed_dict = {self.z: z_samples,
+                     self.generation_max_length: max_length,
+                     self.input_keep_prob:1, 
+                     self.output_keep_prob:1}
+        if sampling:
+            feed_dict[self.generation_temperature] = temperature
+        return sess.run(self.generators[key], feed_dict=feed_dict)
+    
+    def XTozBatch(self, sess, seqs, sentiments, word_delimiters=(), max_batch_size=1000):
+        """
+        Project a list of sequences of different lengths to the latent space Z. Sequences are padded and
+        processed by chunks of max_batch_size elements.
+        Args:
+            sess: current Tensorflow session
+            seqs (list of lists of Natural Integers): sequences of ids (e.g. EncoderDecoder.encode outputs)
+            sentiments (list or numpy array): sentiment features (len(seqs) x 3), may be None if the model does not use them
+            word_delimiters (list of Natural Integers): symbols corresponding to spaces (only used by the char2word encoder)
+            max_batch_size (Natural Integer): maximum number of sequences per session run
+        Returns:
+            numpy array of z_mu (len(seqs) x latent_dim), aligned with the inputs
+        """
+        return encode_batch(sess, self, seqs, sentiments, word_delimiters, max_batch_size)
+    
+    def zToXBatch(self, sess, z_samples, s_length, max_batch_size=1000):
+        """
+        Reconstruct X from a batch of latent variables z, processed by chunks of max_batch_size elements.
+        Args:
+            sess: current Tensorflow session
+            z_samples (numpy array): z samples (n_samples x latent_dim)
+            s_length: sentence_length
+            max_batch_size (Natural Integer): maximum number of samples per session run
+        Returns:
+            numpy array of logits (n_samples x s_length x num_symbols), aligned with the inputs
+        """
+        return decode_batch(sess, self, z_samples, s_length, max_batch_size)
+    
+
+def accumulated_results(results):
+    """
+    combine the results of the micro-batches of an accumulation step (see Vrae.step)
+    Args:
+        results (list): [accumulate op, loss, reconstruction_loss, latent_loss, summary, max_sentence_size] for each micro-batch
+    Returns:
+        [loss, reconstruction_loss, latent_loss, summary, max_sentence_size]
+    """
+    _, losses, reconstruction_losses, latent_losses, summaries, max_sentence_sizes = zip(*results)
+    return [np.mean(losses), np.mean(reconstruction_losses), np.concatenate(latent_losses), summaries[-1], max(max_sentence_sizes)]
+
+def float32_variable_storage_getter(getter, name, shape=None, dtype=None, initializer=None, regularizer=None, trainable=True, *args, **kwargs):
+    """
+    Custom getter for mixed precision: trainable variables are stored in float32 and cast to the requested dtype (float16)
+    """
+    storage_dtype = tf.float32 if trainable else dtype
+    variable = getter(name, shape, dtype=storage_dtype, initializer=initializer, regularizer=regularizer, trainable=trainable, *args, **kwargs)
+    if trainable and dtype != tf.float32:
+        variable = tf.cast(variable, dtype)
+    return variable
+
+def input_placeholder(dtype, shape, name, default=None):
+    """
+    A placeholder, or a placeholder with a default value when the model reads its inputs from an iterator
+    """
+    if default is None:
+        return tf.placeholder(dtype, shape, name=name)
+    if shape is None:
+        shape = default.shape
+    return tf.placeholder_with_default(default, shape, name=name)
+
+def encode_batch(sess, model, seqs, sentiments, word_delimiters=(), max_batch_size=1000):
+    """
+    Project a list of sequences to the latent space (see Vrae.XTozBatch). 
+    Args:
+        sess: Tensorflow session
+        model: object exposing the input and output tensors of the model (Vrae or inference.InferenceModel)
+        others: see Vrae.XTozBatch
+    Returns:
+        numpy array of z_mu (len(seqs) x latent_dim), empty if there is no sequence
+    """
+    if len(seqs) == 0:
+        return np.zeros((0, model.z_mu.get_shape().as_list()[-1]), dtype=np.float32)
+    word_delimiter_ids = delimiter_ids(word_delimiters)
+    if sentiments is None:
+        sentiments = np.zeros((len(seqs), 3))
+    z_mus = []
+    for start in xrange(0, len(seqs), max_batch_size):
+        batch_xs = seqs[start : start + max_batch_size]
+        padded_batch_xs, batch_lengths, _, end_of_words, batch_word_lengths, _ = pad_batch(batch_xs, word_delimiter_ids)
+        z_mus.append( sess.run(model.z_mu, feed_dict={model.x_input: padded_batch_xs,
+                                                      model.x_input_lenghts: batch_lengths,
+                                                      model.end_of_words: end_of_words,
+                                                      model.batch_word_lengths: batch_word_lengths,
+                                                      model.input_keep_prob:1, 
+                                                      model.output_keep_prob:1,
+                                                      model.batch_size: len(batch_xs),
+                                                      model.sentiment_feature: sentiments[start : start + max_batch_size],
+                                                      model.training: False}) )
+    return np.concatenate(z_mus)
+
+def decode_batch(sess, model, z_samples, s_length, max_batch_size=1000, ids=False):
+    """
+    Reconstruct X from a batch of latent variables (see Vrae.zToXBatch).
+    Args:
+        sess: Tensorflow session
+        model: object exposing the input and output tensors of the model (Vrae or inference.InferenceModel)
+        ids (boolean): return the most likely symbols instead of the logits (the argmax is taken for each chunk,
+            only the ids of all the samples are kept in memory)
+        others: see Vrae.zToXBatch
+    Returns:
+        numpy array of logits (n_samples x s_length x num_symbols), or of ids (n_samples x s_length) if ids is True,
+        empty if there is no sample
+    """
+    if len(z_samples) == 0:
+        if ids:
+            return np.zeros((0, s_length), dtype=np.int64)
+        return np.zeros((0, s_length, model.decoder_output.get_shape().as_list()[-1]), dtype=np.float32)
+    outputs = []
+    for start in xrange(0, len(z_samples), max_batch_size):
+        z_batch = z_samples[start : start + max_batch_size]
+        n = len(z_batch)
+        logits = sess.run(model.decoder_output, feed_dict={model.z: z_batch,
+                                                           model.x_input_lenghts: [s_length] * n,
+                                                           model.input_keep_prob:1, 
+                                                           model.output_keep_prob:1,
+                                                           model.batch_size: n,
+                                                           model.training: False,
+                                                           model.x_input: np.zeros((n, 1), dtype=np.int32)
+                                                           })
+        outputs.append( np.argmax(logits, axis=2) if ids else logits )
+    return np.concatenate(outputs)
+    
 def char2word_encoder( char2word_state_size, 
                       char2word_num_layers, 
                       encoder_state_size, 
@@ -396,7 +722,9 @@ def stochasticLayer(encoder_output, latent_dim, batch_size,dtype, scope="stochas
             with tf.name_scope('random_normal_sample'):
                 eps = tf.random_normal((batch_size, latent_dim), 0, 1, dtype=dtype) # draw a random number
             with tf.name_scope('z_sample'):
-                z = tf.add(z_mu, tf.multiply(tf.sqrt(tf.exp(z_ls2)), eps))  # a sample it from Z -> z
+                # sigma is computed in float32 to avoid float16 overflows
+                sigma = tf.cast(tf.exp(0.5 * tf.cast(z_ls2, tf.float32)), dtype)
+                z = tf.add(z_mu, tf.multiply(sigma, eps))  # a sample it from Z -> z
         # summaries
         tf.summary.histogram("z_mu", z_mu)
         tf.summary.histogram("z_ls2", z_ls2)
@@ -405,14 +733,14 @@ def stochasticLayer(encoder_output, latent_dim, batch_size,dtype, scope="stochas
         return z,z_mu,z_ls2
 
 
-def dynamic_rnn_with_projection_layer( cell_dec, z_input, x_input_lenghts, W_proj, b_proj, batch_size, state_size, data_dim, x_inputs,training,dtype, scope="dynamic_rnn_with_projection_layer"):
+def dynamic_rnn_with_projection_layer( cell_dec, z_input, x_input_lenghts, W_proj, b_proj, batch_size, state_size, data_dim, x_inputs,training,dtype, embeddings=None, scope="dynamic_rnn_with_projection_layer"):
     """
     A custom dynamic rnn implemented using the raw_rnn class from Tensorflow. The difference with the dynamic_rnn is the use of a projection layer to feed the true output value to the next step. Indeed, for each cell, the output is a tensor of size (batch_size x state_size). Here we project this output into the expected output value, thus we obtain a Tensor (batch_size x data_dim). Then we output this expected output to the next cell. This makes the model more robust.
     Args:
         cell_dec (tf.nn.rnn_cell): RNN cell
         z_input (Tensor): input Tensor of size (batch_size x state_size) Typically the samples z projected to the dimension of the decoder
         x_input_lengths (Tensor): a Tensor of integers of size (batch_size, ). Lenght of the input sequences.
-        W_proj (tf.Variable): weights of the projection layer.
+        W_proj (tf.Variable): weights of the projection layer (data_dim x state_size).
         b_proj (tf.Variable): biases of the projection layer.
         batch_size (Natural Integer): batch size.
         state_size (Natural Integer): RNN cell state size.
@@ -420,6 +748,8 @@ def dynamic_rnn_with_projection_layer( cell_dec, z_input, x_input_lenghts, W_pro
         x_inputs (Tensor): inputs
         training (bool): training phase or not
         dtype (string): dtype to be used   
+        embeddings (tf.Variable): symbol embeddings if the inputs are embedded (None for one-hot inputs). 
+            In free running mode, the expected embedding under the predicted distribution is fed to the next step.
         scope (string): scope name
     """
     # following dynamic_rnn implementation https://github.com/tensorflow/tensorflow/blob/master/tensorflow/python/ops/rnn.py
@@ -440,6 +770,7 @@ def dynamic_rnn_with_projection_layer( cell_dec, z_input, x_input_lenghts, W_pro
             raise ValueError(
               "Input size (depth of inputs) must be accessible via shape inference,"
               " but saw value None.")
+    input_dim = shape[2].value
     got_time_steps = shape[0].value
     got_batch_size = shape[1].value
     if const_time_steps != got_time_steps:
@@ -472,20 +803,25 @@ def dynamic_rnn_with_projection_layer( cell_dec, z_input, x_input_lenghts, W_pro
             finished = tf.reduce_all(elements_finished) # check if all elements finished and get a single boolean
             if cell_output is None:  # time == 0
                 next_cell_state = cell_dec.zero_state(batch_size, dtype)
-                next_input_value = tf.concat([z_input, tf.zeros([batch_size,data_dim], dtype=dtype)], 1) 
+                next_input_value = tf.concat([z_input, tf.zeros([batch_size,input_dim], dtype=dtype)], 1) 
             else:
                 #emit_output = tf.add(tf.matmul(W_proj,prev_out), b_proj)
                 next_cell_state = cell_state
+                def free_running_input():
+                    predicted_distribution = tf.nn.softmax(tf.add(tf.matmul(cell_output, W_proj, transpose_b=True), b_proj) )
+                    if embeddings is None:
+                        return predicted_distribution
+                    return tf.matmul(predicted_distribution, embeddings)
                 predicted_previous_output = tf.cond(training, 
                                                     lambda: input_ta.read(time-1), 
-                                                    lambda: tf.nn.softmax(tf.add(tf.matmul(cell_output, W_proj), b_proj) ))
+                                                    free_running_input)
                 next_input_value = tf.cond( # removing this condition leads to the read TensorArray problem: used for dynamic rray
                     finished,
                     lambda:tf.concat([ tf.zeros([batch_size,state_size], dtype=dtype), predicted_previous_output], 1) ,
                     lambda:tf.concat([z_input, predicted_previous_output ], 1) )
             next_input = tf.cond(
                 finished,
-                lambda: tf.zeros([batch_size, data_dim + state_size], dtype=dtype),
+                lambda: tf.zeros([batch_size, input_dim + state_size], dtype=dtype),
                 lambda: next_input_value )
             next_loop_state = None
             return (elements_finished, next_input, next_cell_state,
@@ -493,7 +829,32 @@ def dynamic_rnn_with_projection_layer( cell_dec, z_input, x_input_lenghts, W_pro
         return tf.nn.raw_rnn(cell_dec, loop_fn)#, parallel_iterations = 1)
 
 
-def decoder(z, batch_size, state_size, num_layers, data_dim, x_input_lenghts, cell_type, peephole, input_keep_prob, output_keep_prob, x_inputs, training, dtype, scope="decoder"):
+def teacher_forced_rnn(cell_dec, z_input, x_input_lenghts, x_inputs, dtype, scope="teacher_forced_rnn"):
+    """
+    Teacher forcing version of dynamic_rnn_with_projection_layer. All the inputs are known in advance, thus z is concatenated
+    with the shifted inputs once and a standard dynamic_rnn is used instead of the raw_rnn loop (no tf.cond and no TensorArray
+    read per step). The cell is shared with the raw_rnn decoder.
+    Args:
+        cell_dec (tf.nn.rnn_cell): RNN cell
+        z_input (Tensor): input Tensor of size (batch_size x state_size) Typically the samples z projected to the dimension of the decoder
+        x_input_lengths (Tensor): a Tensor of integers of size (batch_size, ). Lenght of the input sequences.
+        x_inputs (Tensor): inputs (batch_size x None x input_dim)
+        dtype (string): dtype to be used   
+        scope (string): scope name
+    Returns:
+        outputs of the RNN (batch_size x None x state_size), zeros after the end of each sequence
+    """
+    with tf.name_scope(scope):
+        time_steps = tf.shape(x_inputs)[1]
+        # the first step receives zeros, step t receives the input t-1
+        shifted_inputs = tf.pad(x_inputs[:, :-1, :], [[0, 0], [1, 0], [0, 0]])
+        z_inputs = tf.tile(tf.expand_dims(z_input, 1), [1, time_steps, 1])
+        rnn_inputs = tf.concat([z_inputs, shifted_inputs], 2)
+        outputs, _ = tf.nn.dynamic_rnn(cell_dec, rnn_inputs, sequence_length=x_input_lenghts, dtype=dtype)
+        return outputs
+
+
+def decoder(z, batch_size, state_size, num_layers, data_dim, x_input_lenghts, cell_type, peephole, input_keep_prob, output_keep_prob, x_inputs, training, dtype, embeddings=None, teacher_forcing=False, scope="decoder"):
     """"
     Decoder of the VRAE model. This neural network approximates the posterior distribution p(x|z). The decoder transforms samples z from the prior distribution to a reconstruction of x.
     Args:
@@ -510,15 +871,25 @@ def decoder(z, batch_size, state_size, num_layers, data_dim, x_input_lenghts, ce
         output_keep_prob (float): dropout keep probability for the outputs
         x_inputs (Tensor): inputs
         training (bool): training phase or not
+        embeddings (tf.Variable): symbol embeddings if x_inputs are embedded (None for one-hot inputs)
+        teacher_forcing (bool): build the teacher forcing decoder used for training (see teacher_forced_rnn)
         scope (string): scope name
     Returns:
-        A tensor of size (batch_size x None x data_dim) which is a reconstruction of x
+        A tuple decoder_output, training_output, build_generator, build_sampled_loss
+            decoder_output: A tensor of size (batch_size x None x data_dim) which is a reconstruction of x
+            training_output: logits of the teacher forcing decoder (decoder_output if teacher_forcing is False)
+            build_generator: a function building the generation graph which shares the decoder variables (see generation_decoder)
+            build_sampled_loss: a function building the sampled softmax reconstruction loss on the training outputs (see sampled_sentence_loss)
     """
     with tf.name_scope(scope):
         # projection layer
         with tf.name_scope("projection_layer"):
-            W_proj = tf.Variable(tf.random_uniform([state_size, data_dim], 0, 1, dtype=dtype), dtype=dtype)
-            b_proj = tf.Variable(tf.zeros([data_dim], dtype=dtype), dtype=dtype)
+            # float32 variables used in the dtype of the model (mixed precision). The weights are stored as one row
+            # per symbol (data_dim x state_size) so that the sampled softmax gathers the rows of the sampled symbols
+            W_out = tf.Variable(tf.random_uniform([data_dim, state_size], 0, 1, dtype=tf.float32), dtype=tf.float32)
+            b_out = tf.Variable(tf.zeros([data_dim], dtype=tf.float32), dtype=tf.float32)
+            W_proj = tf.cast(W_out, dtype)
+            b_proj = tf.cast(b_out, dtype)
         # connect z to the RNN
         h_z2dec = tf.contrib.layers.fully_connected(z, state_size, scope="z2initial_decoder_state", activation_fn=None)
         # RNN Cell
@@ -539,17 +910,108 @@ def decoder(z, batch_size, state_size, num_layers, data_dim, x_input_lenghts, ce
             cells.append(cell)
         dec_cell = tf.contrib.rnn.MultiRNNCell(cells)                                 
         # RNN decoder
-        outputs_ta, final_state, _ = dynamic_rnn_with_projection_layer( dec_cell, h_z2dec, x_input_lenghts, W_proj, b_proj, batch_size, state_size, data_dim, x_inputs, training, dtype, scope="dynamic_rnn_with_projection_layer")
+        outputs_ta, final_state, _ = dynamic_rnn_with_projection_layer( dec_cell, h_z2dec, x_input_lenghts, W_proj, b_proj, batch_size, state_size, data_dim, x_inputs, training, dtype, embeddings=embeddings, scope="dynamic_rnn_with_projection_layer")
          # project the output
         rnn_outputs_decoder = outputs_ta.stack()
         decoder_max_steps, decoder_batch_size, decoder_dim = tf.unstack(tf.shape(rnn_outputs_decoder))
         decoder_outputs_flat = tf.reshape(rnn_outputs_decoder, (-1, state_size))
-        decoder_logits_flat = tf.add(tf.matmul(decoder_outputs_flat, W_proj), b_proj)
+        decoder_logits_flat = tf.add(tf.matmul(decoder_outputs_flat, W_proj, transpose_b=True), b_proj)
         rnn_outputs_decoder = tf.transpose( tf.reshape(decoder_logits_flat, (decoder_max_steps, batch_size, data_dim)) , [1,0,2])
         # no softmax here: softmax is applied in the loss function 
-        return rnn_outputs_decoder
+        if teacher_forcing:
+            training_hidden = teacher_forced_rnn(dec_cell, h_z2dec, x_input_lenghts, x_inputs, dtype)
+            # project all the steps at once
+            training_logits_flat = tf.add(tf.matmul(tf.reshape(training_hidden, (-1, state_size)), W_proj, transpose_b=True), b_proj)
+            training_output = tf.reshape(training_logits_flat, (batch_size, -1, data_dim))
+        else:
+            training_hidden = tf.transpose(outputs_ta.stack(), [1,0,2])
+            training_output = rnn_outputs_decoder
+        build_generator = functools.partial(generation_decoder, dec_cell, h_z2dec, W_proj, b_proj, data_dim, embeddings=embeddings, dtype=dtype, scope=scope+"_generation")
+        build_sampled_loss = functools.partial(sampled_sentence_loss, training_hidden, W_out, b_out, data_dim=data_dim, dtype=dtype)
+        return rnn_outputs_decoder, training_output, build_generator, build_sampled_loss
                     
 
+class LatentProjectionWrapper(tf.contrib.rnn.RNNCell):
+    """
+    Decoder cell used for generation: the input z is concatenated to the inputs and the output is projected
+    to the logits using the projection layer of the decoder, as in dynamic_rnn_with_projection_layer.
+    """
+    def __init__(self, cell, z_input, W_proj, b_proj, data_dim):
+        """
+        Args:
+            cell (tf.nn.rnn_cell): decoder RNN cell
+            z_input (Tensor): z projected to the dimension of the decoder (batch_size x state_size)
+            W_proj (tf.Variable): weights of the projection layer (data_dim x state_size).
+            b_proj (tf.Variable): biases of the projection layer.
+            data_dim (Natural Integer): dimension of the data.
+        """
+        super(LatentProjectionWrapper, self).__init__()
+        self._cell = cell
+        self._z_input = z_input
+        self._W_proj = W_proj
+        self._b_proj = b_proj
+        self._data_dim = data_dim
+        
+    @property
+    def state_size(self):
+        return self._cell.state_size
+    
+    @property
+    def output_size(self):
+        return self._data_dim
+    
+    def zero_state(self, batch_size, dtype):
+        return self._cell.zero_state(batch_size, dtype)
+    
+    def __call__(self, inputs, state, scope=None):
+        output, new_state = self._cell(tf.concat([self._z_input, inputs], 1), state)
+        return tf.add(tf.matmul(output, self._W_proj, transpose_b=True), self._b_proj), new_state
+    
+    
+def generation_decoder(cell_dec, z_input, W_proj, b_proj, data_dim, max_length, beam_width=1, temperature=None, end_token=2, embeddings=None, dtype=tf.float32, scope="generation_decoder"):
+    """
+    Free running decoder used for generation. Unlike dynamic_rnn_with_projection_layer, the previous symbol is fed as a one-hot vector,
+    each sequence is finished when end_token is emitted and the loop stops when all sequences are finished.
+    The first input is a vector of zeros, as during training.
+    Args:
+        cell_dec (tf.nn.rnn_cell): RNN cell of the decoder
+        z_input (Tensor): input Tensor of size (batch_size x state_size) Typically the samples z projected to the dimension of the decoder
+        W_proj (tf.Variable): weights of the projection layer (data_dim x state_size).
+        b_proj (tf.Variable): biases of the projection layer.
+        data_dim (Natural Integer): dimension of the data.
+        max_length (Tensor): maximum number of steps
+        beam_width (Natural Integer): beam search width (1: greedy decoding or sampling)
+        temperature (Tensor or None): sample with this softmax temperature instead of greedy decoding (only with beam_width=1)
+        end_token (Natural Integer): id of the end of sentence symbol (EOS_ID)
+        embeddings (tf.Variable): symbol embeddings if the decoder inputs are embedded (None for one-hot inputs)
+        dtype (string): dtype to be used
+        scope (string): scope name
+    Returns:
+        a tuple ids, lengths: generated ids (batch_size x None) and sequence lengths (batch_size)
+    """
+    with tf.name_scope(scope):
+        batch_size = tf.shape(z_input)[0]
+        if embeddings is None:
+            embedding = lambda ids: tf.one_hot(ids, data_dim, dtype=dtype) # one_hot(-1) is a vector of zeros
+        else:
+            embedding = lambda ids: tf.nn.embedding_lookup(embeddings, tf.maximum(ids, 0)) * tf.expand_dims(tf.cast(ids >= 0, dtype), -1)
+        start_tokens = tf.fill([batch_size], -1)
+        if beam_width > 1:
+            cell = LatentProjectionWrapper(cell_dec, tf.contrib.seq2seq.tile_batch(z_input, beam_width), W_proj, b_proj, data_dim)
+            decoder = tf.contrib.seq2seq.BeamSearchDecoder(cell, embedding, start_tokens, end_token,
+                                                           cell.zero_state(batch_size * beam_width, dtype), beam_width)
+            outputs, _, lengths = tf.contrib.seq2seq.dynamic_decode(decoder, maximum_iterations=max_length, scope=scope)
+            return outputs.predicted_ids[:, :, 0], lengths[:, 0]
+        cell = LatentProjectionWrapper(cell_dec, z_input, W_proj, b_proj, data_dim)
+        if temperature is not None:
+            helper = tf.contrib.seq2seq.SampleEmbeddingHelper(embedding, start_tokens, end_token, softmax_temperature=temperature)
+        else:
+            helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(embedding, start_tokens, end_token)
+        decoder = tf.contrib.seq2seq.BasicDecoder(cell, helper, cell.zero_state(batch_size, dtype))
+        outputs, _, lengths = tf.contrib.seq2seq.dynamic_decode(decoder, maximum_iterations=max_length, impute_finished=True, scope=scope)
+        return outputs.sample_id, lengths
+    
+    
 def sentence_loss(x_reconstr_mean, x_input, weights_input, dtype, scope="sentence_loss"):
     """
     Sentence loss based on tf.contrib.seq2seq.sequence_loss. This is an reduced element-wise cross entropy.
@@ -566,6 +1028,32 @@ def sentence_loss(x_reconstr_mean, x_input, weights_input, dtype, scope="sentenc
     with tf.name_scope(scope):
         return tf.contrib.seq2seq.sequence_loss(x_reconstr_mean, x_input, tf.cast( weights_input, dtype) )
                     
+def sampled_sentence_loss(decoder_hidden, W_proj, b_proj, x_input, weights_input, num_sampled, data_dim, dtype, scope="sampled_sentence_loss"):
+    """
+    Sampled softmax approximation of sentence_loss: the logits are computed for the target and num_sampled symbols only,
+    instead of the full projection over data_dim symbols. Only used for training.
+    Args:
+        decoder_hidden (Tensor): outputs of the decoder RNN before the projection layer (batch_len x None x state_size)
+        W_proj (tf.Variable): float32 weights of the projection layer (data_dim x state_size). Only the rows of the target
+            and sampled symbols are gathered, thus the gradient is sparse
+        b_proj (tf.Variable): float32 biases of the projection layer
+        x_input (Tensor): model input (batch_len x None)
+        weights_input (Tensor): model input weights (batch_len x None)
+        num_sampled (Natural Integer): number of sampled classes
+        data_dim (Natural Integer): dimension of the data (number of classes)
+        dtype (string): dtype
+        scope (string): scope name
+    Returns:
+        Reconstruction loss averaged over the non padded elements
+    """
+    with tf.name_scope(scope):
+        state_size = int(W_proj.shape[1])
+        flat_hidden = tf.cast(tf.reshape(decoder_hidden, (-1, state_size)), tf.float32)
+        labels = tf.reshape(tf.cast(x_input, tf.int64), (-1, 1))
+        weights = tf.cast(tf.reshape(weights_input, (-1,)), tf.float32)
+        losses = tf.nn.sampled_softmax_loss(W_proj, b_proj, labels, flat_hidden, num_sampled, data_dim)
+        return tf.reduce_sum(losses * weights) / (tf.reduce_sum(weights) + 1e-12)
+                    
 def latent_loss_function(z_ls2, z_mu, scope="latent_loss"):
     """
     Latent loss. Acts as a regularization and shape the prior distribution as normal distribution N(0,1). This is used to limit the capacity of the latent distribution and push the model to optimize its content by placing similar items close to another.
@@ -579,7 +1067,7 @@ def latent_loss_function(z_ls2, z_mu, scope="latent_loss"):
     with tf.name_scope(scope):
         return -0.5 * tf.reduce_sum(1 + z_ls2 - tf.square(z_mu) - tf.exp(z_ls2), 1)
         
-def loss_function(x_reconstr_mean, x_input, weights_input,z_ls2, z_mu, B, latent_loss_weight, dtype, scope="loss"):
+def loss_function(x_reconstr_mean, x_input, weights_input,z_ls2, z_mu, B, latent_loss_weight, dtype, reconstruction_loss=None, summaries=True, scope="loss"):
     """
     Loss function of the VRAE model: reconstruction loss + Beta * latent_loss_weight * latent_loss.
     Args:
@@ -591,14 +1079,17 @@ def loss_function(x_reconstr_mean, x_input, weights_input,z_ls2, z_mu, B, latent
         z_mu (Tensor): value of mu, a parameter which controls the prior distribution
         B (Placeholder): value of Beta used for the deterministic warm-up
         latent_loss_weight (float): weight used to weaken the latent_loss and help the model to optimize the reconstruction
-        dtype (string): dtype
+        dtype (string): dtype of the model outputs, the loss is always computed in float32
+        reconstruction_loss (Tensor): reconstruction loss to use instead of sentence_loss (e.g. sampled_sentence_loss)
+        summaries (boolean): add summaries
         scope (string): scope name
     Returns:
         loss of the VRAE model 
     """
     with tf.name_scope(scope):
-        reconstruction_loss = sentence_loss(x_reconstr_mean, x_input, weights_input, dtype)
-        latent_loss = latent_loss_function(z_ls2, z_mu) # L2 regularization
+        if reconstruction_loss is None:
+            reconstruction_loss = sentence_loss(tf.cast(x_reconstr_mean, tf.float32), x_input, weights_input, tf.float32)
+        latent_loss = latent_loss_function(tf.cast(z_ls2, tf.float32), tf.cast(z_mu, tf.float32)) # L2 regularization
         #l2 = 0.00001 * sum(
         #    tf.nn.l2_loss(tf_var)
         #        for tf_var in tf.trainable_variables()
@@ -606,21 +1097,98 @@ def loss_function(x_reconstr_mean, x_input, weights_input,z_ls2, z_mu, B, latent
         #)
         loss = tf.reduce_mean(reconstruction_loss + B * latent_loss_weight * latent_loss )
         # summaries
-        tf.summary.scalar("reconstruction_loss", reconstruction_loss)
-        tf.summary.scalar("latent_loss", tf.reduce_mean(latent_loss) )
-        tf.summary.scalar("loss", loss)
+        if summaries:
+            tf.summary.scalar("reconstruction_loss", reconstruction_loss)
+            tf.summary.scalar("latent_loss", tf.reduce_mean(latent_loss) )
+            tf.summary.scalar("loss", loss)
         return loss, reconstruction_loss, latent_loss
                     
-def optimizationOperation(cost, learning_rate, scope="training_step"):
+def accumulationOperations(cost, learning_rate, accumulation_steps, optimizer=None, global_step=None, device=None, scope="training_step"):
+    """
+    Gradient accumulation: the gradients of accumulation_steps micro-batches are averaged in local variables before one update.
+    The accumulators are not saved in the checkpoints and must be initialized with tf.local_variables_initializer()
+    Args:
+        cost: loss function
+        learning_rate (float or placeholder): learning rate
+        accumulation_steps (Natural Integer): number of micro-batches per update
+        optimizer (tf.train.Optimizer): optimizer (Adam with learning_rate if None)
+        global_step (tf.Variable): global step incremented by the update
+        device (string): device of the accumulators (data-parallel training: the worker, each worker accumulates its own gradients)
+    Returns:
+        a tuple accumulate, apply, reset
+            accumulate: op adding the gradients of the current micro-batch
+            apply: op updating the variables with the accumulated gradients and resetting the accumulators
+            reset: op resetting the accumulators
+    """
+    with tf.variable_scope(tf.get_variable_scope(), reuse=False):
+        with tf.name_scope('train_step'):
+            if optimizer is None:
+                optimizer = tf.train.AdamOptimizer(learning_rate)
+            grads_and_vars = [ (grad, var) for grad, var in optimizer.compute_gradients(cost) if grad is not None ]
+            with tf.name_scope("gradient_accumulation"):
+                with tf.device(device):
+                    accumulators = [ tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False, 
+                                                 collections=[tf.GraphKeys.LOCAL_VARIABLES], name="accumulator") 
+                                     for _, var in grads_and_vars ]
+                accumulate_ops = []
+                for accumulator, (grad, _) in zip(accumulators, grads_and_vars):
+                    if isinstance(grad, tf.IndexedSlices):
+                        accumulate_ops.append( tf.scatter_add(accumulator, grad.indices, grad.values / accumulation_steps) )
+                    else:
+                        accumulate_ops.append( accumulator.assign_add(grad / accumulation_steps) )
+                accumulate = tf.group(*accumulate_ops)
+                reset = tf.group(*[ accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators ])
+            apply_gradients = optimizer.apply_gradients([ (accumulator.read_value(), var) for accumulator, (_, var) in zip(accumulators, grads_and_vars) ], 
+                                                        global_step=global_step)
+            with tf.control_dependencies([apply_gradients]):
+                apply_and_reset = tf.group(*[ accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators ])
+            return accumulate, apply_and_reset, reset
+
+def optimizationOperation(cost, learning_rate, loss_scaling=False, initial_loss_scale=2.**15, loss_scale_period=2000, optimizer=None, global_step=None, scope="training_step"):
     """
     optimizationStep
     Args:
         cost: loss function
         learning_rate (float or placeholder): learning rate
+        loss_scaling (bool): dynamic loss scaling for float16 gradients. The loss is multiplied by the loss scale before 
+            computing the gradients. If a gradient is not finite, the update is skipped and the loss scale is halved,
+            it is doubled after loss_scale_period steps without overflow.
+        initial_loss_scale (float): initial loss scale
+        loss_scale_period (Natural Integer): number of steps without overflow before increasing the loss scale
+        optimizer (tf.train.Optimizer): optimizer (Adam with learning_rate if None)
+        global_step (tf.Variable): global step incremented by the update
     Returns:
         Tensorflow optimizer
     """
     with tf.variable_scope(tf.get_variable_scope(), reuse=False):
         with tf.name_scope('train_step'):
-            return tf.train.AdamOptimizer(learning_rate).minimize(cost)
+            if optimizer is None:
+                optimizer = tf.train.AdamOptimizer(learning_rate)
+            if not loss_scaling:
+                return optimizer.minimize(cost, global_step=global_step)
+            with tf.variable_scope("loss_scaling"):
+                loss_scale = tf.get_variable("loss_scale", [], tf.float32, initializer=tf.constant_initializer(initial_loss_scale), trainable=False)
+                good_steps = tf.get_variable("good_steps", [], tf.int32, initializer=tf.zeros_initializer(), trainable=False)
+                overflows = tf.get_variable("overflows", [], tf.int32, initializer=tf.zeros_initializer(), trainable=False)
+            grads_and_vars = []
+            for grad, var in optimizer.compute_gradients(cost * loss_scale):
+                if isinstance(grad, tf.IndexedSlices):
+                    grad = tf.IndexedSlices(grad.values / loss_scale, grad.indices, grad.dense_shape)
+                elif grad is not None:
+                    grad = grad / loss_scale
+                grads_and_vars.append((grad, var))
+            is_finite = tf.reduce_all([ tf.reduce_all(tf.is_finite(grad.values if isinstance(grad, tf.IndexedSlices) else grad)) 
+                                       for grad, _ in grads_and_vars if grad is not None ])
+            apply_gradients = tf.cond(is_finite, lambda: optimizer.apply_gradients(grads_and_vars, global_step=global_step), tf.no_op)
+            def overflow():
+                return tf.group(loss_scale.assign(tf.maximum(loss_scale / 2, 1.)), good_steps.assign(0), overflows.assign_add(1))
+            def no_overflow():
+                increase = good_steps + 1 >= loss_scale_period
+                return tf.group(loss_scale.assign(tf.where(increase, loss_scale * 2, loss_scale)),
+                                good_steps.assign(tf.where(increase, 0, good_steps + 1)))
+            update_loss_scale = tf.cond(is_finite, no_overflow, overflow)
+            # summaries
+            tf.summary.scalar("loss_scale", loss_scale)
+            tf.summary.scalar("overflows", overflows)
+            return tf.group(apply_gradients, update_loss_scale)
         
\ No newline at end of file
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+"""
+Local HTTP inference server for a trained VRAE model. Concurrent requests are coalesced into micro-batches:
+a worker thread waits for requests during at most max_wait seconds (or until max_batch_size sentences are
+queued) and processes them with a single session run.
+
+Endpoints (POST, json):
+    /encode       {"sentences": ["..."], "sentiments": [[neg, neu, pos]] (optional)}  -> {"z": [[...]]}
+    /decode       {"z": [[...]], "length": 100}                                       -> {"sentences": ["..."]}
+    /reconstruct  {"sentences": ["..."], "length": 100 (optional)}                    -> {"sentences": ["..."]}
+    /interpolate  {"start": "...", "end": "...", "steps": 10, "length": 100, "method": "linear" or "spherical"}
+                                                                                      -> {"sentences": ["..."]}
+
+Usage: python server.py --training_dir no_char2word --port 8000
+       python server.py --export_dir export/no_char2word --port 8000
+
+__author__ = "Valentin Lievin, DTU, Denmark"
+__copyright__ = "Copyright 2017, Valentin Lievin"
+__credits__ = ["Valentin Lievin"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Valentin Lievin"
+__email__ = "valentin.lievin@gmail.com"
+__status__ = "Development"
+"""
+
+import sys
+import json
+import time
+import threading
+import numpy as np
+from six import reraise, string_types
+from six.moves import queue
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from data_utils_LMR import GO_ID, EOS_ID, sentiment_features
+from model import encode_batch, decode_batch
+from interpolation import interpolation_paths
+
+
+class _Request:
+    """
+    a request waiting in a BatchingQueue: a list of items and the corresponding results once processed
+    """
+    def __init__(self, items):
+        self.items = items
+        self.results = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class BatchingQueue:
+    """
+    Coalesce the items submitted by concurrent threads into batches processed by a single worker thread.
+    A batch is processed as soon as max_batch_size items are queued or max_wait seconds after its first request.
+    """
+    def __init__(self, process, max_batch_size=256, max_wait=0.005):
+        """
+        Args:
+            process (function): list of items -> list of results (same length and order)
+            max_batch_size (Natural Integer): maximum number of items per batch (larger requests are processed alone)
+            max_wait (float): maximum time a request waits for other requests, in seconds
+        """
+        self.process = process
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.pending = None
+        self.batch_sizes = []
+        self.thread = threading.Thread(target=self._worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, items):
+        """
+        Process a list of items (blocks until they are processed)
+        Returns:
+            the list of results
+        """
+        request = _Request(list(items))
+        self.queue.put(request)
+        request.done.wait()
+        if request.exc_info is not None:
+            reraise(*request.exc_info)
+        return request.results
+
+    def _next_batch(self):
+        """
+        wait for a first request, then gather the requests arriving before the deadline
+        """
+        requests = [self.pending if self.pending is not None else self.queue.get()]
+        self.pending = None
+        n_items = len(requests[0].items)
+        deadline = time.time() + self.max_wait
+        while n_items < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if n_items + len(request.items) > self.max_batch_size:
+                # first request of the next batch
+                self.pending = request
+                break
+            requests.append(request)
+            n_items += len(request.items)
+        return requests
+
+    def _worker(self):
+        while True:
+            requests = self._next_batch()
+            items = [ item for request in requests for item in request.items ]
+            self.batch_sizes.append(len(items))
+            try:
+                results = self.process(items)
+                start = 0
+                for request in requests:
+                    request.results = results[start : start + len(request.items)]
+                    start += len(request.items)
+            except Exception:
+                for request in requests:
+                    request.exc_info = sys.exc_info()
+            for request in requests:
+                request.done.set()
+
+
+def check_sentences(sentences):
+    """
+    Raise a ValueError if sentences is not a list of strings
+    """
+    if not isinstance(sentences, list) or not all( isinstance(s, string_types) for s in sentences ):
+        raise ValueError("sentences must be a list of strings")
+
+
+class VraeService:
+    """
+    Encode and decode sentences with a trained model, the calls of concurrent threads are batched
+    """
+    def __init__(self, sess, model, encoder_decoder, word_delimiters=(), max_batch_size=256, max_wait=0.005, use_sentiment_feature=True):
+        """
+        Args:
+            sess: Tensorflow session with the trained variables
+            model: Vrae or inference.InferenceModel
+            encoder_decoder (data_utils_LMR.EncoderDecoder): vocabulary
+            word_delimiters (list of Natural Integers): symbols corresponding to spaces (char2word encoder)
+            max_batch_size (Natural Integer): maximum number of sentences per session run
+            max_wait (float): maximum time a request waits for other requests, in seconds
+            use_sentiment_feature (boolean): the model uses the sentiment feature, the VADER features of the sentences
+                are computed when they are not given
+        """
+        self.sess = sess
+        self.model = model
+        self.encoder_decoder = encoder_decoder
+        self.word_delimiters = word_delimiters
+        self.use_sentiment_feature = use_sentiment_feature
+        self.latent_dim = model.z_mu.get_shape().as_list()[-1]
+        self.encoder = BatchingQueue(self._encode, max_batch_size, max_wait)
+        self.decoder = BatchingQueue(self._decode, max_batch_size, max_wait)
+
+    def _encode(self, items):
+        """
+        items: (ids, sentiment) -> z_mu
+        """
+        seqs, sentiments = zip(*items)
+        return list(encode_batch(self.sess, self.model, list(seqs), np.array(sentiments), self.word_delimiters, len(items)))
+
+    def _decode(self, items):
+        """
+        items: (z, length) -> ids. The batch is decoded up to the longest requested length
+        """
+        z_samples, lengths = zip(*items)
+        ids = decode_batch(self.sess, self.model, np.array(z_samples), max(lengths), len(items), ids=True)
+        return [ row[:length] for row, length in zip(ids, lengths) ]
+
+    def _encode_seqs(self, seqs, sentiments):
+        """
+        Encode sequences of ids. The inputs are validated before being submitted, so that a malformed request
+        raises a ValueError in its own thread instead of failing the whole batch
+        """
+        if sentiments is None and self.use_sentiment_feature:
+            # as for the training corpus
+            sentiments = sentiment_features(self.encoder_decoder, seqs)
+        elif sentiments is None:
+            sentiments = np.zeros((len(seqs), 3))
+        sentiments = np.asarray(sentiments, dtype=np.float32)
+        if sentiments.shape != (len(seqs), 3):
+            raise ValueError("expected sentiments of shape (%d, 3), got %s" % (len(seqs), sentiments.shape))
+        return np.array(self.encoder.submit(zip(seqs, sentiments)))
+
+    def encode(self, sentences, sentiments=None):
+        """
+        Returns:
+            numpy array of z_mu (len(sentences) x latent_dim)
+        """
+        check_sentences(sentences)
+        return self._encode_seqs(self.encoder_decoder.encodeBatch(sentences), sentiments)
+
+    def decode(self, z_samples, length):
+        """
+        Returns:
+            list of decoded sentences
+        """
+        z_samples = np.asarray(z_samples, dtype=np.float32)
+        if z_samples.ndim != 2 or z_samples.shape[1] != self.latent_dim:
+            raise ValueError("expected z of shape (n, %d), got %s" % (self.latent_dim, z_samples.shape))
+        if length <= 0:
+            raise ValueError("length must be positive")
+        return self.encoder_decoder.prettyDecodeBatch(self.decoder.submit([ (z, length) for z in z_samples ]))
+
+    def reconstruct(self, sentences, length=None, sentiments=None):
+        """
+        Encode and decode sentences (by default up to twice the length of the longest input)
+        Returns:
+            list of decoded sentences
+        """
+        check_sentences(sentences)
+        seqs = self.encoder_decoder.encodeBatch(sentences)
+        if length is None:
+            length = 2 * max( [ len(seq) for seq in seqs ] + [1] )
+        return self.decode(self._encode_seqs(seqs, sentiments), int(length))
+
+    def interpolate(self, start, end, steps, length, method='linear'):
+        """
+        Decode the points of the path between the latent representations of two sentences
+        (method: 'linear' or 'spherical', see interpolation.interpolation_paths)
+        Returns:
+            list of steps decoded sentences
+        """
+        z_start, z_end = self.encode([start, end])
+        return self.decode(interpolation_paths(z_start, z_end, steps, method)[0], length)
+
+
+def make_handler(service):
+    """
+    HTTP request handler calling a VraeService
+    """
+    endpoints = {
+        '/encode': lambda r: {'z': service.encode(r['sentences'], r.get('sentiments')).tolist()},
+        '/decode': lambda r: {'sentences': service.decode(np.array(r['z']), int(r.get('length', 100)))},
+        '/reconstruct': lambda r: {'sentences': service.reconstruct(r['sentences'], r.get('length'), r.get('sentiments'))},
+        '/interpolate': lambda r: {'sentences': service.interpolate(r['start'], r['end'], int(r.get('steps', 10)), int(r.get('length', 100)),
+                                                                   r.get('method', 'linear'))},
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if self.path not in endpoints:
+                return self.reply(404, {'error': 'unknown endpoint %s' % self.path})
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            except ValueError as e:
+                return self.reply(400, {'error': 'invalid json: %s' % e})
+            try:
+                response = endpoints[self.path](request)
+            except (KeyError, TypeError, ValueError) as e:
+                return self.reply(400, {'error': repr(e)})
+            except Exception as e:
+                return self.reply(500, {'error': repr(e)})
+            self.reply(200, response)
+
+        def reply(self, code, response):
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    one thread per connection, so that concurrent requests can be batched
+    """
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    import tensorflow as tf
+    from data_utils_LMR import EncoderDecoder
+
+    tf.app.flags.DEFINE_string("training_dir", "sentiment_input", "repertory where checkpoints are logs are saved")
+    tf.app.flags.DEFINE_string("export_dir", "", "directory of an exported inference graph (used instead of the checkpoints if set)")
+    tf.app.flags.DEFINE_string("host", "127.0.0.1", "interface the server listens to")
+    tf.app.flags.DEFINE_integer("port", 8000, "port the server listens to")
+    tf.app.flags.DEFINE_integer("max_batch_size", 256, "maximum number of sentences per session run")
+    tf.app.flags.DEFINE_float("max_wait_ms", 5., "maximum time a request waits to be batched with other requests (ms)")
+    FLAGS = tf.app.flags.FLAGS
+    training_dir = "logs/" + FLAGS.training_dir
+
+    def string2bool(st):
+        return st.lower() == "true"
+
+    encoder_decoder = EncoderDecoder()
+    with open(training_dir +'/flags.json', 'r') as fp:
+        training_flags = json.loads( fp.read() )
+    word_delimiters = [ EOS_ID, GO_ID, encoder_decoder.space_symbol ] if string2bool(training_flags['use_char2word']) else ()
+    if FLAGS.export_dir:
+        from inference import InferenceModel
+        model = InferenceModel(FLAGS.export_dir)
+        sess = model.sess
+    else:
+        from model import Vrae as Vrae_model
+        model = Vrae_model(char2word_state_size = int(training_flags['char2word_state_size']),
+                           char2word_num_layers = int(training_flags['char2word_num_layers']),
+                           encoder_state_size = int(training_flags['encoder_state_size']),
+                           encoder_num_layers = int(training_flags['encoder_num_layers']),
+                           decoder_state_size = int(training_flags['decoder_state_size']),
+                           decoder_num_layers = int(training_flags['decoder_num_layers']),
+                           latent_dim = int(training_flags['latent_dim']),
+                           batch_size = int(training_flags['batch_size']),
+                           num_symbols = encoder_decoder.vocabularySize(),
+                           input_keep_prob = float(training_flags['input_keep_prob']),
+                           output_keep_prob = float(training_flags['output_keep_prob']),
+                           latent_loss_weight = float(training_flags['latent_loss_weight']),
+                           dtype_precision = int(training_flags['dtype_precision']),
+                           cell_type = training_flags['cell'],
+                           peephole = False,
+                           sentiment_feature = string2bool(training_flags['use_sentiment_feature']),
+                           use_char2word = string2bool(training_flags['use_char2word']),
+                           embedding_dim = int(training_flags.get('embedding_dim', 0)))
+        sess = tf.Session()
+        tf.train.Saver().restore(sess, tf.train.latest_checkpoint(training_dir))
+    service = VraeService(sess, model, encoder_decoder, word_delimiters, FLAGS.max_batch_size, FLAGS.max_wait_ms / 1000.,
+                          use_sentiment_feature=string2bool(training_flags['use_sentiment_feature']))
+    server = ThreadedHTTPServer((FLAGS.host, FLAGS.port), make_handler(service))
+    print("serving on http://%s:%d" % (FLAGS.host, FLAGS.port))
+    server.serve_forever()
@@ -22,18 +22,13 @@ import datetime
 import json
 import os
 import data_utils_LMR
+import data_utils_WMT
 from data_utils_LMR import prepare_data,read_data, EncoderDecoder
 from model import Vrae as Vrae_model
-from training_utilities import BetaGenerator, LearningRateControler
-from batch import Generator
-
-# sentiment analyzer
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-sentimentAnalyzer = SentimentIntensityAnalyzer()
-def getSentimentScore(sentence):
-    scores = sentimentAnalyzer.polarity_scores(sentence)
-    return (scores['neg'], scores['neu'] ,scores['pos'])
-
+from training_utilities import BetaGenerator, LearningRateControler, AsyncCheckpointer, TrainingMonitor, write_trace
+from batch import Generator, StreamGenerator, Prefetcher
+from input_pipeline import DatasetInput
+import itertools
 
 # flags
 tf.app.flags.DEFINE_integer( "char2word_state_size", 256, "char2word hidden state size ")
@@ -45,7 +40,22 @@ tf.app.flags.DEFINE_integer("decoder_state_size", 1024, "state size for the RNN
 tf.app.flags.DEFINE_integer("decoder_num_layers", 2, "number of layers used in the RNN cells (decoder)")
 tf.app.flags.DEFINE_float("learning_rate_change_rate", 3000, "after a changement of hyper-parameters during training, the learning rate stays fixed during this number of steps.")
 tf.app.flags.DEFINE_integer("latent_dim", 16, "dimension of the latent space")
+tf.app.flags.DEFINE_integer("embedding_dim", 0, "dimension of the symbol embeddings (0: one-hot inputs)")
+tf.app.flags.DEFINE_integer("sampled_softmax", 0, "number of sampled classes for the sampled softmax training loss (0: full softmax)")
 tf.app.flags.DEFINE_integer("batch_size", 800, "length of each batch")
+tf.app.flags.DEFINE_integer("accumulation_steps", 1, "number of micro-batches per update: the gradients of batch_size/accumulation_steps sentences are accumulated")
+tf.app.flags.DEFINE_integer("sort_chunk", 0, "number of batches sorted by length together to reduce padding (0: no length bucketing)")
+tf.app.flags.DEFINE_integer("prefetch_batches", 4, "number of batches prepared in advance in a background thread")
+tf.app.flags.DEFINE_boolean("tf_data", False, "read the batches from a tf.data pipeline instead of feed_dict")
+tf.app.flags.DEFINE_integer("bucket_width", 0, "tf_data only: batch together sentences of lengths in the same bucket of this width (0: no bucketing)")
+tf.app.flags.DEFINE_integer("summary_steps", 10, "summaries are computed and written every summary_steps steps")
+tf.app.flags.DEFINE_integer("max_checkpoints", 5, "number of checkpoints kept")
+tf.app.flags.DEFINE_integer("metrics_steps", 100, "throughput and phase timings are exported every metrics_steps steps (metrics.jsonl and summaries)")
+tf.app.flags.DEFINE_string("trace_steps", "", "comma-separated list of steps traced and written as Chrome traces (timeline_<step>.json)")
+tf.app.flags.DEFINE_integer("seed", None, "seed used to shuffle the data")
+tf.app.flags.DEFINE_boolean("incremental_data", False, "only preprocess new or modified reviews, appended to a single corpus with a recorded train/test split")
+tf.app.flags.DEFINE_boolean("wmt_stream", False, "train on the WMT sentences streamed from disk instead of loading the movie reviews in memory (no ratings nor sentiment features)")
+tf.app.flags.DEFINE_integer("shuffle_buffer", 100000, "wmt_stream only: number of sentences in the shuffling buffer (0: no shuffling)")
 tf.app.flags.DEFINE_integer("sequence_min", 8, "minimum number of characters")
 tf.app.flags.DEFINE_integer("sequence_max", 35, "maximum number of characters")
 tf.app.flags.DEFINE_integer("epoches", 10000, "Number of epoches")
@@ -60,11 +70,38 @@ tf.app.flags.DEFINE_boolean("use_sentiment_feature", True, "Input sentiment feat
 tf.app.flags.DEFINE_boolean("use_char2word", False, "Use the char2word layer in the encoder")
 tf.app.flags.DEFINE_boolean("teacher_forcing", True, "Teacher forcing increases short term accuracy but penalizes long term gradient probagation.")
 tf.app.flags.DEFINE_float("latent_loss_weight", 0.1, "weight used to weaken the latent loss.")
-tf.app.flags.DEFINE_integer("dtype_precision", 32, "dtype to be used: typically 32 or 16")
+tf.app.flags.DEFINE_integer("dtype_precision", 32, "dtype to be used: 32, or 16 for mixed precision training (float32 weights, float16 activations, dynamic loss scaling)")
 tf.app.flags.DEFINE_boolean("initialize", False, "Initialize model or try to load existing one")
 tf.app.flags.DEFINE_string("training_dir" , "sentiment_input", "repertory where checkpoints are logs are saved")
+tf.app.flags.DEFINE_string("ps_hosts", "", "data-parallel training: comma-separated list of parameter servers (e.g. localhost:2222)")
+tf.app.flags.DEFINE_string("worker_hosts", "", "data-parallel training: comma-separated list of workers (e.g. localhost:2223,localhost:2224)")
+tf.app.flags.DEFINE_string("job_name", "worker", "data-parallel training: ps or worker")
+tf.app.flags.DEFINE_integer("task_index", 0, "data-parallel training: index of the task in its job, the worker 0 is the chief")
 FLAGS = tf.app.flags.FLAGS
 
+# data-parallel training: between-graph replication, the variables are stored on the parameter servers
+# and the gradients of the workers are averaged before each update
+distributed = FLAGS.worker_hosts != ""
+if distributed:
+    cluster = tf.train.ClusterSpec({"ps": FLAGS.ps_hosts.split(","), "worker": FLAGS.worker_hosts.split(",")})
+    server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index)
+    if FLAGS.job_name == "ps":
+        server.join()
+    num_workers = len(FLAGS.worker_hosts.split(","))
+    is_chief = FLAGS.task_index == 0
+    worker_device = "/job:worker/task:%d" % FLAGS.task_index
+    device_setter = tf.train.replica_device_setter(worker_device=worker_device, cluster=cluster)
+    if FLAGS.seed is None:
+        FLAGS.seed = 42 # the workers shuffle the data identically and take turns on the batches
+    print "data-parallel training: the maximum sentence length is fixed (no curriculum on the sentences size)"
+else:
+    num_workers = 1
+    is_chief = True
+    worker_device = None
+    device_setter = None
+if FLAGS.wmt_stream and (FLAGS.tf_data or FLAGS.incremental_data or distributed):
+    raise ValueError("wmt_stream is only supported by the feed_dict pipeline on a single worker")
+
 if FLAGS.training_dir == "auto":
     FLAGS.training_dir = "logs/state"+str(FLAGS.state_size)+"_layers"+str(FLAGS.num_layers)+"_latent"+str(FLAGS.latent_dim)+"_batch"+str(FLAGS.batch_size)+"_"+str(FLAGS.cell)+"_seqs"+str(FLAGS.sequence_min)+"-"+str(FLAGS.sequence_max)+"_"+str(FLAGS.initial_learning_rate)[-1]+"e"+str(int(np.log10(FLAGS.initial_learning_rate)))+"_B"+str(FLAGS.latent_loss_weight)+"_f"+str(FLAGS.dtype_precision)
 else:
@@ -79,7 +116,7 @@ training_parameters = dict()
 if FLAGS.initialize:
     #print "||" + str(os.listdir(FLAGS.training_dir))
     print "Checkin in: " + str(FLAGS.training_dir)
-    assert not os.path.isdir(FLAGS.training_dir) or len(os.listdir(FLAGS.training_dir)) == 0
+    assert not is_chief or not os.path.isdir(FLAGS.training_dir) or len(os.listdir(FLAGS.training_dir)) == 0
     print "logging in: " + str(FLAGS.training_dir)
     training_parameters['step'] = 0
     training_parameters['epoch'] = 0
@@ -102,21 +139,46 @@ if not os.path.exists(FLAGS.training_dir):
 flags = dict()
 for k,v in FLAGS.__dict__['__flags'].iteritems():
     flags[k] = str(v)
-with open(FLAGS.training_dir +'/flags.json', 'w') as fp:
-    json.dump( flags , fp)
+if is_chief:
+    with open(FLAGS.training_dir +'/flags.json', 'w') as fp:
+        json.dump( flags , fp)
     
-prepare_data(1000)
+def stream_generator(seq_max):
+    """
+    return a batch generator streaming the WMT sentences of at most seq_max symbols
+    """
+    stream_fn = lambda: data_utils_WMT.stream_data(max_sentence_size=seq_max, min_sentence_size=FLAGS.sequence_min)
+    return StreamGenerator(stream_fn, FLAGS.batch_size, word_delimiters, shuffle_buffer=FLAGS.shuffle_buffer, seed=FLAGS.seed)
 
-sentences, ratings = read_data( max_size=None, max_sentence_size=training_parameters['seq_max'],min_sentence_size=FLAGS.sequence_min) 
-print len(sentences), " sentences"
+# the data and the sentiment features are prepared once, by the chief in data-parallel mode
+if FLAGS.wmt_stream:
+    # the sentences are read from disk at each epoch
+    data_utils_WMT.prepare_data(1000)
+elif is_chief:
+    prepare_data(1000, incremental=FLAGS.incremental_data)
+while not FLAGS.wmt_stream:
+    try:
+        sentences, ratings, sentiments = read_data( max_size=None, max_sentence_size=training_parameters['seq_max'],min_sentence_size=FLAGS.sequence_min, sentiments=True,
+                                                    incremental=FLAGS.incremental_data) 
+        break
+    except ValueError:
+        if is_chief:
+            raise
+        print "waiting for the chief to prepare the data.."
+        time.sleep(10)
 
 # vocabulary encoder-decoder
-encoderDecoder = EncoderDecoder()
+encoderDecoder = data_utils_WMT.EncoderDecoder() if FLAGS.wmt_stream else EncoderDecoder()
 num_symbols = encoderDecoder.vocabularySize()
 # batch generator
-space_symbol = encoderDecoder.encode("I am")[1]
+space_symbol = encoderDecoder.space_symbol
 word_delimiters = [ data_utils_LMR._EOS, data_utils_LMR._GO, space_symbol ]
-batch_gen = Generator(sentences, ratings, FLAGS.batch_size, word_delimiters)
+if FLAGS.wmt_stream:
+    batch_gen = stream_generator(training_parameters['seq_max'])
+else:
+    print len(sentences), " sentences"
+    batch_gen = Generator(sentences, ratings, FLAGS.batch_size, word_delimiters, sort_chunk=FLAGS.sort_chunk, seed=FLAGS.seed, sentiments=sentiments,
+                        num_shards=num_workers, shard_index=FLAGS.task_index)
 #sentences = [ [1,2,3,0,1,4,5,0] , [1,2,3,0,1,4,5,0] , [1,2,3,0,1,4,5,0] ]
 #ratings = [1,2,3]
 #batch_gen = Generator(sentences, ratings, 3, 0)
@@ -127,7 +189,7 @@ beta_T = FLAGS.beta_period*batch_gen.iterations_per_epoch()
 beta_u = FLAGS.beta_offset*batch_gen.iterations_per_epoch()
 betaGenerator = BetaGenerator(num_iters, beta_T, beta_u)
 # text decoder ( text <-> ids)
-encoderDecoder = EncoderDecoder()
+encoderDecoder = data_utils_WMT.EncoderDecoder() if FLAGS.wmt_stream else EncoderDecoder()
 # learning rate
 learningRateControler = LearningRateControler(training_parameters['learning_rate'], FLAGS.learning_rate_change_rate, 0.5)
 
@@ -148,8 +210,19 @@ vrae_model = Vrae_model(char2word_state_size = FLAGS.char2word_state_size,
                      cell_type = FLAGS.cell, 
                      peephole = False, 
                      sentiment_feature = FLAGS.use_sentiment_feature,
-                     teacher_forcing=True,
-                     use_char2word = FLAGS.use_char2word)
+                     teacher_forcing=FLAGS.teacher_forcing,
+                     use_char2word = FLAGS.use_char2word,
+                     embedding_dim = FLAGS.embedding_dim,
+                     sampled_softmax = FLAGS.sampled_softmax,
+                     dataset_input = FLAGS.tf_data,
+                     device_setter = device_setter,
+                     num_replicas = num_workers,
+                     worker_device = worker_device,
+                     accumulation_steps = FLAGS.accumulation_steps)
+if FLAGS.tf_data:
+    # with gradient accumulation, the model reads accumulation_steps micro-batches per update
+    dataset_input = DatasetInput(FLAGS.batch_size // FLAGS.accumulation_steps, word_delimiters, bucket_width=FLAGS.bucket_width, prefetch=FLAGS.prefetch_batches,
+                                 num_shards=num_workers, shard_index=FLAGS.task_index)
 
 config = tf.ConfigProto(
         #device_count = {'GPU': 0},
@@ -163,60 +236,169 @@ config = tf.ConfigProto(
 start = time.time()
 saver = tf.train.Saver()
 init_op = tf.global_variables_initializer()
+local_init_op = tf.local_variables_initializer()   # gradient accumulators (not saved in the checkpoints)
+ready_op = tf.report_uninitialized_variables()
 checkpoint_path = FLAGS.training_dir + '/model.ckp'
+checkpointer = AsyncCheckpointer(checkpoint_path, max_to_keep=FLAGS.max_checkpoints)
+
+def create_session():
+    """
+    create the training session: initialize the model or restore it from the last checkpoint.
+    In data-parallel mode, the chief initializes the shared variables and the other workers wait for it.
+    """
+    checkpoint = None if FLAGS.initialize else tf.train.latest_checkpoint(FLAGS.training_dir)
+    if not distributed:
+        sess = tf.Session(config=config)
+        if checkpoint is None:
+            sess.run(init_op)
+        else:
+            saver.restore(sess, checkpoint)
+        sess.run(local_init_op)
+        return sess
+    sync_optimizer = vrae_model.sync_optimizer
+    session_manager = tf.train.SessionManager(local_init_op=tf.group(sync_optimizer.chief_init_op if is_chief else sync_optimizer.local_step_init_op,
+                                                                     local_init_op),
+                                              ready_op=ready_op,
+                                              ready_for_local_init_op=sync_optimizer.ready_for_local_init_op,
+                                              recovery_wait_secs=1)
+    if is_chief:
+        sess = session_manager.prepare_session(server.target, init_op=init_op if checkpoint is None else None, 
+                                               saver=saver, checkpoint_filename_with_path=checkpoint, config=config)
+        vrae_model.assign_learning_rate(sess, learningRateControler.learning_rate)
+        sess.run(sync_optimizer.get_init_tokens_op())
+        sync_optimizer.get_chief_queue_runner().create_threads(sess, daemon=True, start=True)
+    else:
+        sess = session_manager.wait_for_session(server.target, config=config)
+    return sess
+
 try:
-    with tf.Session(config=config) as sess:
-        # summary writer
-        summary_writer = tf.summary.FileWriter(FLAGS.training_dir, sess.graph)
+    with create_session() as sess:
+        # summary writer (only the chief writes summaries and checkpoints)
+        summary_writer = tf.summary.FileWriter(FLAGS.training_dir, sess.graph) if is_chief else None
         # init
         tf.set_random_seed(42)
-        if FLAGS.initialize:
-            sess.run(init_op)
-        else:
-            saver.restore(sess, "./"+FLAGS.training_dir+'/model.ckp')
-        while training_parameters['epoch'] < FLAGS.epoches:
-            batch_gen.shuffle()
-            while not batch_gen.epochCompleted():
-                # get batch
-                padded_batch_xs, batch_ys, batch_lengths, batch_weights, end_of_words, batch_word_lengths, max_length = batch_gen.next_batch()
-                # sentiment batch
-                vaderSentiments = [ getSentimentScore(encoderDecoder.prettyDecode(xx)) for xx in padded_batch_xs]
-                training_parameters['learning_rate'] = learningRateControler.learning_rate
-                beta = 0.001 + betaGenerator(training_parameters['step']) # add small value to avoid points to scatter
-                _,d,loss_reconstruction, loss_regularization, summary,_ = vrae_model.step(sess, 
-                                                                                          padded_batch_xs, 
-                                                                                          beta, 
-                                                                                          training_parameters['learning_rate'], 
-                                                                                          batch_lengths, 
-                                                                                          batch_weights, 
-                                                                                          end_of_words,
-                                                                                          batch_word_lengths,
-                                                                                          training_parameters['epoch'],
-                                                                                         vaderSentiments)
-                if training_parameters['step'] > beta_T+beta_u: 
-                    learningRateControler.update(d)
-                summary_writer.add_summary(summary, global_step=training_parameters['step'])
-                if training_parameters['step'] % 10 == 0:
-                    print("loss: " + str(d) + " | step: " + str(training_parameters['step'])  + " | beta: " + str(beta) + " | learning rate: " + str(learningRateControler.learning_rate) )
-                training_parameters['step'] += 1 
+        # instrumentation
+        metrics_file = '/metrics.jsonl' if is_chief else '/metrics_worker%d.jsonl' % FLAGS.task_index
+        monitor = TrainingMonitor(FLAGS.training_dir + metrics_file, summary_writer)
+        trace_steps = set( int(k) for k in FLAGS.trace_steps.split(",") if k.strip() )
+        if FLAGS.tf_data:
+            # the corpus is copied once into the graph, the epochs only feed the shuffling seed
+            dataset_input.load(sess, sentences, sentiments)
+        try:
+            update_dataset = False
+            while training_parameters['epoch'] < FLAGS.epoches:
+                if FLAGS.tf_data:
+                    # the model reads the batches from the iterator until the end of the epoch
+                    epoch_seed = np.random.randint(2**31) if FLAGS.seed is None else FLAGS.seed + training_parameters['epoch']
+                    batches = itertools.repeat( dataset_input.initialize(sess, epoch_seed) )
+                else:
+                    # batches are prepared in a background thread, sentiments are precomputed in prepare_data
+                    batches = Prefetcher(batch_gen, FLAGS.prefetch_batches)
+                step_end = time.time()
+                for batch in batches:
+                    monitor.add_phase_time('data_wait', time.time() - step_end)
+                    if distributed and is_chief and learningRateControler.learning_rate != training_parameters['learning_rate']:
+                        # the update of the replicas reads the learning rate from a shared variable
+                        vrae_model.assign_learning_rate(sess, learningRateControler.learning_rate)
+                    training_parameters['learning_rate'] = learningRateControler.learning_rate
+                    beta = 0.001 + betaGenerator(training_parameters['step']) # add small value to avoid points to scatter
+                    # the summaries are only evaluated every summary_steps steps
+                    summarize = is_chief and training_parameters['step'] % FLAGS.summary_steps == 0
+                    if training_parameters['step'] in trace_steps:
+                        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+                        run_metadata = tf.RunMetadata()
+                    else:
+                        run_options = None
+                        run_metadata = None
+                    if FLAGS.tf_data:
+                        try:
+                            with monitor.phase('session_run'):
+                                _,d,loss_reconstruction, loss_regularization, summary,_, batch_statistics = vrae_model.dataset_step(sess, batch, beta, 
+                                                                                                                  training_parameters['learning_rate'], 
+                                                                                                                  training_parameters['epoch'],
+                                                                                                                  summarize=summarize,
+                                                                                                                  options=run_options,
+                                                                                                                  run_metadata=run_metadata,
+                                                                                                                  statistics=True)
+                        except tf.errors.OutOfRangeError:
+                            break
+                        # the batches are built in the graph: sentences, real tokens and padded tokens are fetched with the step
+                        monitor.record(*[ int(n) for n in batch_statistics ])
+                    else:
+                        padded_batch_xs, batch_ys, batch_lengths, batch_weights, end_of_words, batch_word_lengths, max_length, vaderSentiments = batch
+                        if vaderSentiments is None:
+                            # the streamed sentences have no sentiment features
+                            vaderSentiments = np.zeros((len(batch_lengths), 3))
+                        with monitor.phase('session_run'):
+                            _,d,loss_reconstruction, loss_regularization, summary,_ = vrae_model.step(sess, 
+                                                                                                      padded_batch_xs, 
+                                                                                                      beta, 
+                                                                                                      training_parameters['learning_rate'], 
+                                                                                                      batch_lengths, 
+                                                                                                      batch_weights, 
+                                                                                                      end_of_words,
+                                                                                                      batch_word_lengths,
+                                                                                                      training_parameters['epoch'],
+                                                                                                     vaderSentiments,
+                                                                                                      summarize=summarize,
+                                                                                                      options=run_options,
+                                                                                                      run_metadata=run_metadata)
+                        monitor.record(len(batch_lengths), int(batch_lengths.sum()), padded_batch_xs.size)
+                    if training_parameters['step'] > beta_T+beta_u: 
+                        learningRateControler.update(d)
+                    if summary is not None:
+                        with monitor.phase('summary_write'):
+                            summary_writer.add_summary(summary, global_step=training_parameters['step'])
+                    if run_metadata is not None:
+                        write_trace(run_metadata, FLAGS.training_dir + '/timeline_%d.json' % training_parameters['step'], summary_writer, training_parameters['step'])
+                    if (training_parameters['step'] + 1) % FLAGS.metrics_steps == 0:
+                        if not FLAGS.tf_data:
+                            # time spent preparing the batches in the background thread
+                            for name, seconds in batches.pop_timings().items():
+                                monitor.add_phase_time(name, seconds)
+                        metrics = monitor.flush(training_parameters['step'])
+                        print("sentences/sec: %.1f | tokens/sec: %.1f | session run: %.3fs/step" % (metrics['sentences_per_sec'], metrics['tokens_per_sec'], metrics['time_session_run']))
+                    if training_parameters['step'] % 10 == 0:
+                        print("loss: " + str(d) + " | step: " + str(training_parameters['step'])  + " | beta: " + str(beta) + " | learning rate: " + str(learningRateControler.learning_rate) )
+                    training_parameters['step'] += 1 
+                    step_end = time.time()
                 
-                # increase sentences size
-                if training_parameters['n_epoches_since_last_dataset_update'] > 10 and loss_reconstruction < FLAGS.acceptable_accuracy and training_parameters['seq_max'] < sequence_max_max:
-                    print "###########################\nUPDATING SENTENCES SIZE"
-                    FLAGS.training_dir + '/model'+str(training_parameters['seq_max'])+'.ckp'
-                    training_parameters['n_epoches_since_last_dataset_update'] = 0
-                    training_parameters['seq_max'] += 1
-                    sentences, ratings = read_data( max_size=None,max_sentence_size=training_parameters['seq_max'],
-                                                   min_sentence_size=FLAGS.sequence_min) 
-                    batch_gen = Generator(sentences, ratings, FLAGS.batch_size,word_delimiters)
-                    learningRateControler.reset()
+                    # increase sentences size. Disabled in data-parallel mode: each worker would decide from its own loss, 
+                    # the workers would then read different corpora and run different numbers of steps per epoch
+                    if not distributed and training_parameters['n_epoches_since_last_dataset_update'] > 10 and loss_reconstruction < FLAGS.acceptable_accuracy and training_parameters['seq_max'] < sequence_max_max:
+                        print "###########################\nUPDATING SENTENCES SIZE"
+                        FLAGS.training_dir + '/model'+str(training_parameters['seq_max'])+'.ckp'
+                        training_parameters['n_epoches_since_last_dataset_update'] = 0
+                        training_parameters['seq_max'] += 1
+                        update_dataset = True
+                        break
             
-            print "saving to", checkpoint_path
-            training_parameters['epoch'] += 1
-            training_parameters['n_epoches_since_last_dataset_update'] += 1
-            checkpoint_path = saver.save(sess, checkpoint_path)
-            with open(FLAGS.training_dir +'/training_parameters.json', 'w') as fp:
-                json.dump( training_parameters , fp)
+                if not FLAGS.tf_data:
+                    print "padding efficiency:", batches.padding_efficiency()
+                    for name, seconds in batches.pop_timings().items():
+                        monitor.add_phase_time(name, seconds)
+                if update_dataset:
+                    # the new dataset is used from the next epoch
+                    update_dataset = False
+                    if FLAGS.wmt_stream:
+                        batch_gen = stream_generator(training_parameters['seq_max'])
+                    else:
+                        sentences, ratings, sentiments = read_data( max_size=None,max_sentence_size=training_parameters['seq_max'],
+                                                       min_sentence_size=FLAGS.sequence_min, sentiments=True, incremental=FLAGS.incremental_data) 
+                        batch_gen = Generator(sentences, ratings, FLAGS.batch_size, word_delimiters, sort_chunk=FLAGS.sort_chunk, seed=FLAGS.seed, sentiments=sentiments,
+                                              num_shards=num_workers, shard_index=FLAGS.task_index)
+                        if FLAGS.tf_data:
+                            dataset_input.load(sess, sentences, sentiments)
+                    learningRateControler.reset()
+                training_parameters['epoch'] += 1
+                training_parameters['n_epoches_since_last_dataset_update'] += 1
+                if is_chief:
+                    # written in the background, training_parameters.json is updated once the checkpoint is complete
+                    print "saving to", checkpoint_path
+                    checkpointer.save(sess, training_parameters['step'], training_parameters, FLAGS.training_dir +'/training_parameters.json')
+        finally:
+            # the session must stay open until the last checkpoint is written
+            checkpointer.wait()
             
         
         
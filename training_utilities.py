@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 """
-function used to control training: deterministic warm-up and learning rate decay
+function used to control training: deterministic warm-up, learning rate decay, checkpointing and instrumentation
 
 __author__ = "Valentin Lievin, DTU, Denmark"
 __copyright__ = "Copyright 2017, Valentin Lievin"
@@ -12,9 +12,18 @@ __email__ = "valentin.lievin@gmail.com"
 __status__ = "Development"
 """  
 
+import os
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 import numpy as np
+import tensorflow as tf
 import scipy.interpolate as si
 from scipy import interpolate
+from six import reraise
 
 
 def BetaGenerator(epoches, beta_decay_period, beta_decay_offset):
@@ -72,4 +81,181 @@ class LearningRateControler:
                     self.learning_rate = self.minimum 
     def reset(self):
         self.runs_since_last_learning_rate_change = 0
-        
\ No newline at end of file
+        
+
+
+def write_json_atomic(path, obj):
+    """
+    write a json file atomically: the data is written to a temporary file which is then renamed
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(obj, fp)
+    os.rename(tmp_path, path)
+
+
+class AsyncCheckpointer:
+    """
+    Write checkpoints from a background thread. The variables are first copied to snapshot variables (a fast in-graph copy),
+    then the snapshot is saved while training continues. Checkpoints are written atomically by the Tensorflow saver 
+    (temporary files renamed when complete) and only the last max_to_keep checkpoints are kept, including the ones
+    written before a restart.
+    """
+    def __init__(self, checkpoint_path, max_to_keep=5, var_list=None):
+        """
+        Build the snapshot operations in the current graph
+        Args:
+            checkpoint_path (string): prefix of the checkpoints (the step is appended)
+            max_to_keep (Natural Integer): number of checkpoints kept
+            var_list (list of tf.Variable): variables to save (all the global variables if None)
+        """
+        if var_list is None:
+            var_list = tf.global_variables()
+        with tf.name_scope("checkpoint_snapshot"):
+            # not added to any collection: not initialized nor saved with the model
+            snapshots = [ tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False, collections=[], name="snapshot") 
+                          for var in var_list ]
+            self.snapshot_op = tf.group(*[ snapshot.assign(var) for snapshot, var in zip(snapshots, var_list) ])
+        # the snapshots are saved under the names of the variables
+        self.saver = tf.train.Saver(dict( (var.op.name, snapshot) for var, snapshot in zip(var_list, snapshots) ), max_to_keep=max_to_keep)
+        # checkpoints of the previous runs, deleted in turn when new checkpoints are written
+        checkpoint_state = tf.train.get_checkpoint_state(os.path.dirname(checkpoint_path))
+        if checkpoint_state is not None:
+            self.saver.recover_last_checkpoints(checkpoint_state.all_model_checkpoint_paths)
+        self.checkpoint_path = checkpoint_path
+        self.last_checkpoint = None
+        self.thread = None
+        self.exc_info = None
+        
+    def save(self, sess, global_step, training_parameters=None, training_parameters_path=None):
+        """
+        Snapshot the variables and write the checkpoint in the background. Waits for the previous checkpoint first.
+        Args:
+            sess: current Tensorflow session
+            global_step (Natural Integer): step appended to the checkpoint name
+            training_parameters (dict): parameters written to training_parameters_path once the checkpoint is written
+            training_parameters_path (string): path of the json file
+        """
+        self.wait()
+        sess.run(self.snapshot_op)
+        if training_parameters is not None:
+            training_parameters = dict(training_parameters)
+        self.thread = threading.Thread(target=self._write, args=(sess, global_step, training_parameters, training_parameters_path))
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def _write(self, sess, global_step, training_parameters, training_parameters_path):
+        try:
+            self.last_checkpoint = self.saver.save(sess, self.checkpoint_path, global_step=global_step, write_meta_graph=False)
+            if training_parameters is not None:
+                write_json_atomic(training_parameters_path, training_parameters)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        
+    def wait(self):
+        """
+        Wait for the checkpoint being written and raise its exception if it failed
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.exc_info is not None:
+            exc_info, self.exc_info = self.exc_info, None
+            reraise(*exc_info)
+
+
+class TrainingMonitor:
+    """
+    Measure the throughput of the training loop (sentences/sec, tokens/sec, padding ratio) and the time spent in each 
+    phase of a step. The metrics are averaged over the steps since the last flush, exported as Tensorflow summaries
+    and appended to a JSON-lines file.
+    """
+    def __init__(self, metrics_path=None, summary_writer=None):
+        """
+        Args:
+            metrics_path (string): JSON-lines file where the metrics are appended (None: not written)
+            summary_writer (tf.summary.FileWriter): writer used to export the metrics (None: not exported)
+        """
+        self.metrics_path = metrics_path
+        self.summary_writer = summary_writer
+        self.reset()
+        
+    def reset(self):
+        """
+        start a new measurement window
+        """
+        self.start = time.time()
+        self.steps = 0
+        self.sentences = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.phases = defaultdict(float)
+        
+    @contextmanager
+    def phase(self, name):
+        """
+        context manager measuring the time spent in a phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.time() - start
+            
+    def add_phase_time(self, name, seconds):
+        """
+        add time measured elsewhere (e.g. in the thread preparing the batches)
+        """
+        self.phases[name] += seconds
+        
+    def record(self, sentences, tokens=0, padded_tokens=0):
+        """
+        record a training step
+        Args:
+            sentences (Natural Integer): number of sentences in the batch
+            tokens (Natural Integer): number of real tokens
+            padded_tokens (Natural Integer): number of tokens after padding
+        """
+        self.steps += 1
+        self.sentences += sentences
+        self.tokens += tokens
+        self.padded_tokens += padded_tokens
+        
+    def flush(self, step):
+        """
+        export the metrics of the current window and start a new one
+        Args:
+            step (Natural Integer): current training step
+        Returns:
+            dictionary of metrics (phases are given in seconds per step)
+        """
+        elapsed = max(time.time() - self.start, 1e-9)
+        steps = max(self.steps, 1)
+        metrics = {'step': step,
+                   'steps_per_sec': self.steps / elapsed,
+                   'sentences_per_sec': self.sentences / elapsed,
+                   'tokens_per_sec': self.tokens / elapsed}
+        if self.padded_tokens > 0:
+            metrics['padding_ratio'] = 1. - float(self.tokens) / self.padded_tokens
+        for name, seconds in self.phases.items():
+            metrics['time_' + name] = seconds / steps
+        if self.summary_writer is not None:
+            summary = tf.Summary(value=[ tf.Summary.Value(tag="throughput/" + k, simple_value=float(v)) for k, v in metrics.items() if k != 'step' ])
+            self.summary_writer.add_summary(summary, global_step=step)
+        if self.metrics_path is not None:
+            with open(self.metrics_path, 'a') as fp:
+                fp.write(json.dumps(metrics) + '\n')
+        self.reset()
+        return metrics
+
+
+def write_trace(run_metadata, path, summary_writer=None, step=None):
+    """
+    Write the trace of a step (tf.RunMetadata collected with tf.RunOptions.FULL_TRACE) as a Chrome trace
+    (open with chrome://tracing) and optionally add it to Tensorboard
+    """
+    from tensorflow.python.client import timeline
+    with open(path, 'w') as fp:
+        fp.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+    if summary_writer is not None:
+        summary_writer.add_run_metadata(run_metadata, "step%d" % step, global_step=step)